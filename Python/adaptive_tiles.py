@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+################################################################################
+#Adaptive tile sizes from the slope and curvature of the focus surface.
+
+#tile_grid() in focus_map.py covers the sample with tiles of one view field
+#and sets one WD per tile (the surface at the tile centre). Where the
+#surface is steep the corners of a tile are off by more than the depth of
+#focus, where it is flat a much larger field would still be sharp.
+
+#plan_tiles() builds a quadtree of fields instead. It starts from a grid of
+#the largest fields (fov_min * 2^(levels - 1)) and splits a field into four
+#while its WD error is above half the depth of focus. The error of a field
+#of size s with the WD of its centre is bounded from the gradient g and the
+#Hessian H of the surface at the centre:
+#    (|gx| + |gy|) s / 2 + (|hxx| + 2 |hxy| + |hyy|) s^2 / 8
+#(exact for a quadratic surface). All fields of a level are evaluated in
+#one vectorized call. Flat regions end up as few large fields, steep
+#regions as small ones. Fields of the smallest size that are still out of
+#focus are reported (err > dof / 2).
+
+#Neighbouring fields overlap by at least overlap_fraction of the smaller
+#one. With pixel_size given, the pixel count of a field grows with its
+#size (same resolution, fewer stage moves and files), else the fields keep
+#one pixel count and the large ones have coarser pixels.
+
+#Lengths are in meters and view fields in microns, as in focus_map.py.
+
+#Example:
+#    sf = fit_surface(x, y, wd, 'poly22')
+#    plan = plan_tiles(sf, (x.min(), x.max(), y.min(), y.max()), fov_min=50, levels=4, dof=10)
+#    for level, targets in level_targets(plan).items():
+#        TileAcquisition(m, 'L%d' % level, width=w, height=w, view_field=fov * 1e-3).run(targets)
+################################################################################
+
+from __future__ import print_function
+
+import numpy as np
+
+PLAN_KEYS = ('x', 'y', 'wd', 'fov', 'level', 'col', 'row', 'err', 'pixels')
+
+
+def field_error(sf, x, y, size):
+    """Bound of |WD - WD(centre)| over square fields of the size centred
+    at x, y (surface units, size in the units of x, y)."""
+    gx, gy = sf.gradient(x, y)
+    hxx, hxy, hyy = sf.hessian(x, y)
+    return (np.abs(gx) + np.abs(gy)) * size / 2.0 + \
+        (np.abs(hxx) + 2 * np.abs(hxy) + np.abs(hyy)) * size * size / 8.0
+
+
+def plan_tiles(sf, box, fov_min=50, levels=4, dof=10, overlap_fraction=0.05, pixel_size=None,
+               pixels=1536, max_pixels=16384, keep=None):
+    """Quadtree of fields that keep the whole sample within the depth of focus.
+
+    sf              focus surface (focus_map.fit_surface), meters
+    box             (xmin, xmax, ymin, ymax) of the tile centres [m], as the
+                    tile_grid() of the focus points
+    fov_min         smallest view field [microns]
+    levels          number of field sizes, fov_min * 2^k, k < levels
+    dof             depth of focus [microns], the WD error limit is dof / 2
+    pixel_size      keep this pixel size [m] - pixel count grows with the
+                    field (up to max_pixels, which also limits the levels),
+                    None = 'pixels' for every field
+    keep            callable (pts (n x 2), field size) -> mask of the fields
+                    to keep (e.g. Overview.keep_tiles, in meters)
+    Returns dict of arrays PLAN_KEYS - centre x, y [m], wd [m], fov
+    [microns], level (0 = fov_min), col, row (1-based at the level), err
+    (WD error bound [m]) and pixels (width of the field).
+    """
+    ov = overlap_fraction
+    cell0 = fov_min * 1e-6 * (1 - ov)                   # grid step of the smallest fields
+    if pixel_size is not None:
+        while levels > 1 and round(fov_min * 1e-6 * 2 ** (levels - 1) / pixel_size) > max_pixels:
+            levels -= 1
+    tol = dof * 1e-6 / 2.0
+    xmin, xmax, ymin, ymax = box
+    x0 = xmin - cell0 / 2.0                             # finest cells centred as tile_grid()
+    y0 = ymin - cell0 / 2.0
+    top = levels - 1
+    ctop = cell0 * 2 ** top
+    nx = int(np.ceil((xmax - xmin + cell0) / ctop - 1e-9))
+    ny = int(np.ceil((ymax - ymin + cell0) / ctop - 1e-9))
+    ii, jj = np.meshgrid(np.arange(nx), np.arange(ny))
+    ii = ii.ravel()
+    jj = jj.ravel()
+    out = dict((k, []) for k in PLAN_KEYS)
+    for level in range(top, -1, -1):
+        cell = cell0 * 2 ** level
+        cx = x0 + (ii + 0.5) * cell
+        cy = y0 + (jj + 0.5) * cell
+        inside = (cx - cell / 2 < xmax + cell0 / 2) & (cy - cell / 2 < ymax + cell0 / 2)
+        size = cell / (1 - ov)
+        if keep is not None and inside.any():
+            inside[inside] = keep(np.column_stack([cx[inside], cy[inside]]), size)
+        ii, jj, cx, cy = ii[inside], jj[inside], cx[inside], cy[inside]
+        if len(ii) == 0:
+            break
+        err = field_error(sf, cx, cy, size)
+        split = (err > tol) if level > 0 else np.zeros(len(ii), dtype=bool)
+        leaf = ~split
+        fov = fov_min * 2 ** level
+        out['x'].append(cx[leaf])
+        out['y'].append(cy[leaf])
+        out['wd'].append(sf(cx[leaf], cy[leaf]))
+        out['fov'].append(np.full(leaf.sum(), float(fov)))
+        out['level'].append(np.full(leaf.sum(), level))
+        out['col'].append(ii[leaf] + 1)
+        out['row'].append(jj[leaf] + 1)
+        out['err'].append(err[leaf])
+        if pixel_size is None:
+            out['pixels'].append(np.full(leaf.sum(), pixels))
+        else:
+            out['pixels'].append(np.full(leaf.sum(), int(round(fov * 1e-6 / pixel_size))))
+        ii = np.concatenate([2 * ii[split] + d for d in (0, 1, 0, 1)])
+        jj = np.concatenate([2 * jj[split] + d for d in (0, 0, 1, 1)])
+    return dict((k, np.concatenate(v) if v else np.zeros(0)) for k, v in out.items())
+
+
+def summary(plan, dof=10):
+    """Text summary - fields per level, out of focus fields."""
+    lines = []
+    for level in np.unique(plan['level'])[::-1]:
+        m = plan['level'] == level
+        lines.append('fov %6.1f um: %6d fields, max WD error %.2f um' % (
+            plan['fov'][m][0], m.sum(), 1e6 * plan['err'][m].max()))
+    bad = (plan['err'] > dof * 1e-6 / 2.0).sum()
+    lines.append('%d fields, %d out of focus' % (len(plan['x']), bad))
+    return '\n'.join(lines)
+
+
+def plan_names(plan):
+    """Names 'L<level>_<col>_<row>' of the fields."""
+    return ['L%d_%04d_%04d' % t for t in zip(plan['level'], plan['col'], plan['row'])]
+
+
+def level_targets(plan):
+    """TileAcquisition targets (x, y, wd [mm], name) of each level,
+    dict level -> list. A level has one view field (fov of the level)."""
+    names = plan_names(plan)
+    out = {}
+    for i in np.lexsort((plan['col'], plan['row'], plan['level'])):
+        out.setdefault(int(plan['level'][i]), []).append(
+            (float(plan['x'][i]) * 1e3, float(plan['y'][i]) * 1e3, float(plan['wd'][i]) * 1e3, names[i]))
+    return out
+
+
+def plan_samples(plan, z_stage, image_base_name='Snap'):
+    """ImageSnapper PointSample attributes of all the fields (each with its
+    view field), for imagesnapper.write_project()."""
+    from imagesnapper import point_samples
+    names = plan_names(plan)
+    for level in np.unique(plan['level'])[::-1]:
+        idx = np.flatnonzero(plan['level'] == level)
+        pts = np.column_stack([plan['x'][idx], plan['y'][idx], plan['wd'][idx]]).tolist()
+        for s in point_samples(pts, [names[i] for i in idx], z_stage, plan['fov'][idx[0]], image_base_name):
+            yield s
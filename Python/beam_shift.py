@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+################################################################################
+#Beam shift sub-field tiling.
+
+#A stage move and its settling cost far more than a beam deflection.
+#BeamShiftAcquisition groups the tiles of the grid into k x k blocks, moves
+#the stage once to the centre of a block and reaches the fields of the
+#block with Sem.SetImageShift. The stage travel and the number of settles
+#drop by about k^2. Each sub-field gets the WD of its own position (the
+#target WD, or the focus surface at the effective position), the image
+#shift is restored at the end.
+
+#The shift needed for a field offset comes from ShiftCalibration - the
+#matrix from the shift command to the field displacement on the stage,
+#measured by calibrate_shift() (phase correlation of scans at shifted
+#beam). The calibration can be measured once, or again every few blocks
+#(the acquisition runs in chunks, the pipeline drains in between). The
+#stage goes to the middle of the grid cells of the block, so no field is
+#more than (k - 1) / 2 steps off, partial blocks at the edge included. k
+#is reduced until the shift commands of all the fields (calibration
+#applied) are within shift_limit; a command beyond it (a recalibration
+#that changed the scale) stops the run with an error. The .hdr of a tile gets the effective position (stage + field
+#displacement) as StageX/StageY, so tile_manifest.py, mosaic.py --stage and
+#the .hdr index see the true field centres, and the shift command as
+#ImageShiftX/ImageShiftY.
+
+#Units are SharkSEM units (mm), image shift included.
+
+#Example:
+#    cal = calibrate_shift(m, limit=0.05)
+#    acq = BeamShiftAcquisition(m, 'HighRes', k=3, shift_limit=0.05, calibration=cal,
+#                               width=1536, height=1536, view_field=0.05)
+#    records = acq.run(targets, coordn)
+################################################################################
+
+from __future__ import print_function
+
+import numpy as np
+
+from registration import phase_correlation
+from tile_acquisition import TileAcquisition, WAIT_SCAN, WAIT_STAGE, WAIT_OPTICS
+
+
+class ShiftCalibration:
+    """Linear map of the image shift command to the field displacement.
+
+    matrix      (2 x 2) - displacement = matrix . command [mm]
+    """
+
+    def __init__(self, matrix=None):
+        self.matrix = np.eye(2) if matrix is None else np.asarray(matrix, dtype=float)
+
+    def command(self, dx, dy):
+        """Shift command for a field displacement dx, dy."""
+        c = np.linalg.solve(self.matrix, [dx, dy])
+        return float(c[0]), float(c[1])
+
+    def displacement(self, sx, sy):
+        """Field displacement of a shift command."""
+        d = self.matrix.dot([sx, sy])
+        return float(d[0]), float(d[1])
+
+
+def calibrate_shift(m, d=None, limit=0.05, width=512, channel=0, flip_x=True, flip_y=False):
+    """Measure the ShiftCalibration at the current stage position.
+
+    Three frames (shift 0, (d, 0), (0, d)) of the current view field are
+    registered by phase correlation. d defaults to 0.8 limit, at most a
+    quarter of the view field.
+    channel         input video channel, enabled by the caller (DtEnable)
+    flip_x, flip_y  image axes against stage axes, as in mosaic.py
+    """
+    vf = m.GetViewField()
+    if d is None:
+        d = min(0.8 * limit, 0.25 * vf)
+    old_flags = m.connection.wait_flags
+    old = m.GetImageShift()
+    frames = []
+    try:
+        for i, (sx, sy) in enumerate(((0.0, 0.0), (d, 0.0), (0.0, d))):
+            m.SetWaitFlags(WAIT_SCAN)
+            m.SetImageShift(old[0] + sx, old[1] + sy)
+            m.SetWaitFlags(WAIT_SCAN | WAIT_STAGE | WAIT_OPTICS)
+            frame = 0x30000000 + i
+            res = m.ScScanXY(frame, width, width, 0, 0, width - 1, width - 1, 1)
+            if res is None or res < 0:
+                raise RuntimeError('ScScanXY failed in the shift calibration')
+            frames.append(np.asarray(m.FetchImages([channel], width, width, frame)[channel], dtype=np.float32))
+    finally:
+        m.SetWaitFlags(WAIT_SCAN)
+        m.SetImageShift(old[0], old[1])
+        m.SetWaitFlags(old_flags)
+    s = phase_correlation(np.stack(frames[1:]), np.stack([frames[0], frames[0]]))
+    ps = vf / float(width)
+    # a feature moves against the field: displacement = -s * pixel size
+    sign = np.array([1.0 if flip_x else -1.0, 1.0 if flip_y else -1.0])
+    disp = s * ps * sign[None, :]
+    matrix = disp.T / d
+    if np.linalg.cond(matrix) > 100:
+        raise RuntimeError('image shift calibration failed (no shift seen)')
+    return ShiftCalibration(matrix)
+
+
+def max_block(step, limit):
+    """Largest k of a k x k block with the field step and shift limit [mm]."""
+    return int(np.floor(2.0 * limit / step + 1e-9)) + 1
+
+
+def _grid_index(pts):
+    """(column, row) 1-based ranks of the x, y of a regular grid."""
+    cols = np.unique(np.round(pts[:, 0], 6), return_inverse=True)[1].reshape(-1)
+    rows = np.unique(np.round(pts[:, 1], 6), return_inverse=True)[1].reshape(-1)
+    return np.column_stack([cols + 1, rows + 1])
+
+
+def shift_blocks(pts, coordn, k):
+    """Group grid fields into k x k blocks.
+
+    pts     (n x 2) field centres [mm]
+    coordn  (n x 2) 1-based (column, row) grid indices
+    Returns (order, centre, offset) - acquisition order (blocks in
+    serpentine order, fields in serpentine order in a block), stage
+    position of the block of each field (n x 2) and the field offset from
+    it (n x 2). The block position is the middle of the grid cells its
+    fields span (grid vectors fitted to pts, coordn), not their mean - an
+    offset is at most (k - 1) / 2 steps on each grid axis.
+    """
+    pts = np.asarray(pts, dtype=float)
+    c = np.asarray(coordn, dtype=np.int64) - 1
+    bx, by = c[:, 0] // k, c[:, 1] // k
+    key = by * (bx.max() + 1) + bx
+    uniq, inv = np.unique(key, return_inverse=True)
+    inv = inv.reshape(-1)
+    nb = len(uniq)
+    # grid origin and column, row vectors: pts = origin + c . (ex, ey)
+    a = np.column_stack([np.ones(len(c)), c]).astype(float)
+    basis = np.linalg.lstsq(a, pts, rcond=None)[0][1:]
+    # middle of the cells spanned by each block
+    mid = np.zeros((nb, 2))
+    for j in (0, 1):
+        lo = np.full(nb, np.iinfo(np.int64).max)
+        hi = np.full(nb, np.iinfo(np.int64).min)
+        np.minimum.at(lo, inv, c[:, j])
+        np.maximum.at(hi, inv, c[:, j])
+        mid[:, j] = 0.5 * (lo + hi)
+    nominal = (c - mid[inv]).dot(basis)
+    # one stage position per block - the fields off the lattice share it
+    centre = np.zeros((nb, 2))
+    np.add.at(centre, inv, pts - nominal)
+    centre /= np.bincount(inv, minlength=nb)[:, None]
+    centre = centre[inv]
+    # serpentine: odd block rows backwards, odd rows in a block backwards
+    bxs = np.where(by % 2 == 1, -bx, bx)
+    lx, ly = c[:, 0] % k, c[:, 1] % k
+    lxs = np.where(ly % 2 == 1, -lx, lx)
+    order = np.lexsort((lxs, ly, bxs, by))
+    return order, centre, pts - centre
+
+
+class BeamShiftAcquisition(TileAcquisition):
+    """TileAcquisition with k x k sub-fields per stage position.
+
+    k               block size, reduced to what shift_limit allows
+    shift_limit     largest image shift command [mm]
+    calibration     ShiftCalibration, callable (x, y) -> ShiftCalibration
+                    (per block, e.g. interpolated), or None (identity)
+    recalibrate     measure the calibration (calibrate_shift) every this
+                    many blocks, 0 = never
+    surface         callable wd(x, y) [mm] - WD at the effective position,
+                    None = the WD of the target
+    flip_x, flip_y  image axes against stage axes (for recalibrate)
+    Other arguments as TileAcquisition.
+    """
+
+    def __init__(self, m, out_dir, k=3, shift_limit=0.05, calibration=None, recalibrate=0,
+                 surface=None, flip_x=True, flip_y=False, **kwargs):
+        TileAcquisition.__init__(self, m, out_dir, **kwargs)
+        self.k = k
+        self.shift_limit = shift_limit
+        self.calibration = calibration or ShiftCalibration()
+        self.recalibrate = recalibrate
+        self.surface = surface
+        self.flip_x = flip_x
+        self.flip_y = flip_y
+        self.plan = {}                  # name -> stage position, offset, order
+
+    def _calibration(self, x, y):
+        if isinstance(self.calibration, ShiftCalibration):
+            return self.calibration
+        return self.calibration(x, y)
+
+    def stage_position(self, record):
+        p = self.plan[record['name']]
+        return p['stage_x'], p['stage_y']
+
+    def tile_setup(self, record):
+        """Set the image shift of the sub-field, record the effective position."""
+        p = self.plan[record['name']]
+        cal = self._calibration(p['stage_x'], p['stage_y'])
+        lim = self.shift_limit
+        sx, sy = cal.command(p['dx'], p['dy'])
+        if max(abs(sx), abs(sy)) > lim * (1 + 1e-9):
+            raise RuntimeError('image shift (%.6g, %.6g) of tile %s beyond shift_limit %g' % (
+                sx, sy, record['name'], lim))
+        self.m.SetImageShift(self.shift0[0] + sx, self.shift0[1] + sy)
+        dx, dy = cal.displacement(sx, sy)
+        record['index'] = p['index']
+        record['stage_x'] = p['stage_x']
+        record['stage_y'] = p['stage_y']
+        record['shift'] = (sx, sy)
+        record['x'] = p['stage_x'] + dx
+        record['y'] = p['stage_y'] + dy
+
+    def tile_wd(self, record):
+        if self.surface is not None:
+            return float(self.surface(record['x'], record['y']))
+        return record['wd']
+
+    def _max_command(self, centre, offset):
+        """Largest |shift command| of the fields of a plan."""
+        if isinstance(self.calibration, ShiftCalibration):
+            return float(np.abs(np.linalg.solve(self.calibration.matrix, offset.T)).max())
+        keys, first, inv = np.unique(centre, axis=0, return_index=True, return_inverse=True)
+        inv = inv.reshape(-1)
+        worst = 0.0
+        for b, i in enumerate(first):
+            cal = self._calibration(centre[i, 0], centre[i, 1])
+            cmd = np.linalg.solve(cal.matrix, offset[inv == b].T)
+            worst = max(worst, float(np.abs(cmd).max()))
+        return worst
+
+    def blocks(self, targets, coordn=None):
+        """Plan the targets in blocks, returns (order, k). k is the largest
+        up to self.k whose shift commands are all within shift_limit."""
+        pts = np.array([(float(t[0]), float(t[1])) for t in targets]).reshape(-1, 2)
+        if coordn is None:
+            coordn = _grid_index(pts)
+        k = self.k
+        steps = []
+        for a in (0, 1):
+            u = np.unique(np.round(pts[:, a], 6))
+            if len(u) > 1:
+                steps.append(np.median(np.diff(u)))
+        if steps:
+            k = max(min(k, max_block(max(steps), self.shift_limit)), 1)
+        while True:
+            order, centre, offset = shift_blocks(pts, coordn, k)
+            if k == 1 or self._max_command(centre, offset) <= self.shift_limit * (1 + 1e-9):
+                break
+            k = k - 1
+        self.plan = {}
+        for n, i in enumerate(order):
+            self.plan[self.tile_name(i, targets[i])] = {
+                'index': n, 'stage_x': centre[i, 0], 'stage_y': centre[i, 1],
+                'dx': offset[i, 0], 'dy': offset[i, 1]}
+        return order, k
+
+    def run(self, targets, coordn=None, callback=None, plan=True):
+        """Acquire the targets (x, y, wd[, name]) in k x k blocks.
+
+        coordn  1-based grid indices of the targets (tile_grid()), default
+                ranks of their x, y
+        plan    False - the targets are named, in the order of a blocks()
+                call made before over a longer list (a part of it, e.g. a
+                chunk of DriftMonitor.run), acquired with that plan
+        Returns the records in acquisition order, with x, y the effective
+        field position, stage_x, stage_y and shift (command).
+        """
+        targets = list(targets)
+        if plan:
+            order, k = self.blocks(targets, coordn)
+        else:
+            order = range(len(targets))
+        ordered = [(targets[i][0], targets[i][1], targets[i][2], self.tile_name(i, targets[i])) for i in order]
+        chunks = [ordered]
+        if self.recalibrate:
+            key = [self.stage_position({'name': t[3]}) for t in ordered]
+            starts = [i for i in range(len(key)) if i == 0 or key[i] != key[i - 1]]
+            cut = starts[::self.recalibrate] + [len(ordered)]
+            chunks = [ordered[a:b] for a, b in zip(cut[:-1], cut[1:])]
+        m = self.m
+        self.shift0 = m.GetImageShift()
+        records = []
+        try:
+            for chunk in chunks:
+                if self.recalibrate and chunk:
+                    old_flags = m.connection.wait_flags
+                    m.SetWaitFlags(WAIT_SCAN)
+                    m.SetImageShift(self.shift0[0], self.shift0[1])
+                    m.StgMoveTo(*self.stage_position({'name': chunk[0][3]}))
+                    if self.view_field is not None:
+                        m.SetViewField(self.view_field)
+                    m.SetWaitFlags(old_flags)
+                    self.calibration = calibrate_shift(m, limit=self.shift_limit, channel=self.channels[0],
+                                                       flip_x=self.flip_x, flip_y=self.flip_y)
+                records.extend(TileAcquisition.run(self, chunk, callback))
+        finally:
+            old_flags = m.connection.wait_flags
+            m.SetWaitFlags(WAIT_SCAN)
+            m.SetImageShift(self.shift0[0], self.shift0[1])
+            m.SetWaitFlags(old_flags)
+        return records
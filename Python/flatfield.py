@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+################################################################################
+#Flat-field and tile brightness correction.
+
+#The tiles are acquired without ImageSnapper's ShadingCorrection and
+#AutoGainBlack (speed), so the mosaic shows vignetting and brightness steps
+#between tiles. Both are corrected in post, before the assembly.
+
+#Model - a pixel of a tile is  I = dark + flat(x, y) * gain * signal.
+#  flat    smooth per-pixel gain of the detector/scan (mean 1)
+#  dark    black level, constant
+#  gain    per-tile brightness (drift of brightness/contrast)
+
+#Estimation is one streaming pass over all the tiles. Workers read the
+#tiles and return them block-averaged (binning x binning); the main process
+#adds them to a per-pixel histogram of the values (bounded memory, no
+#matter the number of tiles). Per-pixel percentiles come from the
+#histograms - the median map is dark + flat * s50, a lower percentile map
+#dark + flat * s_q. Lines fitted to the low percentiles against the median
+#over the pixels all pass through (dark, dark), which gives the dark
+#level. The flat is the median map minus dark, normalized. A
+#16 x 16 profile of each tile is kept for the gain matching - the level of
+#a tile is compared with its grid neighbours (or with all the tiles).
+
+#Correction (I - dark) / flat * gain + dark runs in a process pool, the
+#corrected tiles are written to a new directory with their .hdr files.
+
+#Example:
+#    python flatfield.py D:\Data\Flat tif D:\Data\Corrected
+################################################################################
+
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from mosaic import find_tiles, parse_grid_names
+from tile_manifest import manifest_tiles
+from tile_acquisition import load_image, save_image
+
+_COARSE = 16
+
+
+def _bin(img, b):
+    """Block mean b x b (gray), size cropped to a multiple of b."""
+    f = np.asarray(img, dtype=np.float32)
+    if f.ndim == 3:
+        f = f.mean(axis=2)
+    h = f.shape[0] // b * b
+    w = f.shape[1] // b * b
+    return f[0:h, 0:w].reshape(h // b, b, w // b, b).mean(axis=(1, 3))
+
+
+def _read_binned(args):
+    """Worker - binned tiles and their coarse profiles (None if unreadable)."""
+    paths, binning = args
+    out = []
+    for p in paths:
+        try:
+            small = _bin(load_image(p), binning)
+        except Exception:
+            out.append(None)
+            continue
+        out.append((small, _bin(small, max(small.shape[0] // _COARSE, 1))[0:_COARSE, 0:_COARSE]))
+    return out
+
+
+class PixelHistogram:
+    """Per-pixel histograms of many images of the same size.
+
+    shape   image size
+    vmax    values are binned over [0, vmax] (clipped)
+    """
+
+    def __init__(self, shape, vmax, bins=512):
+        self.shape = shape
+        self.vmax = float(vmax)
+        self.bins = bins
+        self.counts = np.zeros(int(np.prod(shape)) * bins, dtype=np.uint32)
+        self.n = 0
+
+    def add(self, stack):
+        """Add (k x h x w) stack of images."""
+        stack = np.asarray(stack, dtype=np.float32).reshape(len(stack), -1)
+        k = np.clip((stack * (self.bins / self.vmax)).astype(np.int64), 0, self.bins - 1)
+        k += np.arange(stack.shape[1], dtype=np.int64)[None, :] * self.bins
+        self.counts += np.bincount(k.ravel(), minlength=len(self.counts)).astype(np.uint32)
+        self.n += len(stack)
+
+    def percentile(self, q):
+        """Per-pixel q-th percentile (0..100) map, linear within a bin."""
+        c = self.counts.reshape(-1, self.bins).astype(np.float64)
+        cum = np.cumsum(c, axis=1)
+        target = cum[:, -1:] * q / 100.0
+        i = np.argmax(cum >= target, axis=1)
+        idx = np.arange(len(i))
+        below = np.where(i > 0, cum[idx, i - 1], 0.0)
+        frac = (target[:, 0] - below) / np.maximum(c[idx, i], 1.0)
+        return ((i + frac) * self.vmax / self.bins).reshape(self.shape)
+
+
+def _smooth(a):
+    """3 x 3 box filter, edges replicated."""
+    p = np.pad(a, 1, mode='edge')
+    return sum(p[i:i + a.shape[0], j:j + a.shape[1]] for i in range(3) for j in range(3)) / 9.0
+
+
+def _upsample(a, h, w):
+    """Bilinear upsampling of a binned map to h x w (linear at the edges)."""
+    a = np.concatenate([2 * a[:1] - a[1:2], a, 2 * a[-1:] - a[-2:-1]], axis=0)
+    a = np.concatenate([2 * a[:, :1] - a[:, 1:2], a, 2 * a[:, -1:] - a[:, -2:-1]], axis=1)
+    ys = (np.arange(h) + 0.5) * (a.shape[0] - 2) / float(h) + 0.5
+    xs = (np.arange(w) + 0.5) * (a.shape[1] - 2) / float(w) + 0.5
+    rows = np.array([np.interp(xs, np.arange(a.shape[1]), r) for r in a])
+    return np.array([np.interp(ys, np.arange(a.shape[0]), c) for c in rows.T]).T.astype(np.float32)
+
+
+def estimate(paths, binning=8, low=(2, 5, 10, 20, 30), workers=None, chunk=64, bins=512, dark=None):
+    """Estimate flat field and dark level from the tiles in one pass.
+
+    binning     block size of the estimate, the flat is smooth
+    low         low percentiles used for the dark level
+    dark        known dark level (skips its estimate)
+    Returns dict with flat (full size, float32, mean 1), dark, levels
+    (per-tile brightness, NaN if unreadable) and the coarse profiles.
+    """
+    paths = list(paths)
+    first = load_image(paths[0])
+    h, w = first.shape[0:2]
+    if first.dtype == np.uint8:
+        vmax = 256.0
+    else:
+        vmax = None                                     # from the first chunk
+    shape = (h // binning, w // binning)                # binned size, other sizes are skipped
+    hist = None
+    coarse = np.full((len(paths), _COARSE, _COARSE), np.nan, dtype=np.float32)
+    jobs = [(paths[i:i + chunk], binning) for i in range(0, len(paths), chunk)]
+    with ProcessPoolExecutor(workers) as pool:
+        for j, res in enumerate(pool.map(_read_binned, jobs)):
+            good = [(i, r) for i, r in enumerate(res) if r is not None and r[0].shape == shape]
+            if not good:
+                continue
+            stack = np.stack([r[0] for i, r in good])
+            if hist is None:
+                if vmax is None:
+                    vmax = 1.25 * float(np.percentile(stack, 99.9)) or 1.0
+                hist = PixelHistogram(stack.shape[1:], vmax, bins)
+            hist.add(stack)
+            for i, r in good:
+                cs = r[1]
+                coarse[j * chunk + i, 0:cs.shape[0], 0:cs.shape[1]] = cs
+    if hist is None:
+        raise ValueError('no readable tile of %d x %d pixels' % (w, h))
+    p50 = _smooth(hist.percentile(50.0))
+    if dark is None:
+        dark = _dark_level([_smooth(hist.percentile(q)) for q in low], p50)
+    flat = np.maximum(p50 - dark, 1e-6)
+    flat /= flat.mean()
+    levels = _levels(coarse, flat, dark)
+    return {'flat': _upsample(flat, h, w), 'flat_binned': flat, 'dark': float(dark),
+            'levels': levels, 'coarse': coarse, 'tiles': hist.n}
+
+
+def _dark_level(plo, p50):
+    """Dark level - the lines p = a * p50 + b of the low percentile maps
+    over the pixels cross the diagonal at dark: b = dark * (1 - a)."""
+    x = p50.ravel()
+    if x.std() < 0.01 * max(x.mean(), 1e-12):
+        return 0.0                                      # flat too uniform to tell
+    num = den = 0.0
+    for p in plo:
+        a, b = np.polyfit(x, p.ravel(), 1)
+        num += b * (1.0 - a)
+        den += (1.0 - a) ** 2
+    if den == 0.0:
+        return 0.0
+    return float(np.clip(num / den, 0.0, min(p.min() for p in plo)))
+
+
+def _levels(coarse, flat, dark):
+    """Brightness of each tile - median of its flat-corrected profile."""
+    cs = _COARSE
+    b = flat.shape[0] // cs, flat.shape[1] // cs
+    fc = flat[0:b[0] * cs, 0:b[1] * cs].reshape(cs, b[0], cs, b[1]).mean(axis=(1, 3))
+    corrected = ((coarse - dark) / fc[None]).reshape(len(coarse), -1)
+    levels = np.full(len(coarse), np.nan)
+    read = np.isfinite(corrected).any(axis=1)           # unreadable tiles stay NaN
+    levels[read] = np.nanmedian(corrected[read], axis=1)
+    return levels
+
+
+def tile_gains(levels, cols=None, rows=None, mode='local', clip=(0.5, 2.0), passes=4):
+    """Gain of each tile that matches its brightness to the others.
+
+    mode    'local' - median level of the 8 grid neighbours (needs cols,
+            rows), repeated passes times on the corrected levels (a
+            brightness change over the sample wider than a few tiles is
+            kept), 'global' - median of all the tiles, 'none' - 1
+    """
+    levels = np.asarray(levels, dtype=float)
+    gains = np.ones(len(levels))
+    ok = np.isfinite(levels) & (levels > 0)
+    if mode == 'none' or not ok.any():
+        return gains
+    if mode == 'global' or cols is None:
+        gains[ok] = np.clip(np.median(levels[ok]) / levels[ok], clip[0], clip[1])
+        return gains
+    at = dict(((c, r), i) for i, (c, r) in enumerate(zip(cols, rows)) if ok[i])
+    nbs = [[at[(c + dc, r + dr)] for dc in (-1, 0, 1) for dr in (-1, 0, 1)
+            if (dc or dr) and (c + dc, r + dr) in at] for c, r in zip(cols, rows)]
+    for k in range(passes):
+        cur = levels * gains
+        for i in np.flatnonzero(ok):
+            if nbs[i]:
+                gains[i] *= np.median(cur[nbs[i]]) / cur[i]
+        gains[ok] = np.clip(gains[ok], clip[0], clip[1])
+    return gains
+
+
+def correct(img, flat, dark, gain=1.0):
+    """Corrected image, same dtype: (img - dark) / flat * gain + dark."""
+    f = np.asarray(img, dtype=np.float32)
+    fl = flat if f.ndim == 2 else flat[:, :, None]
+    out = (f - dark) * (gain / fl) + dark
+    if np.issubdtype(img.dtype, np.integer):
+        info = np.iinfo(img.dtype)
+        out = np.clip(np.rint(out), info.min, info.max)
+    return out.astype(img.dtype)
+
+
+_flat = {}
+
+
+def _apply_chunk(args):
+    """Worker - correct and write a chunk of tiles, returns errors."""
+    jobs, flat_path, dark = args
+    if flat_path not in _flat:
+        _flat.clear()
+        _flat[flat_path] = np.load(flat_path)
+    flat = _flat[flat_path]
+    errors = []
+    for src, hdr, dst, gain in jobs:
+        try:
+            save_image(dst, correct(load_image(src), flat, dark, gain))
+            if hdr and os.path.exists(hdr):
+                base, ext = os.path.splitext(dst)
+                shutil.copy2(hdr, '%s-%s.hdr' % (base, ext[1:]))
+        except Exception as e:
+            errors.append('%s: %s' % (src, e))
+    return errors
+
+
+def apply(tiles, out_dir, flat, dark, gains, ext, workers=None, chunk=16):
+    """Write corrected tiles to out_dir as <name>.<ext> + .hdr.
+
+    tiles   list of (name, image path, hdr path) (mosaic.find_tiles())
+    The flat field is saved as out_dir/flat.npy. Returns list of errors.
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    flat_path = os.path.join(out_dir, 'flat.npy')
+    np.save(flat_path, flat)
+    jobs = [(p, h, os.path.join(out_dir, '%s.%s' % (n, ext)), float(g))
+            for (n, p, h), g in zip(tiles, gains)]
+    chunks = [(jobs[i:i + chunk], flat_path, dark) for i in range(0, len(jobs), chunk)]
+    errors = []
+    with ProcessPoolExecutor(workers) as pool:
+        for e in pool.map(_apply_chunk, chunks):
+            errors.extend(e)
+    return errors
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='Flat-field and brightness correction of tiles.')
+    p.add_argument('directory', help='tile directory or manifest.csv')
+    p.add_argument('ext', help='tile extension, e.g. tif')
+    p.add_argument('out_dir')
+    p.add_argument('--gain', default='local', choices=('local', 'global', 'none'))
+    p.add_argument('--binning', type=int, default=8)
+    p.add_argument('--dark', type=float, default=None, help='known dark level')
+    p.add_argument('--workers', type=int, default=None)
+    a = p.parse_args(argv)
+    t = time.time()
+    if a.directory.endswith('.csv'):
+        tiles = manifest_tiles(a.directory)
+    else:
+        tiles = find_tiles(a.directory, a.ext)
+    res = estimate([t_[1] for t_ in tiles], a.binning, workers=a.workers, dark=a.dark)
+    cols, rows = parse_grid_names([t_[0] for t_ in tiles])
+    gains = tile_gains(res['levels'], cols, rows, a.gain)
+    print('%d tiles, dark %.2f, flat %.3f..%.3f, gains %.3f..%.3f' % (
+        res['tiles'], res['dark'], res['flat'].min(), res['flat'].max(), gains.min(), gains.max()))
+    errors = apply(tiles, a.out_dir, res['flat'], res['dark'], gains, a.ext, a.workers)
+    for e in errors:
+        print(e)
+    print('Run time = %d seconds' % (time.time() - t))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+################################################################################
+#Focus drift tracking during long acquisitions.
+
+#The WD surface of the focus map is measured before the high-res run. Over
+#hours the focus drifts (thermal, stage), the later tiles go soft.
+#DriftMonitor runs the acquisition in chunks. Between the chunks (every
+#'every' tiles or 'minutes', whichever comes first - the chunk size follows
+#the measured tile rate, a BeamShiftAcquisition chunk ends with a block)
+#it measures the WD at a few reference points again (Sem.AutoWD, or
+#focus_sweep.FocusSweep). The first measurement is the baseline, the
+#change against it is the drift. DriftModel fits the drift of each check
+#as an offset, or offset and tilt (3 points or more), and extrapolates it
+#linearly in time from the last checks. The WD of every following tile
+#is corrected through the tile_wd() hook of the acquisition (plan + drift
+#at the tile position and time), each check is logged.
+
+#Units are SharkSEM units - mm for the stage and WD.
+
+#Example:
+#    mon = DriftMonitor(m, refs=[(x0, y0), (x1, y1), (x2, y2)], every=200, minutes=20,
+#                       mode='tilt', log='HighRes/drift.csv')
+#    records = mon.run(TileAcquisition(m, 'HighRes'), targets)
+################################################################################
+
+from __future__ import print_function
+import os
+import time
+
+import numpy as np
+
+from focus_sampling import autowd_measure
+
+LOG_COLUMNS = ('time', 'check', 'tiles', 'offset', 'tilt_x', 'tilt_y', 'rate', 'points', 'residual')
+
+
+class DriftModel:
+    """Time-dependent WD drift from re-measured reference points.
+
+    refs        (n x 2) reference positions [mm]
+    mode        'offset' or 'tilt' (offset + linear in x, y)
+    window      number of last checks (baseline included) for the drift rate
+    extrapolate continue the drift at the fitted rate after the last check
+    min_sigma   smallest residual rejected by the tilt fit [mm]
+    """
+
+    def __init__(self, refs, mode='offset', window=3, extrapolate=True, min_sigma=0.005):
+        self.refs = np.asarray(refs, dtype=float).reshape(-1, 2)
+        self.center = self.refs.mean(axis=0)
+        self.mode = mode
+        self.window = window
+        self.extrapolate = extrapolate
+        self.min_sigma = min_sigma
+        self.baseline = None
+        self.times = []
+        self.params = []                        # (offset, tilt_x, tilt_y) per check
+        self.residual = []
+
+    def set_baseline(self, t, wds):
+        """First measurement (None / NaN = failed point)."""
+        self.baseline = np.array([np.nan if w is None else w for w in wds], dtype=float)
+        self.times = [t]
+        self.params = [np.zeros(3)]
+        self.residual = [0.0]
+
+    def add(self, t, wds):
+        """Add a check, returns its (offset, tilt_x, tilt_y) [mm, mm/mm]."""
+        wds = np.array([np.nan if w is None else w for w in wds], dtype=float)
+        d = wds - self.baseline
+        ok = np.isfinite(d)
+        p = np.zeros(3)
+        res = 0.0
+        if ok.sum() >= 3 and self.mode == 'tilt':
+            for k in range(2):                          # fit, drop outliers, fit again
+                a = np.column_stack([np.ones(ok.sum()), self.refs[ok] - self.center])
+                p = np.linalg.lstsq(a, d[ok], rcond=None)[0]
+                r = np.abs(a.dot(p) - d[ok])
+                bad = r > max(3.0 * 1.4826 * np.median(r), self.min_sigma)
+                if not bad.any() or ok.sum() - bad.sum() < 3:
+                    break
+                ok[np.flatnonzero(ok)[bad]] = False
+            res = float(np.sqrt(np.mean(r[~bad] ** 2)))
+        elif ok.any():
+            p[0] = np.median(d[ok])
+            res = float(np.sqrt(np.mean((d[ok] - p[0]) ** 2)))
+        else:
+            p = self.params[-1].copy()              # nothing measured, keep
+        self.times.append(t)
+        self.params.append(p)
+        self.residual.append(res)
+        return p
+
+    def rate(self):
+        """Drift rate of the parameters [per second] from the last checks."""
+        n = min(self.window, len(self.times))
+        if not self.extrapolate or n < 2:
+            return np.zeros(3)
+        t = np.array(self.times[-n:])
+        p = np.array(self.params[-n:])
+        tc = t - t.mean()
+        den = (tc * tc).sum()
+        return tc.dot(p - p.mean(axis=0)) / den if den > 0 else np.zeros(3)
+
+    def params_at(self, t):
+        """Drift parameters at time t."""
+        if not self.params:
+            return np.zeros(3)
+        return self.params[-1] + self.rate() * max(t - self.times[-1], 0.0)
+
+    def correction(self, x, y, t):
+        """WD correction at x, y [mm] and time t."""
+        p = self.params_at(t)
+        return p[0] + p[1] * (np.asarray(x) - self.center[0]) + p[2] * (np.asarray(y) - self.center[1])
+
+
+class DriftMonitor:
+    """Acquisition with periodic focus drift checks.
+
+    m           connected sem.Sem
+    refs        reference positions [(x, y), ...] [mm], on the sample
+    every       tiles between checks
+    minutes     time between checks
+    measure     measure(x, y, wd_guess) -> WD or None, default
+                autowd_measure() (e.g. focus_sweep.FocusSweep)
+    wd_refs     planned WD of the references (focus map), default the WD
+                of the nearest target - only the first guess of the measurement
+    mode, window, extrapolate   see DriftModel
+    log         CSV file of the checks (appended), None = no log
+    """
+
+    def __init__(self, m, refs, every=200, minutes=20.0, measure=None, wd_refs=None,
+                 mode='offset', window=3, extrapolate=True, log=None, verbose=True, channel=0):
+        self.m = m
+        self.model = DriftModel(refs, mode, window, extrapolate)
+        self.every = every
+        self.minutes = minutes
+        self.measure = measure
+        self.wd_refs = wd_refs
+        self.log = log
+        self.verbose = verbose
+        self.channel = channel
+        self.checks = 0
+        self.tiles = 0
+
+    def _measure(self, x, y, guess):
+        if self.measure is not None:
+            return self.measure(x, y, guess)
+        return autowd_measure(self.m, x, y, guess, self.channel)
+
+    def check(self):
+        """Measure the references now, returns the drift parameters."""
+        t = time.time()
+        if self.wd_refs is None:
+            self.wd_refs = [self.m.GetWD()] * len(self.model.refs)
+        wds = []
+        for (x, y), wd0 in zip(self.model.refs, self.wd_refs):
+            guess = wd0 + float(self.model.correction(x, y, t))
+            try:
+                wds.append(self._measure(x, y, guess))
+            except RuntimeError:
+                wds.append(None)
+        if self.model.baseline is None:
+            self.model.set_baseline(t, wds)
+            p = self.model.params[-1]
+        else:
+            p = self.model.add(t, wds)
+        self.checks += 1
+        self._log(t, p, sum(w is not None for w in wds))
+        return p
+
+    def _log(self, t, p, points):
+        rate = self.model.rate()[0] * 3600.0
+        if self.verbose:
+            print('drift check %d after %d tiles: offset %+.4f mm, tilt %+.2e %+.2e, rate %+.4f mm/h, %d points' % (
+                self.checks, self.tiles, p[0], p[1], p[2], rate, points))
+        if self.log is None:
+            return
+        new = not os.path.exists(self.log)
+        with open(self.log, 'a') as f:
+            if new:
+                f.write(','.join(LOG_COLUMNS) + '\n')
+            f.write('%.3f,%d,%d,%.6f,%.6e,%.6e,%.6f,%d,%.6f\n' % (
+                t, self.checks, self.tiles, p[0], p[1], p[2], rate, points, self.model.residual[-1]))
+
+    def run(self, acq, targets, callback=None, **kwargs):
+        """Acquire the targets with acq (TileAcquisition or a subclass) in
+        chunks, with drift checks between them. The tile_wd() of acq is
+        wrapped for the run: planned WD + drift at the tile. Records get
+        wd_drift - the applied correction. Returns all the records.
+
+        A BeamShiftAcquisition plans its blocks once over all the targets
+        (kwargs coordn), a chunk ends at a block boundary - the check never
+        moves the stage away in the middle of a block."""
+        # names from the index in the full list - the chunks restart at 0
+        targets = [tuple(t[0:3]) + (acq.tile_name(i, t),) for i, t in enumerate(targets)]
+        blocks = getattr(acq, 'blocks', None)
+        stage = None                                    # block stage position of each target
+        if blocks is not None and targets:
+            order = blocks(targets, kwargs.pop('coordn', None))[0]
+            targets = [targets[k] for k in order]
+            stage = [acq.stage_position({'name': t[3]}) for t in targets]
+            kwargs['plan'] = False
+        plan_wd = acq.tile_wd
+        model = self.model
+
+        def tile_wd(record):
+            corr = float(model.correction(record['x'], record['y'], time.time()))
+            record['wd_drift'] = corr
+            return plan_wd(record) + corr
+        old = acq.__dict__.get('tile_wd')
+        acq.tile_wd = tile_wd
+        records = []
+        rate = None                                     # seconds per tile
+        if self.wd_refs is None and targets:
+            pts = np.array([(t[0], t[1]) for t in targets], dtype=float)
+            near = [int(np.argmin(np.hypot(pts[:, 0] - x, pts[:, 1] - y))) for x, y in model.refs]
+            self.wd_refs = [float(targets[k][2]) for k in near]
+        try:
+            if model.baseline is None:
+                self.check()
+            i = 0
+            while i < len(targets):
+                n = self.every
+                if rate:
+                    n = min(n, max(int(self.minutes * 60.0 / rate), 1))
+                if stage is not None:                   # to the end of the block
+                    while i + n < len(targets) and stage[i + n] == stage[i + n - 1]:
+                        n += 1
+                chunk = targets[i:i + n]
+                t = time.time()
+                recs = acq.run(chunk, callback=callback, **kwargs)
+                for r in recs:
+                    if stage is None:                   # else the index of the plan
+                        r['index'] += i
+                records.extend(recs)
+                i += len(chunk)
+                self.tiles += len(chunk)
+                rate = (time.time() - t) / max(len(chunk), 1)
+                if i < len(targets):
+                    self.check()
+        finally:
+            if old is None:
+                del acq.__dict__['tile_wd']             # back to the method
+            else:
+                acq.__dict__['tile_wd'] = old
+        return records
@@ -0,0 +1,576 @@
+# -*- coding: utf-8 -*-
+################################################################################
+#Focus map surface fitting (Python counterpart of Matlab/TescanImageSnapper.m).
+
+#The focus map is a set of low-resolution images acquired with autofocus on.
+#Their .hdr files give (StageX, StageY, WD) points. The points are cut to a
+#WD window, cleaned by a Hampel filter, and a surface WD(x, y) is fitted -
+#a polynomial (poly11 = plane, poly22 = quadratic, ...) by least squares or
+#robust (bisquare) least squares, or a smoothing cubic B-spline. The surface
+#is then evaluated over the serpentine grid of high-res tiles in one batched
+#call.
+
+#All lengths are in meters, as in the .hdr files.
+
+#Example:
+#    x, y, wd = read_focus_points('C:/FocusMap/Sample1')
+#    keep = wd_cut(wd, 14e-3, 16e-3)
+#    keep[keep] = ~hampel(wd[keep])
+#    sf = fit_surface(x[keep], y[keep], wd[keep], 'poly22')
+#    pts, coordn = tile_grid(x[keep], y[keep], fov=250, overlap_fraction=0.05)
+#    wd_tiles = sf(pts[:, 0], pts[:, 1])
+################################################################################
+
+from __future__ import print_function
+
+import numpy as np
+
+import tescan_hdr
+
+FOCUS_KEYS = ('WD', 'StageX', 'StageY')
+
+
+def read_focus_points(directory, workers=None, cache=False):
+    """Read StageX, StageY and WD of all .hdr files in a directory.
+
+    cache   use the cached index of hdr_index.py (True = default cache
+            file, or the cache file name), only new files are parsed
+    Returns three arrays x, y, wd (meters), files that lack a key are dropped.
+    """
+    if cache:
+        from hdr_index import HdrIndex
+        idx = HdrIndex(directory, None if cache is True else cache, recursive=False)
+        idx.update(workers)
+        wd, x, y = (idx.numeric(k) for k in FOCUS_KEYS)
+    else:
+        paths = tescan_hdr.find_hdrs(directory)
+        records = tescan_hdr.read_hdrs(paths, FOCUS_KEYS, workers)
+        wd, x, y = tescan_hdr.hdr_columns(records, FOCUS_KEYS)
+    ok = np.isfinite(wd) & np.isfinite(x) & np.isfinite(y)
+    return x[ok], y[ok], wd[ok]
+
+
+def wd_cut(wd, wd_min, wd_max):
+    """Mask of the points inside the WD window (exclusive, as in Matlab)."""
+    wd = np.asarray(wd)
+    return (wd > wd_min) & (wd < wd_max)
+
+
+def hampel(values, k=3, nsigma=3.0):
+    """Hampel outlier detection, same as Matlab hampel(x).
+
+    Each sample is compared to the median of the window of 2k + 1 samples
+    around it (truncated at the ends). It is an outlier if it differs by more
+    than nsigma scaled median absolute deviations. Returns boolean mask of
+    the outliers.
+    """
+    x = np.asarray(values, dtype=float)
+    n = len(x)
+    if n == 0:
+        return np.zeros(0, dtype=bool)
+    padded = np.concatenate([np.full(k, np.nan), x, np.full(k, np.nan)])
+    idx = np.arange(n)[:, None] + np.arange(2 * k + 1)[None, :]
+    win = padded[idx]                               # n x (2k + 1)
+    med = np.nanmedian(win, axis=1)
+    mad = 1.4826 * np.nanmedian(np.abs(win - med[:, None]), axis=1)
+    return np.abs(x - med) > nsigma * mad
+
+
+################################################################################
+# Surfaces
+
+SHAPES = {'poly11': 1, 'poly22': 2, 'poly33': 3, 'poly44': 4, 'poly55': 5}
+
+
+def poly_terms(order):
+    """Exponents (i, j) of the terms x^i y^j with i + j <= order."""
+    return [(i, d - i) for d in range(order + 1) for i in range(d, -1, -1)]
+
+
+class PolySurface:
+    """Polynomial surface z = sum p_ij x^i y^j (i + j <= order).
+
+    Coordinates are normalized internally (center, scale) for conditioning,
+    coef refers to the normalized coordinates.
+    """
+
+    def __init__(self, order, coef, center, scale):
+        self.order = order
+        self.terms = poly_terms(order)
+        self.coef = np.asarray(coef, dtype=float)
+        self.center = center
+        self.scale = scale
+
+    def design(self, x, y):
+        """Design matrix (n x number of terms) of the points."""
+        u = (np.asarray(x, dtype=float).ravel() - self.center[0]) / self.scale
+        v = (np.asarray(y, dtype=float).ravel() - self.center[1]) / self.scale
+        pu = [np.ones_like(u)]
+        pv = [np.ones_like(v)]
+        for p in range(self.order):
+            pu.append(pu[-1] * u)
+            pv.append(pv[-1] * v)
+        return np.column_stack([pu[i] * pv[j] for i, j in self.terms])
+
+    def __call__(self, x, y):
+        """Evaluate the surface at points x, y (arrays of the same shape)."""
+        x = np.asarray(x, dtype=float)
+        return self.design(x, y).dot(self.coef).reshape(x.shape)
+
+    def gradient(self, x, y):
+        """Partial derivatives dz/dx, dz/dy at points x, y."""
+        x = np.asarray(x, dtype=float)
+        u = (x.ravel() - self.center[0]) / self.scale
+        v = (np.asarray(y, dtype=float).ravel() - self.center[1]) / self.scale
+        gx = np.zeros_like(u)
+        gy = np.zeros_like(u)
+        for c, (i, j) in zip(self.coef, self.terms):
+            if i > 0:
+                gx += c * i * u ** (i - 1) * v ** j
+            if j > 0:
+                gy += c * j * u ** i * v ** (j - 1)
+        return (gx / self.scale).reshape(x.shape), (gy / self.scale).reshape(x.shape)
+
+    def hessian(self, x, y):
+        """Second derivatives d2z/dx2, d2z/dxdy, d2z/dy2 at points x, y."""
+        x = np.asarray(x, dtype=float)
+        u = (x.ravel() - self.center[0]) / self.scale
+        v = (np.asarray(y, dtype=float).ravel() - self.center[1]) / self.scale
+        hxx = np.zeros_like(u)
+        hxy = np.zeros_like(u)
+        hyy = np.zeros_like(u)
+        for c, (i, j) in zip(self.coef, self.terms):
+            if i > 1:
+                hxx += c * i * (i - 1) * u ** (i - 2) * v ** j
+            if i > 0 and j > 0:
+                hxy += c * i * j * u ** (i - 1) * v ** (j - 1)
+            if j > 1:
+                hyy += c * j * (j - 1) * u ** i * v ** (j - 2)
+        s2 = self.scale ** 2
+        return (hxx / s2).reshape(x.shape), (hxy / s2).reshape(x.shape), (hyy / s2).reshape(x.shape)
+
+
+def _bspline_basis(t, n):
+    """Uniform cubic B-spline basis on [0, 1] with n intervals.
+
+    Returns (len(t) x n + 3) matrix, 4 non-zeros per row.
+    """
+    t = np.clip(np.asarray(t, dtype=float), 0.0, 1.0) * n
+    k = np.minimum(np.floor(t).astype(int), n - 1)
+    f = t - k
+    b = np.zeros((len(t), n + 3))
+    rows = np.arange(len(t))
+    b[rows, k] = (1 - f) ** 3 / 6.0
+    b[rows, k + 1] = (3 * f ** 3 - 6 * f ** 2 + 4) / 6.0
+    b[rows, k + 2] = (-3 * f ** 3 + 3 * f ** 2 + 3 * f + 1) / 6.0
+    b[rows, k + 3] = f ** 3 / 6.0
+    return b
+
+
+class SplineSurface:
+    """Tensor product cubic B-spline surface over a bounding box."""
+
+    def __init__(self, coef, nx, ny, box):
+        self.coef = np.asarray(coef, dtype=float)
+        self.nx = nx
+        self.ny = ny
+        self.box = box                          # xmin, xmax, ymin, ymax
+
+    def design(self, x, y):
+        """Design matrix (n x (nx + 3)(ny + 3)) of the points."""
+        x0, x1, y0, y1 = self.box
+        bx = _bspline_basis((np.asarray(x, dtype=float).ravel() - x0) / (x1 - x0), self.nx)
+        by = _bspline_basis((np.asarray(y, dtype=float).ravel() - y0) / (y1 - y0), self.ny)
+        return (bx[:, :, None] * by[:, None, :]).reshape(len(bx), -1)
+
+    def __call__(self, x, y):
+        """Evaluate the surface at points x, y (arrays of the same shape)."""
+        x = np.asarray(x, dtype=float)
+        out = np.empty(x.size)
+        xf = x.ravel()
+        yf = np.asarray(y, dtype=float).ravel()
+        for s in range(0, x.size, 65536):               # bounded memory
+            out[s:s + 65536] = self.design(xf[s:s + 65536], yf[s:s + 65536]).dot(self.coef)
+        return out.reshape(x.shape)
+
+    def gradient(self, x, y, h=None):
+        """Partial derivatives dz/dx, dz/dy (central differences)."""
+        if h is None:
+            h = 1e-3 * max(self.box[1] - self.box[0], self.box[3] - self.box[2])
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        gx = (self(x + h, y) - self(x - h, y)) / (2 * h)
+        gy = (self(x, y + h) - self(x, y - h)) / (2 * h)
+        return gx, gy
+
+    def hessian(self, x, y, h=None):
+        """Second derivatives d2z/dx2, d2z/dxdy, d2z/dy2 (central differences)."""
+        if h is None:
+            h = 1e-2 * max(self.box[1] - self.box[0], self.box[3] - self.box[2]) / max(self.nx, self.ny)
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        z = self(x, y)
+        hxx = (self(x + h, y) - 2 * z + self(x - h, y)) / (h * h)
+        hyy = (self(x, y + h) - 2 * z + self(x, y - h)) / (h * h)
+        hxy = (self(x + h, y + h) - self(x + h, y - h) - self(x - h, y + h) + self(x - h, y - h)) / (4 * h * h)
+        return hxx, hxy, hyy
+
+
+def _solve(a, z, w=None, penalty=None):
+    """Weighted (penalized) least squares."""
+    if w is not None:
+        sw = np.sqrt(w)
+        a = a * sw[:, None]
+        z = z * sw
+    if penalty is None:
+        return np.linalg.lstsq(a, z, rcond=None)[0]
+    return np.linalg.solve(a.T.dot(a) + penalty, a.T.dot(z))
+
+
+def _bisquare(r):
+    """Bisquare robust weights of residuals r (as Matlab fit 'Bisquare')."""
+    s = 1.4826 * np.median(np.abs(r - np.median(r)))
+    if s <= 0:
+        return np.ones_like(r)
+    u = r / (4.685 * s)
+    return np.where(np.abs(u) < 1, (1 - u ** 2) ** 2, 0.0)
+
+
+def fit_surface(x, y, z, shape='poly22', robust=False, iterations=20, knots=8, smoothing=1e-3):
+    """Fit surface z(x, y).
+
+    shape       'poly11', 'poly22', ... (polynomial order), or 'spline'
+    robust      bisquare iteratively reweighted least squares
+    knots       number of spline intervals along the longer side
+    smoothing   spline roughness penalty (relative)
+
+    Returns callable surface object (PolySurface or SplineSurface), which is
+    evaluated in batch - sf(x_array, y_array).
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    z = np.asarray(z, dtype=float)
+    if shape == 'spline':
+        box = [x.min(), x.max(), y.min(), y.max()]
+        w = max(box[1] - box[0], 1e-12)
+        h = max(box[3] - box[2], 1e-12)
+        box[1] = box[0] + w
+        box[3] = box[2] + h
+        nx = max(1, int(round(knots * w / max(w, h))))
+        ny = max(1, int(round(knots * h / max(w, h))))
+        sf = SplineSurface(None, nx, ny, box)
+        a = sf.design(x, y)
+        penalty = smoothing * _roughness(nx + 3, ny + 3) * np.trace(a.T.dot(a)) / a.shape[1]
+    else:
+        order = SHAPES[shape]
+        center = (x.mean(), y.mean())
+        scale = max(np.abs(x - center[0]).max(), np.abs(y - center[1]).max(), 1e-12)
+        sf = PolySurface(order, None, center, scale)
+        a = sf.design(x, y)
+        penalty = None
+
+    coef = _solve(a, z, None, penalty)
+    if robust:
+        for it in range(iterations):
+            w = _bisquare(z - a.dot(coef))
+            new = _solve(a, z, w, penalty)
+            if np.allclose(new, coef, rtol=1e-9, atol=1e-15):
+                coef = new
+                break
+            coef = new
+    sf.coef = coef
+    return sf
+
+
+def _roughness(mx, my):
+    """Second difference penalty matrix of mx x my spline coefficients."""
+    def d2(m):
+        if m < 3:
+            return np.zeros((0, m))
+        return np.diff(np.eye(m), 2, axis=0)
+    dx = np.kron(d2(mx), np.eye(my))
+    dy = np.kron(np.eye(mx), d2(my))
+    return dx.T.dot(dx) + dy.T.dot(dy)
+
+
+################################################################################
+# Incremental fit
+
+def t_quantile(z, dof):
+    """Student t quantile of the same tail probability as the normal
+    quantile z, at dof degrees of freedom (Cornish-Fisher expansion, within
+    2 % for dof >= 5 and z <= 3)."""
+    v = float(max(dof, 1))
+    z2 = z * z
+    return z * (1.0 + (z2 + 1) / (4 * v) + (5 * z2 * z2 + 16 * z2 + 3) / (96 * v * v)
+                + (3 * z2 ** 3 + 19 * z2 * z2 + 17 * z2 - 15) / (384 * v ** 3))
+
+
+class IncrementalSurfaceFit:
+    """Polynomial surface fit updated point by point.
+
+    Keeps the running normal equations (A'A, A'z, z'z) of the points, so
+    adding (or removing) a point costs O(p^2) for p terms, independent of the
+    number of points. Coefficients are solved lazily (p <= 21). Residual
+    statistics come from the same sums. A new point is rejected as outlier if
+    its residual against the current fit exceeds the prediction interval -
+    the t-quantile of nsigma (normal) at the residual degrees of freedom,
+    times the residual standard deviation (not below min_sigma) and the
+    leverage of the point. Outliers are only tested once the fit has
+    min_dof residual degrees of freedom. Each time the fit has grown by a
+    quarter all points are tested again (retest()) - accepted outliers are
+    dropped, rejected points that fit are added back.
+
+    box         (xmin, xmax, ymin, ymax) of the region, fixes the coordinate
+                normalization and the support grid
+    min_sigma   floor of the residual standard deviation (WD units, 0.001 =
+                1 micron in mm)
+    min_dof     residual degrees of freedom before outliers are rejected
+    cell        support grid cell size, predictions are trusted only where a
+                cell within 'radius' cells holds an accepted point
+    """
+
+    def __init__(self, box, order=2, nsigma=3.0, min_sigma=0.001, wd_min=None, wd_max=None,
+                 cell=None, radius=1, min_dof=10):
+        self.order = order
+        self.terms = poly_terms(order)
+        p = len(self.terms)
+        center = (0.5 * (box[0] + box[1]), 0.5 * (box[2] + box[3]))
+        scale = max(0.5 * (box[1] - box[0]), 0.5 * (box[3] - box[2]), 1e-12)
+        self.surface = PolySurface(order, np.zeros(p), center, scale)
+        self.box = box
+        self.ata = np.zeros((p, p))
+        self.atz = np.zeros(p)
+        self.ztz = 0.0
+        self.z0 = None                  # offset of z, keeps the sums well conditioned
+        self.n = 0
+        self.nsigma = nsigma
+        self.min_sigma = min_sigma
+        self.wd_min = wd_min
+        self.wd_max = wd_max
+        self.min_dof = min_dof
+        self.rejected = []
+        self.accepted = []              # (x, y, z) of the points in the fit
+        self.suspects = []              # outliers tested again as the fit grows
+        self.n_retest = 0
+        self.retests = 0
+        self.dirty = True
+        self.cov = None                 # (A'A)^-1
+        self.cell = cell if cell is not None else max(box[1] - box[0], box[3] - box[2]) / 16.0
+        self.radius = radius
+        self.support = {}               # grid cell -> number of points
+
+    def _row(self, x, y):
+        return self.surface.design(np.array([x]), np.array([y]))[0]
+
+    def _cellof(self, x, y):
+        return (int(np.floor((x - self.box[0]) / self.cell)), int(np.floor((y - self.box[2]) / self.cell)))
+
+    def _update(self, x, y, z, sign):
+        a = self._row(x, y)
+        dz = z - self.z0
+        self.ata += sign * np.outer(a, a)
+        self.atz += sign * a * dz
+        self.ztz += sign * dz * dz
+        self.n += sign
+        c = self._cellof(x, y)
+        self.support[c] = self.support.get(c, 0) + sign
+        self.dirty = True
+
+    def _solve(self):
+        if not self.dirty:
+            return
+        p = len(self.terms)
+        if self.n >= p:
+            try:
+                self.cov = np.linalg.inv(self.ata)
+            except np.linalg.LinAlgError:
+                self.cov = np.linalg.pinv(self.ata)
+            coef = self.cov.dot(self.atz)
+        else:
+            self.cov = None
+            coef = np.linalg.lstsq(self.ata, self.atz, rcond=None)[0]
+        coef[0] += self.z0 if self.z0 is not None else 0.0      # constant term
+        self.surface.coef = coef
+        self.dirty = False
+
+    def determined(self):
+        """True if there are more points than terms (residuals exist)."""
+        return self.n > len(self.terms)
+
+    def sigma(self):
+        """Residual standard deviation of the current fit."""
+        self._solve()
+        if not self.determined():
+            return np.inf
+        c = self.surface.coef.copy()
+        c[0] -= self.z0
+        rss = self.ztz - 2 * c.dot(self.atz) + c.dot(self.ata).dot(c)
+        return np.sqrt(max(rss, 0.0) / (self.n - len(self.terms)))
+
+    def reliable(self):
+        """True if there are enough residual degrees of freedom to test outliers."""
+        return self.n - len(self.terms) >= max(self.min_dof, 1)
+
+    def _outlier(self, x, y, z):
+        self._solve()
+        dof = self.n - len(self.terms)
+        a = self._row(x, y)
+        lev = a.dot(self.cov).dot(a) if self.cov is not None else 0.0
+        s = max(self.sigma(), self.min_sigma) * np.sqrt(1.0 + max(lev, 0.0))
+        return abs(z - float(self(x, y))) > t_quantile(self.nsigma, dof) * s
+
+    def add(self, x, y, z):
+        """Add focus point, returns False if it was rejected."""
+        if (self.wd_min is not None and z <= self.wd_min) or (self.wd_max is not None and z >= self.wd_max):
+            self.rejected.append((x, y, z))
+            return False
+        if self.z0 is None:
+            self.z0 = z
+        if self.reliable() and self._outlier(x, y, z):
+            self.rejected.append((x, y, z))
+            self.suspects.append((x, y, z))
+            return False
+        self._update(x, y, z, 1)
+        self.accepted.append((x, y, z))
+        if self.reliable() and self.n >= 1.25 * self.n_retest:
+            self.retest()
+        return True
+
+    def retest(self):
+        """Test all the points again against the current fit - accepted
+        points with a studentized residual above the limit are dropped (worst
+        first, they may have been accepted before the fit was reliable), then
+        the rejected outliers that fit are added back."""
+        self.n_retest = self.n
+        self.retests += 1
+        p = len(self.terms)
+        for k in range(len(self.accepted)):
+            if self.n - 1 - p < max(self.min_dof, 1):
+                break
+            self._solve()
+            pts = np.array(self.accepted)
+            a = self.surface.design(pts[:, 0], pts[:, 1])
+            h = np.einsum('ij,jk,ik->i', a, self.cov, a)
+            s = max(self.sigma(), self.min_sigma)
+            r = np.abs(pts[:, 2] - self.surface(pts[:, 0], pts[:, 1])) / (s * np.sqrt(np.maximum(1.0 - h, 1e-12)))
+            i = int(np.argmax(r))
+            if r[i] <= t_quantile(self.nsigma, self.n - p):
+                break
+            q = self.accepted.pop(i)
+            self._update(q[0], q[1], q[2], -1)
+            self.rejected.append(q)
+            self.suspects.append(q)
+        while self.suspects:
+            ok = [not self._outlier(*q) for q in self.suspects]
+            if not any(ok):
+                break
+            for q, good in zip(self.suspects, ok):
+                if good:
+                    self._update(q[0], q[1], q[2], 1)
+                    self.accepted.append(q)
+                    self.rejected.remove(q)
+            self.suspects = [q for q, good in zip(self.suspects, ok) if not good]
+
+    def remove(self, x, y, z):
+        """Remove previously added point - an accepted one from the fit (rank-one
+        downdate), a rejected one from the rejected list. Returns True if the
+        fit changed, raises ValueError if the point was never added."""
+        q = (x, y, z)
+        if q in self.accepted:
+            self.accepted.remove(q)
+            self._update(x, y, z, -1)
+            return True
+        if q not in self.rejected:
+            raise ValueError('point %r was not added to the fit' % (q,))
+        self.rejected.remove(q)
+        if q in self.suspects:
+            self.suspects.remove(q)
+        return False
+
+    def __call__(self, x, y):
+        """Predicted WD at points x, y."""
+        self._solve()
+        return self.surface(x, y)
+
+    def predict(self, x, y):
+        """Predicted WD and its standard error at points x, y."""
+        self._solve()
+        x = np.asarray(x, dtype=float)
+        z = self.surface(x, y)
+        if self.cov is None or not self.determined():
+            return z, np.full(x.shape, np.inf)
+        a = self.surface.design(x, y)
+        var = np.einsum('ij,jk,ik->i', a, self.cov, a) * self.sigma() ** 2
+        return z, np.sqrt(np.maximum(var, 0.0)).reshape(x.shape)
+
+    def supported(self, x, y):
+        """Mask of points with an accepted focus point nearby."""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        cx = np.floor((x - self.box[0]) / self.cell).astype(int)
+        cy = np.floor((y - self.box[2]) / self.cell).astype(int)
+        out = np.zeros(x.shape, dtype=bool)
+        for (i, j), cnt in self.support.items():
+            if cnt > 0:
+                out |= (np.abs(cx - i) <= self.radius) & (np.abs(cy - j) <= self.radius)
+        return out
+
+    def constrained(self, x, y, tol):
+        """Mask of points where the prediction can be used - supported by
+        nearby focus points and with standard error below tol."""
+        z, err = self.predict(x, y)
+        return self.supported(x, y) & (err < tol)
+
+
+################################################################################
+# Tile grid
+
+def tile_grid(x, y, fov=250, overlap_fraction=0.05):
+    """Serpentine grid of tile centres over the bounding box of x, y.
+
+    fov is the view field in microns, x and y in meters. Every other row is
+    traversed backwards to minimize stage movement. Returns (pts, coordn) -
+    pts is (n x 2) array of stage positions, coordn is (n x 2) array of the
+    1-based (column, row) indices, as in TescanImageSnapper.m.
+    """
+    step = 1e-6 * fov * (1 - overlap_fraction)
+    # same as Matlab min(X):step:max(X) (tolerant to rounding at the end)
+    xv = np.min(x) + step * np.arange(int(np.floor((np.max(x) - np.min(x)) / step + 1e-9)) + 1)
+    yv = np.min(y) + step * np.arange(int(np.floor((np.max(y) - np.min(y)) / step + 1e-9)) + 1)
+    nx = len(xv)
+    ny = len(yv)
+    ii = np.tile(np.arange(nx), ny).reshape(ny, nx)
+    ii[1::2] = ii[1::2, ::-1]                       # flip every other row
+    jj = np.repeat(np.arange(ny), nx).reshape(ny, nx)
+    ii = ii.ravel()
+    jj = jj.ravel()
+    pts = np.column_stack([xv[ii], yv[jj]])
+    coordn = np.column_stack([ii + 1, jj + 1])
+    return pts, coordn
+
+
+def focus_map(directory, fov=250, overlap_fraction=0.05, wd_min=None, wd_max=None,
+              outliers=True, shape='poly22', robust=False, workers=None, cache=False):
+    """Whole focus map pipeline of TescanImageSnapper.m.
+
+    cache   read the .hdr files through the cached index (hdr_index.py)
+
+    Returns (ptsxyz, coordn, sf) - ptsxyz is (n x 3) array of tile x, y and
+    fitted WD (meters), coordn the grid indices, sf the fitted surface.
+    """
+    x, y, wd = read_focus_points(directory, workers, cache)
+    nfiles = len(wd)
+    keep = np.ones(nfiles, dtype=bool)
+    if wd_min is not None and wd_max is not None:
+        keep &= wd_cut(wd, wd_min, wd_max)
+    if outliers:
+        sub = np.flatnonzero(keep)
+        keep[sub[hampel(wd[sub])]] = False
+    print('%d files, %d outliers' % (nfiles, nfiles - keep.sum()))
+    x, y, wd = x[keep], y[keep], wd[keep]
+    sf = fit_surface(x, y, wd, shape, robust)
+    pts, coordn = tile_grid(x, y, fov, overlap_fraction)
+    ptsxyz = np.column_stack([pts, sf(pts[:, 0], pts[:, 1])])
+    print('%d images' % len(coordn))
+    return ptsxyz, coordn, sf
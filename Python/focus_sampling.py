@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+################################################################################
+#Adaptive focus point sampling.
+
+#Instead of autofocusing on a dense fixed rectangle, AdaptiveFocusSampler
+#measures the focus (Sem.AutoWD + Sem.GetWD after Sem.StgMoveTo) where the
+#current surface model is least certain. The model is IncrementalSurfaceFit
+#from focus_map.py. The error estimate of a candidate location is the
+#prediction standard error of the fit plus the misfit (residual) of the
+#nearest measured point, if it is not too close. Sampling stops once the
+#estimated WD error over the whole target region is below the tolerance
+#(e.g. half the depth of focus). Failed autofocus results are rejected by
+#the fit as outliers and their location is not tried again.
+
+#Units are SharkSEM units - mm for the stage and WD.
+
+#Example:
+#    s = AdaptiveFocusSampler(m, box=(-10, 10, -8, 8), tol=0.005)
+#    fit = s.run(max_points=60)
+#    wd = fit(x_tiles, y_tiles)
+################################################################################
+
+from __future__ import print_function
+
+import numpy as np
+
+from focus_map import IncrementalSurfaceFit, poly_terms
+from tile_acquisition import WAIT_STAGE, WAIT_OPTICS, WAIT_AUTO
+
+
+def autowd_measure(m, x, y, wd_guess=None, channel=0):
+    """Move the stage to x, y and run AutoWD, returns the found WD [mm].
+
+    wd_guess    starting WD for the autofocus (e.g. the predicted one)
+    """
+    old_flags = m.connection.wait_flags
+    try:
+        m.SetWaitFlags(0)
+        m.StgMoveTo(x, y)
+        if wd_guess is not None:
+            m.SetWD(wd_guess)
+        m.SetWaitFlags(WAIT_STAGE | WAIT_OPTICS)
+        m.AutoWD(channel)
+        m.SetWaitFlags(WAIT_AUTO)                   # wait for the procedure
+        return m.GetWD()
+    finally:
+        m.SetWaitFlags(old_flags)
+
+
+class AdaptiveFocusSampler:
+    """Focus map acquisition driven by the surface fit uncertainty.
+
+    m           connected sem.Sem (may be None if 'measure' is given)
+    box         (xmin, xmax, ymin, ymax) of the target region [mm]
+    candidates  (n x 2) array of allowed focus locations, default is a
+                'grid' x 'grid' raster of the box
+    tol         required WD error over the region [mm], e.g. half the DOF
+    order       polynomial order of the surface
+    measure     measure(x, y, wd_guess) -> WD, default autowd_measure()
+    min_spacing minimum distance of two focus points [mm]
+    """
+
+    def __init__(self, m, box, candidates=None, tol=0.005, order=2, grid=24, channel=0,
+                 measure=None, min_spacing=None, nsigma=3.0, min_sigma=0.001,
+                 wd_min=None, wd_max=None):
+        self.m = m
+        self.box = box
+        if candidates is None:
+            gx, gy = np.meshgrid(np.linspace(box[0], box[1], grid), np.linspace(box[2], box[3], grid))
+            candidates = np.column_stack([gx.ravel(), gy.ravel()])
+        self.candidates = np.asarray(candidates, dtype=float)
+        self.tol = tol
+        self.channel = channel
+        self.measure = measure
+        if min_spacing is None:
+            min_spacing = 0.5 * max(box[1] - box[0], box[3] - box[2]) / grid
+        self.min_spacing = min_spacing
+        self.fit = IncrementalSurfaceFit(box, order, nsigma, min_sigma, wd_min, wd_max,
+                                         cell=4 * min_spacing, radius=2)
+        self.points = []                # (x, y, wd, accepted)
+        self.retests = 0
+        self.used = np.zeros(len(self.candidates), dtype=bool)
+
+    def _measure(self, x, y, wd_guess):
+        if self.measure is not None:
+            return self.measure(x, y, wd_guess)
+        return autowd_measure(self.m, x, y, wd_guess, self.channel)
+
+    def _seeds(self):
+        """Initial points - spread over the candidates, enough for the fit."""
+        n = len(poly_terms(self.fit.order)) + 3
+        c = self.candidates
+        chosen = [int(np.argmin(np.hypot(c[:, 0] - c[:, 0].mean(), c[:, 1] - c[:, 1].mean())))]
+        d = np.hypot(c[:, 0] - c[chosen[0], 0], c[:, 1] - c[chosen[0], 1])
+        while len(chosen) < min(n, len(c)):            # farthest point sampling
+            i = int(np.argmax(d))
+            chosen.append(i)
+            d = np.minimum(d, np.hypot(c[:, 0] - c[i, 0], c[:, 1] - c[i, 1]))
+        return chosen
+
+    def error_estimate(self, x=None, y=None):
+        """Estimated WD error at points (default the candidates)."""
+        if x is None:
+            x, y = self.candidates[:, 0], self.candidates[:, 1]
+        z, err = self.fit.predict(x, y)
+        acc = [(px, py, pz) for px, py, pz, ok in self.points if ok]
+        if not acc or not np.all(np.isfinite(err)):
+            return err
+        p = np.array(acc)
+        res = np.abs(p[:, 2] - self.fit(p[:, 0], p[:, 1]))
+        d = np.hypot(x[:, None] - p[None, :, 0], y[:, None] - p[None, :, 1])
+        k = np.argmin(d, axis=1)
+        far = d[np.arange(len(x)), k] > self.min_spacing
+        return err + np.where(far, res[k], 0.0)
+
+    def next_point(self):
+        """Index of the next candidate to measure, None when done."""
+        if not self.fit.determined():
+            for i in self._seeds():
+                if not self.used[i]:
+                    return i
+        err = self.error_estimate()
+        if np.all(err < self.tol):
+            return None
+        c = self.candidates
+        blocked = self.used.copy()
+        for px, py, pz, ok in self.points:              # keep the spacing
+            blocked |= np.hypot(c[:, 0] - px, c[:, 1] - py) < self.min_spacing
+        err = np.where(blocked, -np.inf, err)
+        i = int(np.argmax(err))
+        if err[i] == -np.inf:
+            return None                                 # nothing left to try
+        return i
+
+    def step(self):
+        """Measure one more point, returns False when sampling is finished."""
+        i = self.next_point()
+        if i is None:
+            return False
+        x, y = self.candidates[i]
+        guess = float(self.fit(x, y)) if self.fit.n > 0 else None
+        wd = self._measure(x, y, guess)
+        ok = wd is not None and self.fit.add(x, y, wd)
+        self.used[i] = True
+        self.points.append((x, y, wd, ok))
+        if self.fit.retests != self.retests:            # points dropped or added back
+            self.retests = self.fit.retests
+            acc = set(self.fit.accepted)
+            self.points = [(px, py, pz, (px, py, pz) in acc) for px, py, pz, pok in self.points]
+        return True
+
+    def run(self, max_points=100, verbose=False):
+        """Sample until the error is below tol (or max_points), returns the fit."""
+        while len(self.points) < max_points and self.step():
+            if verbose:
+                x, y, wd, ok = self.points[-1]
+                print('%3d  x=%.4f y=%.4f WD=%s %s  max err=%.5f' % (
+                    len(self.points), x, y, wd, '' if ok else 'rejected', np.max(self.error_estimate())))
+        return self.fit
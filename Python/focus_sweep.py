@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+################################################################################
+#Software focus - WD sweep on small fast scans.
+
+#Alternative to Sem.AutoWD (slow, fails in about 10 % of the points). The
+#working distance is stepped through a short sweep around the guess, at
+#each step a small window in the middle of the field is scanned
+#(Sem.ScScanXY with a sub-window) and read (Sem.FetchImages). The frames
+#are binned (the pixel noise would hide the blur of the finest details)
+#and the sharpness of all of them is computed at once (normalized gradient
+#energy or variance of the Laplacian). The peak is fitted by a parabola to
+#the log of the sharpness. A second, finer sweep around the peak (all its
+#steps in the fit) is optional.
+
+#The scans keep the pixel size of the tiles (width of the full frame), so
+#the sweep sees the defocus as the tiles do - only the window is smaller.
+#The requests of the next step (SetWD, ScScanXY) are queued behind the
+#current scan while its frame is read.
+
+#Each result has a confidence 0..1 - the peak contrast of the sweep
+#(1 - min/max of the sharpness) times the goodness of the parabola fit, 0
+#if the peak is at the end of the sweep (the sweep is then moved and
+#repeated). Points below min_confidence are reported as failed (None), so
+#FocusSweep can be used directly as the 'measure' of AdaptiveFocusSampler.
+
+#Units are SharkSEM units - mm for the stage and WD.
+
+#Example:
+#    fs = FocusSweep(m, span=0.4, steps=9)
+#    wd, conf = fs.focus(wd_guess=15.0)
+#    s = AdaptiveFocusSampler(m, box, measure=fs)
+################################################################################
+
+from __future__ import print_function
+
+import numpy as np
+
+from tile_acquisition import WAIT_SCAN, WAIT_STAGE, WAIT_OPTICS
+
+
+def sharpness(frames, metric='gradient', binning=1):
+    """Sharpness of each frame of a (n x h x w) stack (or one image).
+
+    metric  'gradient' - mean squared gradient / mean^2, 'laplacian' -
+            variance of the 4-neighbour Laplacian / mean^2
+    binning frames are averaged in binning x binning blocks first
+    """
+    f = np.asarray(frames, dtype=np.float32)
+    single = f.ndim == 2
+    if single:
+        f = f[None]
+    if binning > 1:
+        h = f.shape[1] // binning
+        w = f.shape[2] // binning
+        f = f[:, 0:h * binning, 0:w * binning].reshape(len(f), h, binning, w, binning).mean(axis=(2, 4))
+    m = np.maximum(f.mean(axis=(1, 2)), 1e-6)
+    if metric == 'laplacian':
+        lap = (f[:, 1:-1, 0:-2] + f[:, 1:-1, 2:] + f[:, 0:-2, 1:-1] + f[:, 2:, 1:-1]
+               - 4.0 * f[:, 1:-1, 1:-1])
+        s = lap.var(axis=(1, 2)) / (m * m)
+    else:
+        gx = np.diff(f, axis=2)
+        gy = np.diff(f, axis=1)
+        s = ((gx * gx).mean(axis=(1, 2)) + (gy * gy).mean(axis=(1, 2))) / (m * m)
+    return float(s[0]) if single else s
+
+
+def fit_peak(wds, scores, points=5):
+    """Peak of a focus sweep.
+
+    A parabola is fitted to log(sharpness) of the 'points' steps around the
+    maximum. Returns (wd, confidence, edge) - edge is -1 / 1 if the maximum
+    is the first / last step (peak outside the sweep), else 0.
+    """
+    wds = np.asarray(wds, dtype=float)
+    s = np.asarray(scores, dtype=float)
+    k = int(np.argmax(s))
+    if s[k] <= 0:
+        return float(wds[k]), 0.0, 0
+    if k == 0 or k == len(s) - 1:
+        return float(wds[k]), 0.0, -1 if k == 0 else 1
+    contrast = 1.0 - s.min() / s[k]
+    h = max(points // 2, 1)
+    i = np.arange(max(k - h, 0), min(k + h + 1, len(s)))
+    x = wds[i] - wds[k]
+    y = np.log(np.maximum(s[i], 1e-12))
+    c = np.polyfit(x, y, 2)
+    if c[0] >= 0:
+        return float(wds[k]), 0.0, 0
+    peak = -c[1] / (2 * c[0])
+    if len(i) > 3:
+        res = y - np.polyval(c, x)
+        r2 = max(1.0 - res.var() / max(y.var(), 1e-12), 0.0)
+    else:
+        r2 = 1.0                                        # exact fit
+    step = np.abs(np.diff(wds)).mean()
+    peak = float(np.clip(peak, x.min() - 0.5 * step, x.max() + 0.5 * step))
+    return float(wds[k] + peak), float(contrast * r2), 0
+
+
+class FocusSweep:
+    """Focus by a WD sweep.
+
+    m               connected sem.Sem
+    channel         input video channel, enabled by the caller (DtEnable)
+    width, height   full frame resolution - the pixel size of the scans
+    window          size of the scanned window in the middle [pixels]
+    span            WD range of the sweep [mm]
+    steps           number of frames of the sweep
+    refine          second sweep over 2 steps around the peak
+    metric          'gradient' or 'laplacian', see sharpness()
+    binning         binning of the frames for the sharpness
+    min_confidence  results below are failures (None from __call__)
+    retries         how many times a sweep with the peak at its end is moved
+    speed           scanning speed of the sweep (ScSetSpeed), None = keep
+    """
+
+    def __init__(self, m, channel=0, width=1536, height=1536, window=256, span=0.4, steps=9,
+                 refine=True, metric='gradient', binning=4, min_confidence=0.2, retries=2, speed=None):
+        self.m = m
+        self.channel = channel
+        self.width = width
+        self.height = height
+        self.window = window
+        self.span = span
+        self.steps = steps
+        self.refine = refine
+        self.metric = metric
+        self.binning = binning
+        self.min_confidence = min_confidence
+        self.retries = retries
+        self.speed = speed
+        self.frame = 0x40000000                 # own range of frame ids
+        self.history = []                       # (x, y, wd, confidence)
+
+    def _window(self):
+        w = min(self.window, self.width)
+        h = min(self.window, self.height)
+        left = (self.width - w) // 2
+        top = (self.height - h) // 2
+        return left, top, left + w - 1, top + h - 1
+
+    def _scan(self, wd):
+        """Queue SetWD + scan of the window behind the current scan."""
+        m = self.m
+        self.frame = self.frame % 0xffffffff + 1
+        m.SetWaitFlags(WAIT_SCAN)
+        m.SetWD(wd)
+        m.SetWaitFlags(WAIT_SCAN | WAIT_STAGE | WAIT_OPTICS)
+        left, top, right, bottom = self._window()
+        res = m.ScScanXY(self.frame, self.width, self.height, left, top, right, bottom, 1)
+        if res is None or res < 0:
+            raise RuntimeError('ScScanXY failed in the focus sweep')
+        return self.frame
+
+    def sweep(self, wds):
+        """Scan a frame at each WD, returns their sharpness."""
+        m = self.m
+        left, top, right, bottom = self._window()
+        w = right - left + 1
+        h = bottom - top + 1
+        frames = np.empty((len(wds), h, w), dtype=np.float32)
+        ids = [self._scan(wds[0])]
+        for i in range(len(wds)):
+            if i + 1 < len(wds):
+                ids.append(self._scan(wds[i + 1]))
+            frames[i] = m.FetchImages([self.channel], w, h, ids[i])[self.channel]
+        return sharpness(frames, self.metric, self.binning)
+
+    def focus(self, wd_guess=None):
+        """Focus at the current position, returns (WD, confidence).
+
+        The WD is left at the found value (at the guess if confidence is 0).
+        """
+        m = self.m
+        old_flags = m.connection.wait_flags
+        old_speed = None
+        if wd_guess is None:
+            wd_guess = m.GetWD()
+        try:
+            if self.speed is not None:
+                old_speed = m.ScGetSpeed()
+                m.ScSetSpeed(self.speed)
+            center = wd_guess
+            for k in range(self.retries + 1):
+                wds = center + np.linspace(-0.5, 0.5, self.steps) * self.span
+                wd, conf, edge = fit_peak(wds, self.sweep(wds))
+                if not edge:
+                    break
+                center += edge * 0.75 * self.span           # move the sweep, keep overlap
+            if self.refine and conf > 0:
+                step = self.span / (self.steps - 1)
+                wds = wd + np.linspace(-2.0, 2.0, self.steps) * step
+                wd2, conf2, edge = fit_peak(wds, self.sweep(wds), points=self.steps)
+                if not edge and conf2 > 0:
+                    wd = wd2
+            m.SetWaitFlags(WAIT_SCAN)
+            m.SetWD(wd if conf > 0 else wd_guess)
+            return wd, conf
+        finally:
+            if old_speed is not None:
+                m.ScSetSpeed(old_speed)
+            m.SetWaitFlags(old_flags)
+
+    def __call__(self, x, y, wd_guess=None):
+        """Move to x, y and focus, returns WD or None if not confident
+        (interface of AdaptiveFocusSampler 'measure')."""
+        m = self.m
+        old_flags = m.connection.wait_flags
+        try:
+            m.SetWaitFlags(0)
+            m.StgMoveTo(x, y)
+        finally:
+            m.SetWaitFlags(old_flags)
+        wd, conf = self.focus(wd_guess)
+        self.history.append((x, y, wd, conf))
+        return wd if conf >= self.min_confidence else None
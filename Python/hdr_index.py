@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+################################################################################
+#Columnar index of the .hdr files of an acquisition.
+
+#HdrIndex parses every key=value field of every .hdr file under a directory
+#(process pool, tescan_hdr.py) into one table - a column per key, float
+#where all the values are numbers (NaN if missing), text otherwise - plus
+#the path, size and mtime of each file. The table is cached next to the
+#data as a numpy structured array (.npy, no pickle). On the next run only
+#the files that are new or whose size or mtime changed are parsed again,
+#deleted files are dropped.
+
+#Queries are vectorized over the columns:
+#    idx = HdrIndex('D:/Data/HighRes')
+#    idx.update()
+#    m = idx.select(WD=(0.0149, 0.0151)) & idx.in_box(0.010, 0.012, 0.003, 0.004)
+#    paths = idx['path'][m]
+
+#Values are in the units of the .hdr files (SI - meters).
+################################################################################
+
+from __future__ import print_function
+import os
+import time
+
+import numpy as np
+
+from tescan_hdr import read_hdrs
+from tile_manifest import scan_tree
+
+_FILE_COLUMNS = ('path', 'size', 'mtime')
+
+
+def _typed(values):
+    """Column array from a list of strings ('' = missing) - float if all
+    the values are numbers, text otherwise."""
+    try:
+        return np.array([float(v) if v != '' else np.nan for v in values], dtype=float)
+    except ValueError:
+        return np.array(values, dtype=str)
+
+
+def _merge(a, b):
+    """Concatenate two columns, text wins over float."""
+    if a.dtype.kind == 'f' and b.dtype.kind == 'f':
+        return np.concatenate([a, b])
+
+    def text(c):
+        if c.dtype.kind == 'f':
+            return np.array(['' if np.isnan(v) else repr(float(v)) for v in c], dtype=str)
+        return c
+    return np.concatenate([text(a), text(b)])
+
+
+def _missing(column, n):
+    return np.full(n, np.nan) if column.dtype.kind == 'f' else np.full(n, '', dtype=str)
+
+
+class HdrIndex:
+    """Cached columnar table of .hdr files.
+
+    directory   root of the acquisition
+    cache       cache file, default <directory>/.hdr_index.npy, False = none
+    recursive   include subdirectories
+    """
+
+    def __init__(self, directory, cache=None, recursive=True):
+        self.directory = directory
+        if cache is None:
+            cache = os.path.join(directory, '.hdr_index.npy')
+        self.cache = cache
+        self.recursive = recursive
+        self.columns = {'path': np.zeros(0, dtype=str), 'size': np.zeros(0, dtype=np.int64),
+                        'mtime': np.zeros(0)}
+        if cache and os.path.exists(cache):
+            self._load()
+
+    def __len__(self):
+        return len(self.columns['path'])
+
+    def __getitem__(self, key):
+        return self.columns[key]
+
+    def keys(self):
+        """Names of the .hdr fields in the table."""
+        return [k for k in self.columns if k not in _FILE_COLUMNS]
+
+    def _list(self):
+        """Current .hdr files - dict path -> (size, mtime)."""
+        if self.recursive:
+            tree = scan_tree(self.directory)
+        else:
+            files = [(e.name, e.stat()) for e in os.scandir(self.directory) if e.is_file()]
+            tree = {self.directory: [(n, st.st_size, st.st_mtime) for n, st in files]}
+        out = {}
+        for d, files in tree.items():
+            for n, size, mtime in files:
+                if n.endswith('hdr'):
+                    out[os.path.join(d, n)] = (size, mtime)
+        return out
+
+    def update(self, workers=None, verbose=False):
+        """Bring the table up to date, returns number of files parsed."""
+        t0 = time.time()
+        files = self._list()
+        old = self.columns
+        keep = np.array([files.get(p) == (s, m) for p, s, m in
+                         zip(old['path'], old['size'].tolist(), old['mtime'].tolist())], dtype=bool)
+        known = set(old['path'][keep].tolist())
+        new = sorted(p for p in files if p not in known)
+        records = read_hdrs(new, None, workers) if new else []
+        ok = [r is not None for r in records]
+        new = [p for p, k in zip(new, ok) if k]
+        records = [r for r in records if r is not None]
+
+        cols = dict((k, v[keep]) for k, v in old.items())
+        add = {'path': np.array(new, dtype=str),
+               'size': np.array([files[p][0] for p in new], dtype=np.int64),
+               'mtime': np.array([files[p][1] for p in new], dtype=float)}
+        names = []
+        for r in records:
+            for k in r:
+                if k not in add and k not in names:
+                    names.append(k)
+        for k in names:
+            add[k] = _typed([r.get(k, '') for r in records])
+        n_old = len(cols['path'])
+        n_new = len(new)
+        for k in list(cols) + [k for k in add if k not in cols]:
+            a = cols[k] if k in cols else _missing(add[k], n_old)
+            b = add[k] if k in add else _missing(a, n_new)
+            cols[k] = _merge(a, b) if k not in ('size', 'mtime', 'path') else np.concatenate([a, b])
+        order = np.argsort(cols['path'], kind='stable')
+        self.columns = dict((k, v[order]) for k, v in cols.items())
+        if self.cache and (n_new or not keep.all()):
+            self._save()
+        if verbose:
+            print('%d .hdr files, %d parsed, %d removed (%.2f s)' % (
+                len(self), n_new, (~keep).sum(), time.time() - t0))
+        return n_new
+
+    def table(self):
+        """The index as one numpy structured array."""
+        fields = []
+        for k, v in self.columns.items():
+            fields.append((k, v.dtype if v.dtype.kind != 'U' else 'U%d' % max(v.dtype.itemsize // 4, 1)))
+        out = np.zeros(len(self), dtype=fields)
+        for k, v in self.columns.items():
+            out[k] = v
+        return out
+
+    def _save(self):
+        tmp = self.cache + '.tmp.npy'
+        np.save(tmp, self.table(), allow_pickle=False)
+        os.replace(tmp, self.cache)
+
+    def _load(self):
+        try:
+            t = np.load(self.cache, allow_pickle=False)
+        except (IOError, OSError, ValueError):
+            return                                      # rebuilt by update()
+        self.columns = dict((k, np.array(t[k])) for k in t.dtype.names)
+
+    # queries ---------------------------------------------------------------
+
+    def select(self, **ranges):
+        """Mask of the files with every given key inside [lo, hi], e.g.
+        select(WD=(0.0149, 0.0151)). None as a limit means open."""
+        m = np.ones(len(self), dtype=bool)
+        for k, (lo, hi) in ranges.items():
+            v = self.numeric(k)
+            if lo is not None:
+                m &= v >= lo
+            if hi is not None:
+                m &= v <= hi
+        return m
+
+    def in_box(self, xmin, xmax, ymin, ymax):
+        """Mask of the files with StageX, StageY inside the box [m]."""
+        return self.select(StageX=(xmin, xmax), StageY=(ymin, ymax))
+
+    def numeric(self, key):
+        """Column as floats, NaN where missing or not a number."""
+        v = self.columns.get(key)
+        if v is None:
+            return np.full(len(self), np.nan)
+        if v.dtype.kind == 'f':
+            return v
+        out = np.full(len(v), np.nan)
+        for i, s in enumerate(v):
+            try:
+                out[i] = float(s)
+            except ValueError:
+                pass
+        return out
+
+    def get(self, keys, mask=None):
+        """Tuple of columns (optionally masked)."""
+        if mask is None:
+            return tuple(self.columns[k] for k in keys)
+        return tuple(self.columns[k][mask] for k in keys)
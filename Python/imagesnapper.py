@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+################################################################################
+#Streaming reader and writer of ImageSnapper project XML files.
+
+#An ImageSnapper project is
+#    <ImageSnapperProject>
+#    <Settings AutoFocus="0" ... Path="..." ImageFormat="tif" .../>
+#    <Samples Count="n">
+#    <RectangleSample Name="..." Z="..." WD="..." .../> or <PointSample .../>
+#    ...
+#    </Samples>
+#    </ImageSnapperProject>
+
+#The reader parses incrementally and drops every sample once it is handed
+#out, memory does not grow with the project. All attribute values are kept
+#as the strings from the file - the Z stage value in particular must be
+#written back exactly, ImageSnapper moves the stage if it differs in the
+#last digit (see README).
+
+#The writer takes a generator of samples and writes them out as they come.
+#The number of samples does not have to be known in advance - if it is not
+#given, the samples are spooled to a temporary file next to the output and
+#copied after the <Samples Count="n"> tag once n is known.
+#write_image_snapper() produces the same file as writeImageSnapper.m.
+
+#Example:
+#    z, name, settings = focus_map_info('FocusMapImageSnapper.xml')
+#    write_image_snapper('ImageSnapper.xml', ptsxyz, z, 250, coordn, path, 'tif')
+################################################################################
+
+import io
+import os
+import shutil
+import tempfile
+from decimal import Decimal
+from xml.etree.ElementTree import iterparse
+from xml.sax.saxutils import escape
+
+SAMPLE_TAGS = ('RectangleSample', 'PointSample')
+
+# writeImageSnapper.m defaults
+DEFAULT_SETTINGS = (('AutoFocus', '0'), ('AutoGainBlack', '0'), ('Stitching', '0'),
+                    ('ShadingCorrection', '0'), ('AddInfobar', '0'), ('Path', ''),
+                    ('ImageFormat', 'tif'), ('SnapshotSize', '4'), ('PanoramaSize', '100'),
+                    ('PanoramaMaxW', '10000'))
+
+
+################################################################################
+# Reading
+
+def iter_project(path):
+    """Stream an ImageSnapper project, yields (tag, attributes) pairs.
+
+    Tags are 'Settings', 'Samples' and the sample tags, attributes are
+    dicts of strings in file order. Constant memory.
+    """
+    depth = 0
+    samples = None
+    for event, elem in iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            depth = depth + 1
+            if depth == 2 and elem.tag == 'Samples':
+                samples = elem
+                yield elem.tag, dict(elem.attrib)
+            elif depth == 2 or (depth == 3 and samples is not None):
+                yield elem.tag, dict(elem.attrib)
+        else:
+            depth = depth - 1
+            if depth == 2 and samples is not None:
+                samples.clear()             # drop the finished samples
+            elif depth == 1:
+                elem.clear()
+
+
+def read_settings(path):
+    """Attributes of <Settings>, reads only the head of the file."""
+    for tag, attrib in iter_project(path):
+        if tag == 'Settings':
+            return attrib
+        if tag in SAMPLE_TAGS:
+            break
+    return {}
+
+
+def iter_samples(path, tags=SAMPLE_TAGS):
+    """Stream the samples, yields (tag, attributes) of the given tags."""
+    for tag, attrib in iter_project(path):
+        if tag in tags:
+            yield tag, attrib
+
+
+def focus_map_info(path):
+    """Z stage value, name of the first sample and settings of a focus map
+    project (as TescanImageSnapper.m). All samples must share the same Z.
+
+    Z is the exact string from the file.
+    """
+    settings = {}
+    z = None
+    name = None
+    for tag, attrib in iter_project(path):
+        if tag == 'Settings':
+            settings = attrib
+        elif tag in SAMPLE_TAGS:
+            if z is None:
+                z = attrib.get('Z')
+                name = attrib.get('Name')
+            elif attrib.get('Z') != z:
+                raise ValueError('Different Z Stage values in XML: %s, %s' % (z, attrib.get('Z')))
+    if z is None:
+        raise ValueError('No samples in %s' % path)
+    return z, name, settings
+
+
+def parse_pos(value, exact=False):
+    """Split Pos="x,y" (mm), floats or Decimals if exact."""
+    conv = Decimal if exact else float
+    x, y = value.split(',')
+    return conv(x), conv(y)
+
+
+################################################################################
+# Writing
+
+_ESCAPE = {'"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#9;'}
+
+
+def _attrs(attrib):
+    out = []
+    for k, v in attrib:
+        v = str(v)
+        if not v.isalnum() and any(c in v for c in '&<>"\n\r\t'):
+            v = escape(v, _ESCAPE)
+        out.append(' %s="%s"' % (k, v))
+    return ''.join(out)
+
+
+def _write_samples(f, samples, chunk):
+    """Write the sample tags, returns their number."""
+    n = 0
+    lines = []
+    for tag, attrib in samples:
+        if hasattr(attrib, 'items'):
+            attrib = attrib.items()
+        lines.append(u'<%s%s/>\n' % (tag, _attrs(attrib)))
+        n = n + 1
+        if len(lines) >= chunk:
+            f.write(u''.join(lines))
+            lines = []
+    f.write(u''.join(lines))
+    return n
+
+
+def write_project(path, samples, settings=None, chunk=4096, count=None):
+    """Stream-write an ImageSnapper project.
+
+    samples     iterable of (tag, attributes), attributes is a dict or a
+                sequence of (name, value) pairs, values are written as
+                given (strings are kept exactly)
+    settings    Settings attributes, defaults of writeImageSnapper.m are
+                used for missing ones
+    count       number of samples if known (written in one pass, must
+                match), else the samples are spooled to a temporary file
+    Returns the number of samples written.
+    """
+    s = dict(DEFAULT_SETTINGS)
+    s.update(settings or {})
+    order = [k for k, v in DEFAULT_SETTINGS] + [k for k in s if k not in dict(DEFAULT_SETTINGS)]
+    spool = None
+    if count is None:
+        spool = tempfile.TemporaryFile('w+', encoding='utf-8', newline='\n',
+                                       dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        if spool is not None:
+            count = _write_samples(spool, samples, chunk)
+            spool.seek(0)
+        with io.open(path, 'w', encoding='utf-8', newline='\n') as f:
+            f.write(u'<?xml version="1.0" encoding="utf-8" standalone="yes"?>\n')
+            f.write(u'<ImageSnapperProject>\n')
+            f.write(u'<Settings%s/>\n' % _attrs((k, s[k]) for k in order))
+            f.write(u'<Samples Count="%d">\n' % count)
+            if spool is not None:
+                shutil.copyfileobj(spool, f, 1 << 20)
+            else:
+                n = _write_samples(f, samples, chunk)
+                if n != count:
+                    raise ValueError('%d samples written, count is %d' % (n, count))
+            f.write(u'</Samples>\n')
+            f.write(u'</ImageSnapperProject>\n')
+    finally:
+        if spool is not None:
+            spool.close()
+    return count
+
+
+def sample_names(coordn):
+    """Sample names '<column>_<row>' as writeImageSnapper.m (zero padded)."""
+    cols = [int(c[0]) for c in coordn]
+    rows = [int(c[1]) for c in coordn]
+    wx = _digits(max(cols))
+    wy = _digits(max(rows))
+    return ['%0*d_%0*d' % (wx, c, wy, r) for c, r in zip(cols, rows)]
+
+
+def _digits(n):
+    """ceil(log10(n)) of writeImageSnapper.m"""
+    d = 0
+    while 10 ** d < n:
+        d = d + 1
+    return d
+
+
+def point_samples(ptsxyz, names, z_stage, view_field, image_base_name='Snap'):
+    """Generate PointSample attributes as writeImageSnapper.m.
+
+    ptsxyz      iterable of (x, y, wd) in meters, or strings written as
+                they are (x, y then in mm, as Pos)
+    names       iterable of sample names
+    z_stage     Z stage value, string as read from the focus map XML
+    view_field  view field in microns
+    """
+    vf = '%.6f' % (view_field * 1e-6)
+    for (x, y, wd), name in zip(ptsxyz, names):
+        if not isinstance(wd, str):
+            wd = '%.9f' % wd
+        if isinstance(x, str):
+            pos = '%s,%s' % (x, y)
+        else:
+            pos = '%.4f,%.4f' % (x * 1e3, y * 1e3)
+        yield 'PointSample', (('Name', name), ('Z', z_stage), ('WD', wd), ('ViewField', vf),
+                              ('Overlapping', '0'), ('ImageBaseName', image_base_name), ('Pos', pos))
+
+
+def write_image_snapper(path, ptsxyz, z_stage, view_field, coordn, image_path, image_format):
+    """Python version of writeImageSnapper.m (units as there - ptsxyz in
+    meters, view_field in microns, z_stage string). Returns sample count."""
+    settings = {'Path': image_path, 'ImageFormat': image_format}
+    if hasattr(ptsxyz, 'tolist'):
+        ptsxyz = ptsxyz.tolist()
+    if hasattr(coordn, 'tolist'):
+        coordn = coordn.tolist()
+    return write_project(path, point_samples(ptsxyz, sample_names(coordn), z_stage, view_field), settings,
+                         count=min(len(ptsxyz), len(coordn)))
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+################################################################################
+#Checkpointed, resumable tile acquisition.
+
+#A run of thousands of tiles that dies halfway (client, network, SEM
+#software) used to be restarted from the ImageSnapper XML, the tiles done
+#re-imaged or pruned by hand. Journal keeps an append-only CSV of the
+#tiles written: name, planned target, effective position, the stage
+#position read back (Sem.StgGetPosition, while the tile is scanned), WD,
+#timestamps, and the files (image(s) + .hdr, relative to the journal)
+#with their size and CRC32.
+#A line is appended by the writer thread once the tile is on disk
+#(tile_done() hook of TileAcquisition and its subclasses). The file is
+#flushed and fsync'ed in batches (sync_every lines or sync_seconds), so a
+#crash loses at most the last batch - those tiles are imaged again.
+
+#On resume the journal is read once into a dict (the last line of a tile
+#wins, a torn last line is ignored) and each target is looked up by its
+#name - a tile is done if its files are on disk with the recorded sizes
+#(and CRC32 with verify=True), else it is corrupt and queued again. The
+#cost is one lookup and a few os.stat per tile, the remaining targets
+#keep their names (the name of an unnamed target is its index in the
+#full list, as tile_name()).
+
+#Units are SharkSEM units - mm for the stage and WD.
+
+#Example:
+#    acq = TileAcquisition(m, 'HighRes', width=1536, height=1536)
+#    with Journal('HighRes/journal.csv') as j:
+#        records = j.run(acq, targets)                  # again after a crash
+#    python journal.py HighRes/journal.csv --verify
+################################################################################
+
+from __future__ import print_function
+import argparse
+import csv
+import os
+import sys
+import threading
+import time
+import zlib
+
+from tile_acquisition import WAIT_STAGE
+
+COLUMNS = ('name', 'index', 'target_x', 'target_y', 'target_wd', 'x', 'y', 'stage_x', 'stage_y',
+           'stage_z', 'wd', 't_scan', 't_done', 'files', 'sizes', 'crc32')
+_FLOAT = ('target_x', 'target_y', 'target_wd', 'x', 'y', 'stage_x', 'stage_y', 'stage_z', 'wd',
+          't_scan', 't_done')
+
+
+def file_crc32(path, block=1 << 20):
+    """CRC32 of a file."""
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            b = f.read(block)
+            if not b:
+                return crc & 0xffffffff
+            crc = zlib.crc32(b, crc)
+
+
+def read_journal(path):
+    """Entries of a journal, dict name -> entry (dict of COLUMNS, the last
+    line of a name wins). Torn or malformed lines are skipped."""
+    entries = {}
+    if not os.path.exists(path):
+        return entries
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, 'r') as f:
+        for row in csv.reader(f):
+            if len(row) != len(COLUMNS) or row[0] == 'name':
+                continue
+            e = dict(zip(COLUMNS, row))
+            try:
+                e['index'] = int(e['index'])
+                for k in _FLOAT:
+                    e[k] = float(e[k]) if e[k] else None
+                e['files'] = [os.path.join(base, f) for f in e['files'].split(';')]
+                e['sizes'] = [int(v) for v in e['sizes'].split(';')]
+                e['crc32'] = [int(v, 16) for v in e['crc32'].split(';')]
+            except ValueError:
+                continue
+            if len(e['sizes']) != len(e['files']) or len(e['crc32']) != len(e['files']):
+                continue
+            entries[e['name']] = e
+    return entries
+
+
+def entry_ok(entry, verify=False):
+    """True if the files of a journal entry are on disk, with the recorded
+    sizes (and CRC32 if verify)."""
+    for path, size, crc in zip(entry['files'], entry['sizes'], entry['crc32']):
+        try:
+            if os.stat(path).st_size != size:
+                return False
+            if verify and file_crc32(path) != crc:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+class Journal:
+    """Append-only journal of the tiles written.
+
+    path            CSV file, appended (created with a header)
+    sync_every      fsync after this many lines
+    sync_seconds    or after this time since the last fsync
+    readback        read the stage position (StgGetPosition) of each tile
+    """
+
+    def __init__(self, path, sync_every=32, sync_seconds=5.0, readback=True):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_seconds = sync_seconds
+        self.readback = readback
+        self.lock = threading.Lock()
+        self.file = None
+        self.writer = None
+        self.unsynced = 0
+        self.t_sync = time.time()
+        self.targets = {}               # name -> (index, target) of the run
+        self._hooks = None
+
+    def open(self):
+        if self.file is not None:
+            return
+        d = os.path.dirname(self.path)
+        if d and not os.path.isdir(d):
+            os.makedirs(d)
+        new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        torn = False
+        if not new:
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                torn = f.read(1) != b'\n'
+        self.file = open(self.path, 'a')
+        self.writer = csv.writer(self.file, lineterminator='\n')
+        if new:
+            self.file.write(','.join(COLUMNS) + '\n')
+        elif torn:
+            self.file.write('\n')                       # end the torn line of a crash
+        self.sync()
+
+    def sync(self):
+        """Flush the journal to the disk."""
+        with self.lock:
+            self._sync()
+
+    def _sync(self):
+        if self.file is None:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.t_sync = time.time()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self._sync()
+                self.file.close()
+                self.file = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, record):
+        """Add a written tile (TileAcquisition record)."""
+        index, target = self.targets.get(record['name'], (record['index'], None))
+        if target is None:
+            target = (record['x'], record['y'], record['wd_plan'])
+        files = list(record['files'])
+        if record.get('hdr'):
+            files.append(record['hdr'])
+        sizes = []
+        crcs = []
+        for path in files:
+            sizes.append(os.path.getsize(path))
+            crcs.append(file_crc32(path))
+        files = [self._relative(f) for f in files]
+        stage = record.get('stage') or (None, None, None)
+        row = [record['name'], index, target[0], target[1], target[2], record['x'], record['y'],
+               stage[0], stage[1], stage[2], record['wd'], record['t_scan'], record['t_done'],
+               ';'.join(files), ';'.join('%d' % v for v in sizes), ';'.join('%08x' % v for v in crcs)]
+        row = ['' if v is None else ('%.6f' % v if isinstance(v, float) else str(v)) for v in row]
+        with self.lock:
+            self.writer.writerow(row)
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every or time.time() - self.t_sync >= self.sync_seconds:
+                self._sync()
+
+    def _relative(self, path):
+        """Path relative to the journal (the tree can be moved), else absolute."""
+        try:
+            return os.path.relpath(os.path.abspath(path), os.path.dirname(os.path.abspath(self.path)))
+        except ValueError:                              # other drive
+            return os.path.abspath(path)
+
+    def remaining(self, acq, targets, verify=False):
+        """Split the targets against the journal.
+
+        acq     the TileAcquisition of the run (tile names)
+        verify  check the CRC32 of the files too (reads them)
+        Returns (todo, done, corrupt) - todo the indices of the targets to
+        acquire, done and corrupt lists of names.
+        """
+        entries = read_journal(self.path)
+        todo, done, corrupt = [], [], []
+        for i, t in enumerate(targets):
+            name = acq.tile_name(i, t)
+            e = entries.get(name)
+            if e is not None and entry_ok(e, verify):
+                done.append(name)
+                continue
+            if e is not None:
+                corrupt.append(name)
+            todo.append(i)
+        return todo, done, corrupt
+
+    def attach(self, acq, targets=()):
+        """Journal the tiles of acq - wraps its tile_started() (stage read
+        back) and tile_done() hooks until detach()."""
+        self.open()
+        self.targets = dict((acq.tile_name(i, t), (i, tuple(float(v) for v in t[0:3])))
+                            for i, t in enumerate(targets))
+        old = dict((k, acq.__dict__.get(k)) for k in ('tile_started', 'tile_done'))
+        started, done = acq.tile_started, acq.tile_done
+        m = acq.m
+        readback = self.readback
+
+        def tile_started(record):
+            started(record)
+            if readback:
+                flags = m.connection.wait_flags
+                m.SetWaitFlags(WAIT_STAGE)              # stage settled, scan still running
+                record['stage'] = tuple(m.StgGetPosition()[0:3])
+                m.SetWaitFlags(flags)
+
+        def tile_done(record):
+            done(record)
+            self.append(record)
+        acq.tile_started = tile_started
+        acq.tile_done = tile_done
+        self._hooks = (acq, old)
+
+    def detach(self):
+        """Restore the hooks, sync the journal."""
+        if self._hooks is not None:
+            acq, old = self._hooks
+            for k, v in old.items():
+                if v is None:
+                    del acq.__dict__[k]
+                else:
+                    acq.__dict__[k] = v
+            self._hooks = None
+        self.sync()
+
+    def run(self, acq, targets, callback=None, verify=False, runner=None, verbose=True, **kwargs):
+        """Acquire the targets not done yet, with the journal.
+
+        runner  runner(acq, targets, callback, **kwargs), default acq.run -
+                e.g. DriftMonitor(...).run
+        kwargs  passed to the runner, a 'coordn' (one per target, as
+                BeamShiftAcquisition.run) is reduced to the remaining ones
+        Returns the records of the tiles acquired now.
+        """
+        targets = list(targets)
+        todo, done, corrupt = self.remaining(acq, targets, verify)
+        if verbose:
+            print('journal %s: %d done, %d corrupt, %d to acquire' % (
+                self.path, len(done), len(corrupt), len(todo)))
+        if not todo:
+            return []
+        if kwargs.get('coordn') is not None:
+            kwargs['coordn'] = [kwargs['coordn'][i] for i in todo]
+        work = [tuple(targets[i][0:3]) + (acq.tile_name(i, targets[i]),) for i in todo]
+        self.attach(acq, targets)
+        try:
+            if runner is None:
+                return acq.run(work, callback=callback, **kwargs)
+            return runner(acq, work, callback, **kwargs)
+        finally:
+            self.detach()
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='Check the tiles of an acquisition journal.')
+    p.add_argument('journal')
+    p.add_argument('--verify', action='store_true', help='check the CRC32 of the files')
+    a = p.parse_args(argv)
+    entries = read_journal(a.journal)
+    bad = [name for name, e in sorted(entries.items()) if not entry_ok(e, a.verify)]
+    for name in bad:
+        print('corrupt or missing: %s' % name)
+    print('%d tiles in the journal, %d corrupt' % (len(entries), len(bad)))
+    return 1 if bad else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+################################################################################
+#Live stitching during the acquisition.
+
+#LiveMosaic keeps a downsampled mosaic and its pyramid (every level half
+#the size of the previous one) as chunk files
+#    <out_dir>/<level>/<chunk row>_<chunk column>.<ext>
+#A new tile is resampled and pasted into the level 0 chunks it covers,
+#then only the parents of those chunks are recomputed, level by level - a
+#tile costs the same at the start and at the end of a long run. The
+#extent does not have to be known in advance (chunk indices may be
+#negative).
+
+#Tiles come from:
+#  - TileWatcher - polls an acquisition directory for ImageSnapper sample
+#    directories (<col>_<row>/Snap_1.<ext>), renamed tiles (<col>_<row>.<ext>)
+#    or direct acquisition tiles (<name>.<ext> + <name>-<ext>.hdr), a tile
+#    is taken once its file stopped changing
+#  - LiveMosaic.add_record - callback of TileAcquisition.run
+
+#Each tile also gets a sharpness score (normalized gradient energy). Tiles
+#much less sharp than the median are listed in tiles.csv as suspects, so a
+#focus failure can be re-shot while the session is still running.
+
+#Geometry and flip conventions are those of mosaic.py.
+
+#Example:
+#    python live_stitch.py D:\Data\Sample 5 5 128 tif D:\Data\Live --stage
+################################################################################
+
+from __future__ import print_function
+import argparse
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+from mosaic import resize, tile_region, _NAME
+from tescan_hdr import read_hdr
+from tile_acquisition import save_image, load_image
+
+
+def sharpness(img):
+    """Normalized gradient energy - mean squared gradient / mean^2."""
+    f = np.asarray(img, dtype=np.float32)
+    if f.ndim == 3:
+        f = f.mean(axis=2)
+    gx = np.diff(f, axis=1)
+    gy = np.diff(f, axis=0)
+    m = f.mean()
+    return float(((gx * gx).mean() + (gy * gy).mean()) / max(m * m, 1e-12))
+
+
+def _downsample2(a):
+    """2x2 mean (array with even size)."""
+    f = a.astype(np.float32)
+    f = 0.25 * (f[0::2, 0::2] + f[1::2, 0::2] + f[0::2, 1::2] + f[1::2, 1::2])
+    if np.issubdtype(a.dtype, np.integer):
+        f = np.rint(f)
+    return f.astype(a.dtype)
+
+
+class LiveMosaic:
+    """Incrementally updated downsampled mosaic with pyramid.
+
+    out_dir     output directory of the chunk files
+    tile_px     width of a tile in the level 0 mosaic [pixels]
+    h_overlap   overlap of neighbours, fraction of the tile
+    levels      number of pyramid levels (level 0 included)
+    chunk       chunk size [pixels]
+    ext         format of the chunk files (npy, png, tif, ...)
+    focus_ratio tiles with sharpness below focus_ratio x median are suspects
+    """
+
+    def __init__(self, out_dir, tile_px=128, h_overlap=0.0, v_overlap=0.0, levels=5, chunk=256,
+                 ext='png', flip_x=True, flip_y=False, focus_ratio=0.7):
+        self.out_dir = out_dir
+        self.tile_px = tile_px
+        self.h_overlap = h_overlap
+        self.v_overlap = v_overlap
+        self.levels = levels
+        self.chunk = chunk
+        self.ext = ext
+        self.flip_x = flip_x
+        self.flip_y = flip_y
+        self.focus_ratio = focus_ratio
+        self.chunks = [{} for k in range(levels)]      # (cy, cx) -> array
+        self.dtype = None
+        self.channels = ()
+        self.pixel = None                               # level 0 pixel [mm]
+        self.tiles = []                                 # (name, x, y, sharpness)
+        self.lock = threading.Lock()
+        for k in range(levels):
+            d = os.path.join(out_dir, str(k))
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+    # positions -------------------------------------------------------------
+
+    def grid_position(self, col, row, tile_h):
+        """Top-left level 0 position of grid tile (col, row), 1-based."""
+        sx = -1 if self.flip_x else 1
+        sy = -1 if self.flip_y else 1
+        return (sx * (col - 1) * self.tile_px * (1.0 - self.h_overlap),
+                sy * (row - 1) * tile_h * (1.0 - self.v_overlap))
+
+    def stage_position(self, x, y, pixel_size, tile_w_in, tile_h):
+        """Top-left level 0 position of a tile centred at stage x, y [mm].
+
+        pixel_size  pixel size of the original tile [mm]
+        """
+        if self.pixel is None:
+            self.pixel = pixel_size * tile_w_in / float(self.tile_px)
+        px = x / self.pixel                             # stage 0 is pixel 0
+        py = y / self.pixel
+        return ((-px if self.flip_x else px) - 0.5 * self.tile_px,
+                (-py if self.flip_y else py) - 0.5 * tile_h)
+
+    # updates ---------------------------------------------------------------
+
+    def add(self, img, pos, name=''):
+        """Paste tile image at level 0 position pos (x, y), update the
+        pyramid. Returns the tile sharpness."""
+        img = np.asarray(img)
+        s = sharpness(img)
+        tile_h = int(round(img.shape[0] * float(self.tile_px) / img.shape[1]))
+        small = resize(img, self.tile_px, tile_h)
+        r0, r1, c0, c1 = tile_region(pos, self.tile_px, tile_h, self.h_overlap, self.v_overlap)
+        sy = r0 - int(np.floor(pos[1] + 0.5))
+        sx = c0 - int(np.floor(pos[0] + 0.5))
+        part = small[sy:sy + r1 - r0, sx:sx + c1 - c0]
+        with self.lock:
+            if self.dtype is None:
+                self.dtype = small.dtype
+                self.channels = small.shape[2:]
+            dirty = self._paste(part, r0, c0)
+            for k in range(1, self.levels):
+                dirty = self._reduce(k, dirty)
+            self.tiles.append((name, pos[0], pos[1], s))
+        return s
+
+    def add_grid(self, path, col, row, name=None):
+        """Add tile file of the grid position (col, row)."""
+        img = load_image(path)
+        tile_h = int(round(img.shape[0] * float(self.tile_px) / img.shape[1]))
+        return self.add(img, self.grid_position(col, row, tile_h), name or path)
+
+    def add_stage(self, path, hdr_path, name=None):
+        """Add tile file placed by StageX, StageY, PixelSizeX of its .hdr."""
+        h = read_hdr(hdr_path, ['StageX', 'StageY', 'PixelSizeX'])
+        img = load_image(path)
+        tile_h = int(round(img.shape[0] * float(self.tile_px) / img.shape[1]))
+        pos = self.stage_position(float(h['StageX']) * 1e3, float(h['StageY']) * 1e3,
+                                  float(h['PixelSizeX']) * 1e3, img.shape[1], tile_h)
+        return self.add(img, pos, name or path)
+
+    def add_record(self, r):
+        """TileAcquisition callback - add the tile of an acquisition record
+        (placed by the .hdr sidecar the writer wrote, r['hdr'])."""
+        s = self.add_stage(r['files'][0], r['hdr'], r['name'])
+        self.write_index()
+        return s
+
+    def _chunk(self, level, key):
+        c = self.chunks[level].get(key)
+        if c is None:
+            c = np.zeros((self.chunk, self.chunk) + self.channels, dtype=self.dtype)
+            self.chunks[level][key] = c
+        return c
+
+    def _paste(self, img, r0, c0):
+        """Write img at level 0 (r0, c0), returns the touched chunk keys."""
+        n = self.chunk
+        h, w = img.shape[0:2]
+        dirty = set()
+        for cy in range(r0 // n, (r0 + h - 1) // n + 1):
+            a = max(r0, cy * n)
+            b = min(r0 + h, (cy + 1) * n)
+            for cx in range(c0 // n, (c0 + w - 1) // n + 1):
+                c = max(c0, cx * n)
+                d = min(c0 + w, (cx + 1) * n)
+                self._chunk(0, (cy, cx))[a - cy * n:b - cy * n, c - cx * n:d - cx * n] = \
+                    img[a - r0:b - r0, c - c0:d - c0]
+                dirty.add((cy, cx))
+        for key in dirty:
+            self._save(0, key)
+        return dirty
+
+    def _reduce(self, level, dirty):
+        """Recompute the level chunks above the dirty ones of level - 1."""
+        n = self.chunk
+        h = n // 2
+        parents = set((cy // 2, cx // 2) for cy, cx in dirty)
+        below = self.chunks[level - 1]
+        for py, px in parents:
+            out = self._chunk(level, (py, px))
+            for dy in (0, 1):
+                for dx in (0, 1):
+                    src = below.get((2 * py + dy, 2 * px + dx))
+                    if src is not None:
+                        out[dy * h:(dy + 1) * h, dx * h:(dx + 1) * h] = _downsample2(src)
+            self._save(level, (py, px))
+        return parents
+
+    def _save(self, level, key):
+        """Write chunk file (replaced atomically, viewers never see half)."""
+        path = os.path.join(self.out_dir, str(level), '%d_%d.%s' % (key[0], key[1], self.ext))
+        tmp = path + '.tmp.' + self.ext
+        save_image(tmp, self.chunks[level][key])
+        os.replace(tmp, path)
+
+    def write_index(self):
+        """tiles.csv - name, level 0 position, sharpness, suspect flag.
+        Written and replaced under the lock - the writer threads of an
+        acquisition call it concurrently (add_record)."""
+        path = os.path.join(self.out_dir, 'tiles.csv')
+        with self.lock:
+            if not self.tiles:
+                return
+            med = np.median([t[3] for t in self.tiles])
+            lines = ['name,x,y,sharpness,suspect']
+            for name, x, y, s in self.tiles:
+                lines.append('%s,%.1f,%.1f,%.6g,%d' % (name, x, y, s, s < self.focus_ratio * med))
+            with open(path + '.tmp', 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(path + '.tmp', path)
+
+    def suspects(self):
+        """Names of the tiles that look out of focus."""
+        with self.lock:
+            if not self.tiles:
+                return []
+            med = np.median([t[3] for t in self.tiles])
+            return [t[0] for t in self.tiles if t[3] < self.focus_ratio * med]
+
+    def preview(self, level):
+        """Whole level as one array (for display), and its (row, column)
+        offset in level pixels."""
+        with self.lock:
+            keys = list(self.chunks[level])
+            if not keys:
+                return None, (0, 0)
+            n = self.chunk
+            ys = [k[0] for k in keys]
+            xs = [k[1] for k in keys]
+            out = np.zeros(((max(ys) - min(ys) + 1) * n, (max(xs) - min(xs) + 1) * n) + self.channels,
+                           dtype=self.dtype)
+            for (cy, cx), c in self.chunks[level].items():
+                out[(cy - min(ys)) * n:(cy - min(ys) + 1) * n, (cx - min(xs)) * n:(cx - min(xs) + 1) * n] = c
+            return out, (min(ys) * n, min(xs) * n)
+
+
+class TileWatcher:
+    """Polls an acquisition directory for finished tiles.
+
+    by      'name' - grid position from <col>_<row> names, 'stage' - from
+            the .hdr files (direct acquisition tiles need 'stage')
+    """
+
+    def __init__(self, directory, ext, mosaic, by='name'):
+        self.directory = directory
+        self.ext = ext
+        self.mosaic = mosaic
+        self.by = by
+        self.done = set()
+        self.seen = {}                  # path -> (size, mtime) of the last poll
+
+    def _candidates(self):
+        """(name, image, hdr) of the tiles not added yet."""
+        ext = '.' + self.ext
+        for e in os.scandir(self.directory):
+            if e.name in self.done:
+                continue
+            if e.is_dir():
+                if _NAME.match(e.name):
+                    yield (e.name, os.path.join(e.path, 'Snap_1' + ext),
+                           os.path.join(e.path, 'Snap_1-%s.hdr' % self.ext))
+            elif e.name.endswith(ext):
+                base = e.name[:-len(ext)]
+                if self.by == 'stage' or _NAME.match(base):
+                    yield (e.name, e.path, os.path.join(self.directory, '%s-%s.hdr' % (base, self.ext)))
+
+    def poll(self):
+        """Add the tiles that are complete, returns list of (name, sharpness)."""
+        added = []
+        for name, img, hdr in self._candidates():
+            try:
+                st = os.stat(img)
+            except OSError:
+                continue
+            if self.by == 'stage' and not os.path.exists(hdr):
+                continue
+            stamp = (st.st_size, st.st_mtime)
+            if self.seen.get(img) != stamp:            # still being written?
+                self.seen[img] = stamp
+                continue
+            try:
+                if self.by == 'stage':
+                    s = self.mosaic.add_stage(img, hdr, name)
+                else:
+                    col, row = (int(v) for v in _NAME.match(os.path.splitext(name)[0]).groups())
+                    s = self.mosaic.add_grid(img, col, row, name)
+            except (IOError, OSError, ValueError, KeyError):
+                continue                                # retried on the next poll
+            self.done.add(name)
+            self.seen.pop(img, None)
+            added.append((name, s))
+        if added:
+            self.mosaic.write_index()
+        return added
+
+    def run(self, interval=2.0, idle_stop=None):
+        """Poll until interrupted (or no new tile for idle_stop seconds)."""
+        last = time.time()
+        try:
+            while True:
+                for name, s in self.poll():
+                    last = time.time()
+                    print('%s  sharpness %.4g' % (name, s))
+                if idle_stop is not None and time.time() - last > idle_stop:
+                    break
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+        return self.mosaic.suspects()
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='Live downsampled mosaic of a running acquisition.')
+    p.add_argument('directory')
+    p.add_argument('h_overlap', type=float, help='horizontal overlap of tiles in percent')
+    p.add_argument('v_overlap', type=float, help='vertical overlap of tiles in percent')
+    p.add_argument('tile_size', type=int, help='tile size in the level 0 mosaic (pixels)')
+    p.add_argument('ext', help='tile extension, e.g. tif')
+    p.add_argument('out_dir', help='output directory of the pyramid')
+    p.add_argument('--stage', action='store_true', help='place tiles by stage position in .hdr files')
+    p.add_argument('--levels', type=int, default=5)
+    p.add_argument('--format', default='png', help='format of the chunk files')
+    p.add_argument('--interval', type=float, default=2.0, help='poll interval in seconds')
+    a = p.parse_args(argv)
+    m = LiveMosaic(a.out_dir, a.tile_size, a.h_overlap / 100.0, a.v_overlap / 100.0, a.levels, ext=a.format)
+    suspects = TileWatcher(a.directory, a.ext, m, 'stage' if a.stage else 'name').run(a.interval)
+    if suspects:
+        print('Possibly out of focus: %s' % ', '.join(suspects))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+################################################################################
+#Out-of-core mosaic assembly.
+
+#Replacement of ShellScripts/TescanRenameFilesMontage.sh. The tiles are
+#placed either by their <column>_<row> names (the grid written by
+#writeImageSnapper.m) or by the stage position in their .hdr files, and
+#written straight into a memory mapped output file:
+#  - .tif/.tiff - uncompressed tiled BigTIFF, no size limit
+#  - .npy       - plain array (numpy.load(path, mmap_mode='r'))
+
+#Geometry is the one of the montage script - each tile is scaled to
+#'tile_size' pixels wide and neighbours overlap by h_overlap / v_overlap
+#(fractions of the tile). Every tile contributes the central part of its
+#image, half of the overlap is cut on each side, so the tiles cover
+#disjoint parts of the canvas and are resampled and written by a pool of
+#processes in any order. As in the script, the column index grows to the
+#left (flip_x) and the row index downwards.
+
+#The positions may be refined by registration.py (register=True).
+
+#Only the canvas file grows with the mosaic, memory use is a few tiles per
+#worker.
+
+#Example (as the shell script, overlaps in percent):
+#    python mosaic.py ~/Data/Mosaic02 9.1 7.6 250 jpg ~/Documents/Pano.tif
+################################################################################
+
+from __future__ import print_function
+import argparse
+import os
+import re
+import struct
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from registration import register_tiles
+from tescan_hdr import read_hdrs, hdr_columns
+from tile_manifest import manifest_tiles
+from tile_acquisition import load_image
+
+_NAME = re.compile(r'^(\d+)_(\d+)$')
+
+
+################################################################################
+# Tiles and their positions
+
+def find_tiles(directory, ext):
+    """Tiles of a grid acquisition, renamed (<col>_<row>.<ext>) or as
+    ImageSnapper leaves them (<col>_<row>/Snap_1.<ext>).
+
+    Returns list of (name, image path, hdr path), sorted by name.
+    """
+    out = []
+    for n in os.listdir(directory):
+        p = os.path.join(directory, n)
+        base, e = os.path.splitext(n)
+        if e == '.' + ext and _NAME.match(base):
+            out.append((base, p, os.path.join(directory, '%s-%s.hdr' % (base, ext))))
+        elif _NAME.match(n) and os.path.isdir(p):
+            img = os.path.join(p, 'Snap_1.%s' % ext)
+            if os.path.exists(img):
+                out.append((n, img, os.path.join(p, 'Snap_1-%s.hdr' % ext)))
+    return sorted(out)
+
+
+def parse_grid_names(names):
+    """(column, row) integer arrays from <col>_<row> names."""
+    cr = np.array([[int(v) for v in _NAME.match(os.path.basename(n)).groups()] for n in names],
+                  dtype=np.int64).reshape(-1, 2)
+    return cr[:, 0], cr[:, 1]
+
+
+def grid_positions(cols, rows, tile_w, tile_h, h_overlap=0.0, v_overlap=0.0, flip_x=True, flip_y=False):
+    """Top-left canvas position (x, y) of each tile of a regular grid.
+
+    tile_w, tile_h  tile size in the mosaic [pixels]
+    h_overlap       overlap of neighbours, fraction of the tile
+    """
+    cols = np.asarray(cols)
+    rows = np.asarray(rows)
+    cx = cols.max() - cols if flip_x else cols - cols.min()
+    cy = rows.max() - rows if flip_y else rows - rows.min()
+    return np.column_stack([cx * tile_w * (1.0 - h_overlap), cy * tile_h * (1.0 - v_overlap)])
+
+
+def stage_positions(x, y, pixel_size, tile_w, tile_h, flip_x=True, flip_y=False):
+    """Top-left canvas position (x, y) of tiles centred at stage x, y.
+
+    pixel_size  mosaic pixel size, in the units of x and y
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    px = (x.max() - x if flip_x else x - x.min()) / pixel_size
+    py = (y.max() - y if flip_y else y - y.min()) / pixel_size
+    return np.column_stack([px - 0.5 * tile_w, py - 0.5 * tile_h])
+
+
+################################################################################
+# Output canvases
+
+class NpyCanvas:
+    """Mosaic as a .npy file, memory mapped."""
+
+    def __init__(self, path, shape, dtype, create=True):
+        if create:
+            self.a = np.lib.format.open_memmap(path, 'w+', dtype, shape)
+        else:
+            self.a = np.load(path, mmap_mode='r+')
+
+    def write(self, r0, c0, img):
+        self.a[r0:r0 + img.shape[0], c0:c0 + img.shape[1]] = img
+
+    def close(self):
+        self.a.flush()
+        del self.a
+
+
+class TiffCanvas:
+    """Mosaic as an uncompressed tiled BigTIFF, memory mapped.
+
+    All tiles have the same size, so the file layout is fixed once the
+    image size is known - header, one IFD, tile offsets and byte counts,
+    then the tiles row by row. The pixel data are a (tiles_y, tiles_x,
+    tile, tile, samples) array in the file.
+    """
+
+    def __init__(self, path, shape, dtype, create=True, tile=256):
+        dtype = np.dtype(dtype).newbyteorder('<')
+        h, w = shape[0:2]
+        spp = shape[2] if len(shape) > 2 else 1
+        nty = (h + tile - 1) // tile
+        ntx = (w + tile - 1) // tile
+        offset = _tiff_data_offset(nty * ntx)
+        if create:
+            _write_tiff_header(path, w, h, spp, dtype, tile, nty * ntx, offset)
+        self.tile = tile
+        self.t = np.memmap(path, dtype, 'r+', offset, (nty, ntx, tile, tile, spp))
+
+    def write(self, r0, c0, img):
+        t = self.tile
+        if img.ndim == 2:
+            img = img[:, :, None]
+        h, w = img.shape[0:2]
+        for ty in range(r0 // t, (r0 + h - 1) // t + 1):
+            a = max(r0, ty * t)
+            b = min(r0 + h, (ty + 1) * t)
+            for tx in range(c0 // t, (c0 + w - 1) // t + 1):
+                c = max(c0, tx * t)
+                d = min(c0 + w, (tx + 1) * t)
+                self.t[ty, tx, a - ty * t:b - ty * t, c - tx * t:d - tx * t] = img[a - r0:b - r0, c - c0:d - c0]
+
+    def close(self):
+        self.t.flush()
+        del self.t
+
+
+_IFD_TAGS = 11
+
+
+def _tiff_data_offset(ntiles):
+    """Offset of the pixel data - header, IFD, two arrays, 4k aligned."""
+    n = 16 + 8 + 20 * _IFD_TAGS + 8 + 16 * ntiles
+    return (n + 4095) // 4096 * 4096
+
+
+def _write_tiff_header(path, w, h, spp, dtype, tile, ntiles, offset):
+    ifd = 16
+    offsets_at = ifd + 8 + 20 * _IFD_TAGS + 8
+    counts_at = offsets_at + 8 * ntiles
+    tile_bytes = tile * tile * spp * dtype.itemsize
+    bps = struct.pack('<%dH' % spp, *([dtype.itemsize * 8] * spp)).ljust(8, b'\0')
+
+    def entry(tag, typ, count, value):
+        if not isinstance(value, bytes):
+            value = struct.pack('<Q', value) if typ == 16 or count > 1 else \
+                struct.pack('<H' if typ == 3 else '<I', value).ljust(8, b'\0')
+        return struct.pack('<HHQ', tag, typ, count) + value
+
+    entries = [entry(256, 4, 1, w),                     # ImageWidth
+               entry(257, 4, 1, h),                     # ImageLength
+               entry(258, 3, spp, bps),                 # BitsPerSample
+               entry(259, 3, 1, 1),                     # Compression - none
+               entry(262, 3, 1, 2 if spp == 3 else 1),  # Photometric - RGB / min is black
+               entry(277, 3, 1, spp),                   # SamplesPerPixel
+               entry(284, 3, 1, 1),                     # PlanarConfiguration - chunky
+               entry(322, 3, 1, tile),                  # TileWidth
+               entry(323, 3, 1, tile),                  # TileLength
+               entry(324, 16, ntiles, offsets_at if ntiles > 1 else offset),    # TileOffsets
+               entry(325, 16, ntiles, counts_at if ntiles > 1 else tile_bytes)]  # TileByteCounts
+    with open(path, 'wb') as f:
+        f.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, ifd))
+        f.write(struct.pack('<Q', len(entries)) + b''.join(entries) + struct.pack('<Q', 0))
+        if ntiles > 1:
+            f.write((offset + tile_bytes * np.arange(ntiles, dtype='<u8')).tobytes())
+            f.write(np.full(ntiles, tile_bytes, dtype='<u8').tobytes())
+        f.truncate(offset + tile_bytes * ntiles)          # sparse on most file systems
+
+
+def open_canvas(path, shape, dtype, create=True, tile=256):
+    """Canvas for the output file, format by the extension."""
+    if path.endswith('.npy'):
+        return NpyCanvas(path, shape, dtype, create)
+    if path.endswith('.tif') or path.endswith('.tiff'):
+        return TiffCanvas(path, shape, dtype, create, tile)
+    raise ValueError('unsupported mosaic format %s (use .tif or .npy)' % path)
+
+
+################################################################################
+# Assembly
+
+_resample_cache = {}
+
+
+def _resample_matrix(n_in, n_out):
+    """(n_out x n_in) area averaging matrix."""
+    key = (n_in, n_out)
+    if key not in _resample_cache:
+        s = float(n_in) / n_out
+        lo = np.arange(n_out)[:, None] * s
+        j = np.arange(n_in)[None, :]
+        m = np.clip(np.minimum(lo + s, j + 1) - np.maximum(lo, j), 0, None) / s
+        _resample_cache[key] = m.astype(np.float32)
+    return _resample_cache[key]
+
+
+def resize(img, w, h):
+    """Resize image to w x h by area averaging (no dependencies)."""
+    if img.shape[1] == w and img.shape[0] == h:
+        return img
+    ry = _resample_matrix(img.shape[0], h)
+    rx = _resample_matrix(img.shape[1], w)
+    f = img.astype(np.float32)
+    if f.ndim == 2:
+        out = ry.dot(f).dot(rx.T)
+    else:
+        out = np.stack([ry.dot(f[:, :, k]).dot(rx.T) for k in range(f.shape[2])], axis=2)
+    if np.issubdtype(img.dtype, np.integer):
+        info = np.iinfo(img.dtype)
+        out = np.clip(np.rint(out), info.min, info.max)
+    return out.astype(img.dtype)
+
+
+def tile_region(pos, tile_w, tile_h, h_overlap, v_overlap):
+    """Canvas region (r0, r1, c0, c1) a tile at pos contributes to."""
+    mx = 0.5 * tile_w * h_overlap
+    my = 0.5 * tile_h * v_overlap
+    c0 = int(np.floor(pos[0] + mx + 0.5))
+    c1 = int(np.floor(pos[0] + tile_w - mx + 0.5))
+    r0 = int(np.floor(pos[1] + my + 0.5))
+    r1 = int(np.floor(pos[1] + tile_h - my + 0.5))
+    return r0, r1, c0, c1
+
+
+_canvas = {}
+
+
+def _place(args):
+    """Worker - load, resize and write one tile. Returns error or None."""
+    path, pos, (tile_w, tile_h), overlap, spec = args
+    try:
+        key = spec[0:2]
+        if key not in _canvas:
+            _canvas.clear()
+            _canvas[key] = open_canvas(spec[0], spec[1], spec[2], False, spec[3])
+        canvas = _canvas[key]
+        shape = spec[1]
+        img = resize(load_image(path), tile_w, tile_h)
+        r0, r1, c0, c1 = tile_region(pos, tile_w, tile_h, overlap[0], overlap[1])
+        a, b = max(r0, 0), min(r1, shape[0])
+        c, d = max(c0, 0), min(c1, shape[1])
+        if a < b and c < d:
+            sy = a - int(np.floor(pos[1] + 0.5))
+            sx = c - int(np.floor(pos[0] + 0.5))
+            part = img[max(sy, 0):max(sy, 0) + b - a, max(sx, 0):max(sx, 0) + d - c]
+            canvas.write(a, c, part[0:b - a, 0:d - c])
+        return None
+    except Exception as e:
+        return '%s: %s' % (path, e)
+
+
+def mosaic_tiles(paths, positions, out, tile_size=None, h_overlap=0.0, v_overlap=0.0,
+                 workers=None, tile=256):
+    """Assemble tiles into the out file (.tif or .npy).
+
+    paths       tile image files
+    positions   (n x 2) top-left canvas position (x, y) of each tile, in
+                mosaic pixels (grid_positions(), stage_positions(), or the
+                result of a registration)
+    tile_size   tile width in the mosaic, None = original size
+    Returns dict with shape, the per-tile regions and the errors.
+    """
+    paths = list(paths)
+    positions = np.asarray(positions, dtype=float)
+    first = load_image(paths[0])
+    h_in, w_in = first.shape[0:2]
+    tile_w = tile_size or w_in
+    tile_h = int(round(h_in * float(tile_w) / w_in))
+    regions = np.array([tile_region(p, tile_w, tile_h, h_overlap, v_overlap) for p in positions])
+    r_min = regions[:, 0].min()
+    c_min = regions[:, 2].min()
+    positions = positions - [c_min, r_min]                  # canvas starts at the first pixel
+    regions = regions - [r_min, r_min, c_min, c_min]
+    shape = (int(regions[:, 1].max()), int(regions[:, 3].max())) + first.shape[2:]
+    canvas = open_canvas(out, shape, first.dtype, True, tile)
+    canvas.close()
+    spec = (out, shape, first.dtype.str, tile)
+    jobs = [(p, tuple(pos), (tile_w, tile_h), (h_overlap, v_overlap), spec) for p, pos in zip(paths, positions)]
+    with ProcessPoolExecutor(workers) as pool:
+        errors = [e for e in pool.map(_place, jobs, chunksize=8) if e is not None]
+    return {'shape': shape, 'regions': regions, 'positions': positions, 'errors': errors}
+
+
+def build_mosaic(directory, ext, out, h_overlap, v_overlap, tile_size=None, by='name',
+                 workers=None, flip_x=True, flip_y=False, register=False):
+    """Mosaic of a grid acquisition directory (see find_tiles()) or of
+    the tiles of a manifest file (tile_manifest.py).
+
+    by          'name' - place by <col>_<row> names, 'stage' - by StageX,
+                StageY and PixelSizeX of the .hdr files
+    h_overlap   overlap of neighbours, fraction of the tile
+    register    refine the positions by registration.register_tiles()
+    """
+    if directory.endswith('.csv'):
+        tiles = manifest_tiles(directory)
+    else:
+        tiles = find_tiles(directory, ext)
+    if not tiles:
+        raise ValueError('no tiles *.%s in %s' % (ext, directory))
+    names, paths, hdrs = zip(*tiles)
+    first = load_image(paths[0])
+    h_in, w_in = first.shape[0:2]
+    if by == 'name':
+        cols, rows = parse_grid_names(names)
+        pos = grid_positions(cols, rows, w_in, h_in, h_overlap, v_overlap, flip_x, flip_y)
+    elif by == 'stage':
+        x, y, ps = hdr_columns(read_hdrs(hdrs, ['StageX', 'StageY', 'PixelSizeX']),
+                               ['StageX', 'StageY', 'PixelSizeX'])
+        ok = np.isfinite(x) & np.isfinite(y)
+        if not ok.all():
+            print('%d tiles without stage position skipped' % (~ok).sum())
+        paths = [p for p, k in zip(paths, ok) if k]
+        pos = stage_positions(x[ok], y[ok], np.nanmedian(ps), w_in, h_in, flip_x, flip_y)
+    else:
+        raise ValueError("by must be 'name' or 'stage'")
+    if register:
+        res = register_tiles(paths, pos, (w_in, h_in), workers=workers)
+        print('registration: %d of %d pairs used' % (res['accepted'].sum(), len(res['pairs'])))
+        pos = res['positions']
+    tile_w = tile_size or w_in
+    return mosaic_tiles(paths, pos * (float(tile_w) / w_in), out, tile_w, h_overlap, v_overlap, workers)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='Assemble a tile mosaic (TescanRenameFilesMontage.sh arguments).')
+    p.add_argument('directory', help='tile directory or manifest.csv')
+    p.add_argument('h_overlap', type=float, help='horizontal overlap of tiles in percent')
+    p.add_argument('v_overlap', type=float, help='vertical overlap of tiles in percent')
+    p.add_argument('tile_size', type=int, help='output tile size in the mosaic (pixels), 0 = original')
+    p.add_argument('ext', help='tile extension, e.g. jpg')
+    p.add_argument('output', help='output file, .tif (tiled BigTIFF) or .npy')
+    p.add_argument('--stage', action='store_true', help='place tiles by stage position in .hdr files')
+    p.add_argument('--register', action='store_true', help='refine tile positions by phase correlation')
+    p.add_argument('--workers', type=int, default=None)
+    a = p.parse_args(argv)
+    t = time.time()
+    res = build_mosaic(a.directory, a.ext, a.output, a.h_overlap / 100.0, a.v_overlap / 100.0,
+                       a.tile_size or None, 'stage' if a.stage else 'name', a.workers,
+                       register=a.register)
+    for e in res['errors']:
+        print(e)
+    print('%d x %d mosaic written to %s' % (res['shape'][1], res['shape'][0], a.output))
+    print('Run time = %d seconds' % (time.time() - t))
+    return 1 if res['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
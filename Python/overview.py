@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+################################################################################
+#Overview scan and culling of the tiles that miss the sample.
+
+#The high-res grid of TescanImageSnapper.m covers the whole bounding box of
+#the focus points, for an irregular section in epoxy a large part of the
+#tiles shows only the mount. An overview image - one large view field scan
+#at low resolution (scan_overview) or the chamber camera (camera_overview)
+#- is segmented into sample and background: box smoothing, threshold (Otsu
+#by default), closing and opening with a square element, holes filled,
+#small objects dropped. Overview knows the stage position of its pixels,
+#keep_tiles() tests the footprint of each tile (grown by a margin) against
+#the mask with a summed area table, so the test is O(1) per tile.
+
+#Stage units are SharkSEM units (mm). The image X axis grows against stage
+#X (flip_x), as in mosaic.py; the simulator draws columns growing with X
+#(flip_x=False).
+
+#Example:
+#    ov = scan_overview(m, view_field=25.0, width=1024, center=(0.0, 0.0))
+#    mask = ov.segment()
+#    pts, coordn = tile_grid(x, y, fov=250)              # focus_map.py, meters
+#    keep = ov.keep_tiles(pts * 1e3, 0.25, margin=0.1, mask=mask)
+#    write_image_snapper(path, ptsxyz[keep], z, 250, coordn[keep], ...)
+################################################################################
+
+from __future__ import print_function
+
+import numpy as np
+
+from tile_acquisition import WAIT_SCAN, WAIT_STAGE, WAIT_OPTICS
+
+
+def otsu(img, bins=256):
+    """Otsu threshold of an image."""
+    f = np.asarray(img, dtype=np.float64).ravel()
+    lo, hi = f.min(), f.max()
+    if hi <= lo:
+        return lo
+    h, edges = np.histogram(f, bins, (lo, hi))
+    p = h / float(h.sum())
+    centers = 0.5 * (edges[1:] + edges[:-1])
+    w0 = np.cumsum(p)
+    m0 = np.cumsum(p * centers)
+    w1 = 1.0 - w0
+    between = (m0[-1] * w0 - m0) ** 2 / np.maximum(w0 * w1, 1e-12)
+    return edges[int(np.argmax(between[:-1])) + 1]
+
+
+def _box_sum(a, r):
+    """Sum over (2r+1) x (2r+1) squares, edges replicated."""
+    s = np.pad(np.asarray(a, dtype=np.float64), r + 1, mode='edge')
+    s[0, :] = 0
+    s[:, 0] = 0
+    c = s.cumsum(axis=0).cumsum(axis=1)
+    n = 2 * r + 1
+    h, w = a.shape
+    return c[n:n + h, n:n + w] - c[0:h, n:n + w] - c[n:n + h, 0:w] + c[0:h, 0:w]
+
+
+def smooth(img, r):
+    """Box filter of radius r."""
+    if r <= 0:
+        return np.asarray(img, dtype=np.float64)
+    return _box_sum(img, r) / (2 * r + 1) ** 2
+
+
+def dilate(mask, r):
+    """Binary dilation, square (2r+1) x (2r+1)."""
+    return _box_sum(mask, r) > 0.5 if r > 0 else mask
+
+
+def erode(mask, r):
+    """Binary erosion, square (2r+1) x (2r+1)."""
+    return _box_sum(mask, r) > (2 * r + 1) ** 2 - 0.5 if r > 0 else mask
+
+
+def _runs(mask):
+    """True runs of the rows, in raster order - (row, start, end) arrays,
+    end exclusive."""
+    h, w = mask.shape
+    p = np.zeros((h, w + 2), dtype=np.int8)
+    p[:, 1:-1] = mask
+    d = np.diff(p, axis=1).ravel()
+    starts = np.flatnonzero(d == 1)
+    ends = np.flatnonzero(d == -1)
+    return starts // (w + 1), starts % (w + 1), ends % (w + 1)
+
+
+def label(mask):
+    """Connected components (4-connectivity), returns (labels, n).
+
+    Union-find over the runs of the rows: the overlapping runs of adjacent
+    rows are found by binary search, the trees are merged (roots hooked to
+    the smaller root) and compressed in vectorized rounds - the number of
+    components at least halves each round. Components are numbered in the
+    order of their first pixel.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    h, w = mask.shape
+    lab = np.zeros(mask.shape, dtype=np.int64)
+    row, start, end = _runs(mask)
+    if len(row) == 0:
+        return lab, 0
+    # run b overlaps run a of the row above if start_a < end_b and end_a > start_b
+    span = w + 1
+    skey = row * span + start
+    ekey = row * span + end
+    lo = np.searchsorted(ekey, (row - 1) * span + start, side='right')
+    hi = np.searchsorted(skey, (row - 1) * span + end, side='left')
+    cnt = np.maximum(hi - lo, 0)
+    b = np.repeat(np.arange(len(row)), cnt)
+    a = np.repeat(lo - np.cumsum(cnt) + cnt, cnt) + np.arange(cnt.sum())
+    parent = np.arange(len(row))
+    while len(a):
+        pa, pb = parent[a], parent[b]
+        diff = pa != pb
+        if not diff.any():
+            break
+        a, b, pa, pb = a[diff], b[diff], pa[diff], pb[diff]
+        np.minimum.at(parent, np.maximum(pa, pb), np.minimum(pa, pb))
+        while True:
+            p2 = parent[parent]
+            if np.array_equal(p2, parent):
+                break
+            parent = p2
+    u, inv = np.unique(parent, return_inverse=True)
+    lab.ravel()[np.flatnonzero(mask)] = np.repeat(inv.reshape(-1) + 1, end - start)
+    return lab, len(u)
+
+
+def fill_holes(mask):
+    """Fill the background regions that do not touch the image border."""
+    lab, n = label(~mask)
+    border = np.unique(np.concatenate([lab[0], lab[-1], lab[:, 0], lab[:, -1]]))
+    outside = np.isin(lab, border[border > 0])
+    return mask | ~outside
+
+
+def remove_small(mask, min_area):
+    """Drop the objects smaller than min_area pixels."""
+    lab, n = label(mask)
+    area = np.bincount(lab.ravel(), minlength=n + 1)
+    keep = area >= min_area
+    keep[0] = False
+    return keep[lab]
+
+
+class Overview:
+    """Overview image and the stage position of its pixels.
+
+    img         (h x w) image
+    center      stage position of the image centre (x, y) [mm]
+    pixel_size  [mm]
+    flip_x      image X grows against stage X
+    flip_y      image Y grows against stage Y
+    """
+
+    def __init__(self, img, center, pixel_size, flip_x=True, flip_y=False):
+        self.img = np.asarray(img)
+        if self.img.ndim == 3:
+            self.img = self.img.mean(axis=2)
+        self.center = (float(center[0]), float(center[1]))
+        self.pixel_size = float(pixel_size)
+        self.flip_x = flip_x
+        self.flip_y = flip_y
+
+    def to_pixel(self, x, y):
+        """Stage x, y [mm] -> image column, row (float)."""
+        h, w = self.img.shape
+        sx = -1.0 if self.flip_x else 1.0
+        sy = -1.0 if self.flip_y else 1.0
+        col = w / 2.0 + sx * (np.asarray(x) - self.center[0]) / self.pixel_size
+        row = h / 2.0 + sy * (np.asarray(y) - self.center[1]) / self.pixel_size
+        return col, row
+
+    def to_stage(self, col, row):
+        """Image column, row -> stage x, y [mm]."""
+        h, w = self.img.shape
+        sx = -1.0 if self.flip_x else 1.0
+        sy = -1.0 if self.flip_y else 1.0
+        x = self.center[0] + sx * (np.asarray(col) - w / 2.0) * self.pixel_size
+        y = self.center[1] + sy * (np.asarray(row) - h / 2.0) * self.pixel_size
+        return x, y
+
+    def segment(self, threshold=None, invert=False, smoothing=2, closing=3, opening=2, fill=True,
+                min_area=0.0005):
+        """Sample mask of the overview.
+
+        threshold   gray level, default Otsu
+        invert      sample darker than the mount
+        smoothing   box filter radius [pixels] before the threshold
+        closing     radius of the closing [pixels]
+        opening     radius of the opening [pixels]
+        min_area    smallest kept object, fraction of the image
+        """
+        f = smooth(self.img, smoothing)
+        if threshold is None:
+            threshold = otsu(f)
+        mask = f < threshold if invert else f > threshold
+        if closing:
+            mask = erode(dilate(mask, closing), closing)
+        if opening:
+            mask = dilate(erode(mask, opening), opening)
+        if fill:
+            mask = fill_holes(mask)
+        if min_area:
+            mask = remove_small(mask, min_area * mask.size)
+        return mask
+
+    def keep_tiles(self, pts, tile_w, tile_h=None, margin=0.0, mask=None, outside=True):
+        """Mask of the tiles whose footprint touches the sample.
+
+        pts         (n x 2) tile centres [mm]
+        tile_w      tile size [mm] (view field), tile_h default tile_w
+        margin      footprint grown by margin on each side [mm]
+        mask        sample mask, default segment()
+        outside     result for tiles entirely outside the overview
+        """
+        if mask is None:
+            mask = self.segment()
+        if tile_h is None:
+            tile_h = tile_w
+        pts = np.asarray(pts, dtype=float).reshape(-1, 2)
+        h, w = mask.shape
+        sat = np.zeros((h + 1, w + 1), dtype=np.int64)
+        sat[1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+        hx = 0.5 * tile_w + margin
+        hy = 0.5 * tile_h + margin
+        c0, r0 = self.to_pixel(pts[:, 0] - hx, pts[:, 1] - hy)
+        c1, r1 = self.to_pixel(pts[:, 0] + hx, pts[:, 1] + hy)
+        left = np.floor(np.minimum(c0, c1)).astype(np.int64)
+        right = np.ceil(np.maximum(c0, c1)).astype(np.int64)
+        top = np.floor(np.minimum(r0, r1)).astype(np.int64)
+        bottom = np.ceil(np.maximum(r0, r1)).astype(np.int64)
+        off = (right <= 0) | (left >= w) | (bottom <= 0) | (top >= h)
+        left, right = np.clip(left, 0, w), np.clip(right, 0, w)
+        top, bottom = np.clip(top, 0, h), np.clip(bottom, 0, h)
+        count = sat[bottom, right] - sat[top, right] - sat[bottom, left] + sat[top, left]
+        return np.where(off, outside, count > 0)
+
+
+def scan_overview(m, view_field, width=1024, height=None, channel=0, center=None, speed=None,
+                  flip_x=True, flip_y=False):
+    """Scan an overview image with a large view field.
+
+    view_field  [mm], restored afterwards
+    channel     input video channel, enabled by the caller (DtEnable)
+    center      stage position (x, y) [mm], default the current one
+    speed       scanning speed (ScSetSpeed), None = keep
+    """
+    if height is None:
+        height = width
+    old_flags = m.connection.wait_flags
+    old_vf = m.GetViewField()
+    old_speed = None
+    frame = 0x20000000
+    try:
+        m.SetWaitFlags(0)
+        if center is not None:
+            m.StgMoveTo(center[0], center[1])
+        if speed is not None:
+            old_speed = m.ScGetSpeed()
+            m.ScSetSpeed(speed)
+        m.SetViewField(view_field)
+        m.SetWaitFlags(WAIT_STAGE | WAIT_OPTICS)
+        res = m.ScScanXY(frame, width, height, 0, 0, width - 1, height - 1, 1)
+        if res is None or res < 0:
+            raise RuntimeError('ScScanXY failed for the overview')
+        img = m.FetchImages([channel], width, height, frame)[channel]
+        if center is None:
+            center = m.StgGetPosition()[0:2]
+    finally:
+        m.SetWaitFlags(WAIT_SCAN)
+        m.SetViewField(old_vf)
+        if old_speed is not None:
+            m.ScSetSpeed(old_speed)
+        m.SetWaitFlags(old_flags)
+    return Overview(img, center, view_field / float(width), flip_x, flip_y)
+
+
+def camera_overview(m, channel, center, pixel_size, flip_x=True, flip_y=False):
+    """Overview from the chamber camera (enabled by CameraEnable).
+
+    center, pixel_size  calibration of the camera image in stage mm
+    """
+    w, h, data = m.FetchCameraImage(channel)
+    img = np.frombuffer(bytes(data), dtype=np.uint8)[0:w * h].reshape(h, w)
+    return Overview(img, center, pixel_size, flip_x, flip_y)
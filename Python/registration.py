@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+################################################################################
+#Tile registration.
+
+#The stage does not return exactly to the requested position, so placing
+#the tiles by a fixed overlap leaves seams. register_tiles() measures the
+#true offset of every pair of neighbouring tiles by phase correlation of
+#their nominal overlap strips and then finds the tile positions that agree
+#best with all the measured offsets (least squares over the whole grid).
+
+#  1) pairs - tiles whose nominal boxes overlap side by side
+#  2) pairwise - the strips are cut once per image, stacked by shape and
+#     correlated by batched FFTs, chunks of pairs run in a process pool.
+#     The confidence of a pair is the normalized cross correlation of the
+#     strips at the found shift.
+#  3) global - weighted least squares, x and y separately, solved by
+#     conjugate gradients on the sparse tile graph. Unreliable pairs (low
+#     correlation, shift too large, large residual after the solve) are
+#     replaced by their nominal offset with a small weight, each tile is
+#     also weakly tied to its nominal position, so tiles without good
+#     neighbours stay where the stage put them.
+
+#Positions are top-left corners in pixels, as mosaic.py uses them.
+
+#Example:
+#    res = register_tiles(paths, nominal)
+#    mosaic.mosaic_tiles(paths, res['positions'], 'Pano.tif')
+################################################################################
+
+from __future__ import print_function
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from tile_acquisition import load_image
+
+
+def neighbour_pairs(positions, tile_w, tile_h, min_overlap=0.01):
+    """Pairs (i, j), i < j, of side by side neighbours.
+
+    Nominal boxes must overlap by at least min_overlap of the tile in the
+    narrow direction and by half of the tile in the other one (no
+    diagonal neighbours).
+    """
+    p = np.asarray(positions, dtype=float)
+    cells = {}
+    key = np.floor(p / [tile_w, tile_h]).astype(np.int64)
+    for i, (a, b) in enumerate(key.tolist()):
+        cells.setdefault((a, b), []).append(i)
+    pairs = []
+    for i, (a, b) in enumerate(key.tolist()):
+        for da in (-1, 0, 1):
+            for db in (-1, 0, 1):
+                for j in cells.get((a + da, b + db), ()):
+                    if j <= i:
+                        continue
+                    ox = (tile_w - abs(p[j, 0] - p[i, 0])) / tile_w
+                    oy = (tile_h - abs(p[j, 1] - p[i, 1])) / tile_h
+                    if min(ox, oy) >= min_overlap and max(ox, oy) >= 0.5:
+                        pairs.append((i, j))
+    return np.array(pairs, dtype=np.int64).reshape(-1, 2)
+
+
+def overlap_region(d, tile_w, tile_h):
+    """Overlap of tile j at offset d = p_j - p_i, in tile i pixels
+    (y0, y1, x0, x1). In tile j it is shifted by -d."""
+    dx = int(round(d[0]))
+    dy = int(round(d[1]))
+    return max(0, dy), min(tile_h, tile_h + dy), max(0, dx), min(tile_w, tile_w + dx)
+
+
+def _gray(img, binning):
+    img = np.asarray(img)
+    if img.ndim == 3:
+        img = img.mean(axis=2)
+    img = img.astype(np.float32)
+    if binning > 1:
+        h = img.shape[0] // binning * binning
+        w = img.shape[1] // binning * binning
+        img = img[0:h, 0:w].reshape(h // binning, binning, w // binning, binning).mean(axis=(1, 3))
+    return img
+
+
+def phase_correlation(a, b):
+    """Shifts s of a stack of image pairs, a(x) = b(x - s), subpixel.
+
+    a, b    (k x h x w) arrays. Returns (k x 2) shifts (x, y).
+    """
+    k, h, w = a.shape
+    win = np.outer(np.hanning(h + 2)[1:-1], np.hanning(w + 2)[1:-1]).astype(np.float32)
+    a = (a - a.mean(axis=(1, 2), keepdims=True)) * win
+    b = (b - b.mean(axis=(1, 2), keepdims=True)) * win
+    r = np.fft.rfft2(a) * np.conj(np.fft.rfft2(b))
+    r /= np.abs(r) + 1e-12
+    c = np.fft.irfft2(r, s=(h, w))
+    flat = c.reshape(k, -1).argmax(axis=1)
+    py, px = np.unravel_index(flat, (h, w))
+    idx = np.arange(k)
+
+    def sub(c0, cm, cp):
+        den = cm - 2 * c0 + cp
+        return np.where(np.abs(den) > 1e-12, 0.5 * (cm - cp) / np.where(den == 0, 1, den), 0.0)
+    c0 = c[idx, py, px]
+    sy = sub(c0, c[idx, (py - 1) % h, px], c[idx, (py + 1) % h, px])
+    sx = sub(c0, c[idx, py, (px - 1) % w], c[idx, py, (px + 1) % w])
+    py = np.where(py > h // 2, py - h, py) + sy
+    px = np.where(px > w // 2, px - w, px) + sx
+    return np.column_stack([px, py])
+
+
+def _ncc(a, b, s):
+    """Normalized cross correlation of a(x) and b(x - s), integer s."""
+    sx = int(round(s[0]))
+    sy = int(round(s[1]))
+    h, w = a.shape
+    if abs(sx) >= w or abs(sy) >= h:
+        return 0.0
+    aa = a[max(sy, 0):h + min(sy, 0), max(sx, 0):w + min(sx, 0)]
+    bb = b[max(-sy, 0):h + min(-sy, 0), max(-sx, 0):w + min(-sx, 0)]
+    aa = aa - aa.mean()
+    bb = bb - bb.mean()
+    den = np.sqrt((aa * aa).sum() * (bb * bb).sum())
+    return float((aa * bb).sum() / den) if den > 0 else 0.0
+
+
+def _register_chunk(args):
+    """Worker - shifts and confidences of a chunk of pairs."""
+    paths, pairs, offsets, (tile_w, tile_h), binning = args
+    regions = [overlap_region(d, tile_w, tile_h) for d in offsets]
+    need = {}                                   # image -> [(pair, side)]
+    for k, (i, j) in enumerate(pairs):
+        need.setdefault(i, []).append((k, 0))
+        need.setdefault(j, []).append((k, 1))
+    strips = [[None, None] for k in range(len(pairs))]
+    for n, uses in need.items():                # every image is read once
+        img = _gray(load_image(paths[n]), binning)
+        for k, side in uses:
+            y0, y1, x0, x1 = regions[k]
+            if side == 1:
+                dx = int(round(offsets[k][0]))
+                dy = int(round(offsets[k][1]))
+                y0, y1, x0, x1 = y0 - dy, y1 - dy, x0 - dx, x1 - dx
+            strips[k][side] = img[y0 // binning:y1 // binning, x0 // binning:x1 // binning].copy()
+        del img
+    shifts = np.zeros((len(pairs), 2))
+    ncc = np.zeros(len(pairs))
+    groups = {}
+    for k, (a, b) in enumerate(strips):
+        if a.size > 16 and a.shape == b.shape:
+            groups.setdefault(a.shape, []).append(k)
+    for shape, ks in groups.items():            # batched FFT per strip shape
+        s = phase_correlation(np.stack([strips[k][0] for k in ks]), np.stack([strips[k][1] for k in ks]))
+        for k, sk in zip(ks, s):
+            # the strips are cut at the rounded nominal offset
+            shifts[k] = sk * binning + np.round(offsets[k]) - offsets[k]
+            ncc[k] = _ncc(strips[k][0], strips[k][1], sk)
+    return shifts, ncc
+
+
+def _cg(diag, ei, ej, w, b, x0, iterations=2000, tol=1e-8):
+    """Solve (L + diag) x = b, L the weighted graph Laplacian, by Jacobi
+    preconditioned conjugate gradients."""
+    n = len(b)
+    deg = np.bincount(ei, w, n) + np.bincount(ej, w, n) + diag
+
+    def A(x):
+        f = w * (x[ei] - x[ej])
+        return diag * x + np.bincount(ei, f, n) - np.bincount(ej, f, n)
+    x = x0.copy()
+    r = b - A(x)
+    z = r / deg
+    p = z.copy()
+    rz = r.dot(z)
+    bn = np.sqrt(b.dot(b)) or 1.0
+    for it in range(iterations):
+        q = A(p)
+        alpha = rz / p.dot(q)
+        x += alpha * p
+        r -= alpha * q
+        if np.sqrt(r.dot(r)) < tol * bn:
+            break
+        z = r / deg
+        rz_new = r.dot(z)
+        p = z + (rz_new / rz) * p
+        rz = rz_new
+    return x
+
+
+def solve_layout(nominal, pairs, measured, weight, prior=1e-4):
+    """Least squares positions from pairwise offsets.
+
+    measured    (m x 2) offsets p_j - p_i of the pairs
+    weight      (m) weights of the pairs
+    prior       weight tying each tile to its nominal position
+    """
+    nominal = np.asarray(nominal, dtype=float)
+    n = len(nominal)
+    ei = pairs[:, 0]
+    ej = pairs[:, 1]
+    diag = np.full(n, float(prior))
+    out = np.empty_like(nominal)
+    for axis in (0, 1):
+        f = weight * measured[:, axis]
+        b = prior * nominal[:, axis] - np.bincount(ei, f, n) + np.bincount(ej, f, n)
+        out[:, axis] = _cg(diag, ei, ej, weight, b, nominal[:, axis])
+    return out
+
+
+def register_tiles(paths, nominal, tile_size=None, min_ncc=0.3, max_shift=None, max_residual=3.0,
+                   fallback=0.01, prior=1e-4, binning=1, workers=None, chunk=64, verbose=False):
+    """Register tiles, returns dict with the refined positions.
+
+    paths       tile image files
+    nominal     (n x 2) nominal top-left positions (x, y) [pixels of the
+                tiles as stored]
+    tile_size   (w, h) of the tiles, None = read from the first one
+    min_ncc     pairs with lower correlation use the nominal offset
+    max_shift   largest accepted correction [pixels], None = any (the
+                correlation finds shifts up to half the overlap strip)
+    max_residual  pairs disagreeing with the solved layout by more pixels
+                use the nominal offset
+    fallback    weight of the nominal offset of rejected pairs
+    binning     integer binning of the images before correlation
+
+    The result has 'positions', 'pairs', 'shifts' (measured corrections),
+    'ncc', 'accepted' and 'residuals' (pixels).
+    """
+    paths = list(paths)
+    nominal = np.asarray(nominal, dtype=float)
+    if tile_size is None:
+        shape = load_image(paths[0]).shape
+        tile_size = (shape[1], shape[0])
+    tile_w, tile_h = tile_size
+    pairs = neighbour_pairs(nominal, tile_w, tile_h)
+    if len(pairs) == 0:
+        return {'positions': nominal.copy(), 'pairs': pairs, 'shifts': np.zeros((0, 2)),
+                'ncc': np.zeros(0), 'accepted': np.zeros(0, dtype=bool), 'residuals': np.zeros(0)}
+    offsets = nominal[pairs[:, 1]] - nominal[pairs[:, 0]]
+
+    order = np.lexsort((pairs[:, 1], pairs[:, 0]))     # image locality in chunks
+    jobs = []
+    for s in range(0, len(order), chunk):
+        ks = order[s:s + chunk]
+        jobs.append((paths, pairs[ks].tolist(), offsets[ks].tolist(), (tile_w, tile_h), binning))
+    shifts = np.zeros((len(pairs), 2))
+    ncc = np.zeros(len(pairs))
+    if len(jobs) == 1:
+        results = [_register_chunk(jobs[0])]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(_register_chunk, jobs))
+    for s, (sh, c) in zip(range(0, len(order), chunk), results):
+        ks = order[s:s + chunk]
+        shifts[ks] = sh
+        ncc[ks] = c
+
+    accepted = ncc >= min_ncc
+    if max_shift is not None:
+        accepted &= np.hypot(shifts[:, 0], shifts[:, 1]) <= max_shift
+    positions = nominal
+    for it in range(10):
+        measured = offsets + np.where(accepted[:, None], shifts, 0.0)
+        weight = np.where(accepted, np.maximum(ncc, 0.0) ** 2, fallback)
+        positions = solve_layout(nominal, pairs, measured, weight, prior)
+        d = positions[pairs[:, 1]] - positions[pairs[:, 0]] - (offsets + shifts)
+        residuals = np.hypot(d[:, 0], d[:, 1])
+        bad = accepted & (residuals > max_residual)
+        if verbose:
+            print('iteration %d: %d/%d pairs accepted, %d rejected by residual' % (
+                it + 1, accepted.sum(), len(pairs), bad.sum()))
+        if not bad.any():
+            break
+        worst = residuals[bad].max()                # drop the worst ones first
+        accepted &= ~(bad & (residuals > 0.5 * worst))
+    return {'positions': positions, 'pairs': pairs, 'shifts': shifts, 'ncc': ncc,
+            'accepted': accepted, 'residuals': residuals}
@@ -63,6 +63,25 @@ class Sem:
         """
         self.connection.Disconnect()
         
+    def Pipeline(self):
+        """ Create pipelined batch of requests
+        
+        Returns SemPipeline object, which offers the same methods as Sem. Its
+        requests are sent immediately without waiting for the responses, the
+        getters return sem_conn.SemFuture objects instead of values. The
+        responses are collected when the pipeline is flushed (on exit from the
+        'with' block or by the first SemFuture.result() call), so several
+        getters cost about one network round trip.
+        
+        Example:
+            with m.Pipeline() as p:
+                pos = p.StgGetPosition()
+                wd = p.GetWD()
+                vf = p.GetViewField()
+            print(pos.result(), wd.result(), vf.result())
+        """
+        return SemPipeline(self)
+        
     def SetWaitFlags(self, flags):
         """ Set wait condition 
         
@@ -91,6 +110,66 @@ class Sem:
         """
         return self.connection.FetchImage('ScData', channel, size)
 
+    def FetchImageArray(self, channel, width, height, out = None):
+        """ Read single image into numpy array
+        
+        channel     input video channel
+        width       image width (pixels)
+        height      image height (pixels)
+        out         optional preallocated uint8 array (height, width) to reuse
+        
+        Same as FetchImage(), but the frame buffer is allocated only once and
+        each data packet is received directly to its place (no copying). The
+        result is a numpy array of shape (height, width), dtype uint8. Requires
+        numpy.
+        """
+        return self.connection.FetchImageArray('ScData', channel, width, height, out)
+
+    def FetchImages(self, channels, width, height, frameid = -1):
+        """ Read single image from several channels at once
+        
+        channels    list of input video channels (enabled by DtEnable)
+        width       image width (pixels)
+        height      image height (pixels)
+        frameid     frame id passed to ScScanXY(), -1 = that of the last
+                    ScScanXY() of this connection (or the first frame whose
+                    data start from pixel 0) - late resends of the previous
+                    frame are skipped
+        
+        Data connection is read once and data packets of all the channels are
+        routed to per-channel buffers, so SE and BSE images are acquired in a
+        single scan. Both 8 and 16 bits per pixel are supported (see DtEnable).
+        The result is a dictionary {channel: numpy array (height, width)}, with
+        dtype uint8 or uint16. Frame id of the received images is stored in
+        self.connection.last_frame_id. Requires numpy.
+        """
+        return self.connection.FetchImages('ScData', channels, width, height, frameid)
+
+    def IterImageRows(self, channel, width, height, out = None, frameid = -1):
+        """ Read single image as a stream of row blocks
+        
+        channel     input video channel
+        width       image width (pixels)
+        height      image height (pixels)
+        out         optional preallocated C-contiguous array (height, width),
+                    uint8 or uint16 - the pixel size of the channel
+        frameid     frame id passed to ScScanXY(), -1 = as FetchImages()
+        
+        Generator, which yields (row, block) tuples while the image is being
+        scanned. 'block' is a numpy view of the complete rows row, row + 1, ...
+        received since the previous step. If the server resends data from an
+        earlier position, the affected rows are yielded again (with lower
+        'row'), so the consumer must accept the rows more than once. All the
+        blocks are views of one frame buffer ('out' if given). A wrong 'out'
+        raises ValueError - at the call, or at the first data if its pixel
+        size does not match the channel. Requires numpy.
+        
+        Example:
+            for row, block in m.IterImageRows(0, 1536, 1536, img):
+                preview(row, block)
+        """
+        return self.connection.IterImageRows('ScData', channel, width, height, out, frameid)
+
     def FetchCameraImage(self, channel):
         """ Read single image from camera (wait till it comes)
         
@@ -281,10 +360,11 @@ class Sem:
         return self.connection.RecvInt('ScGetSpeed')
 
     def ScScanLine(self, frameid, width, height, x0, y0, x1, y1, dwell_time, pixel_count, single):
-        return self.connection.RecvInt('ScScanLine', self._CInt(0), self._CInt(width), self._CInt(height), self._CInt(x0), self._CInt(y0), self._CInt(x1), self._CInt(y1), self._CInt(dwell_time), self._CInt(pixel_count), self._CInt(single))
+        return self.connection.RecvInt('ScScanLine', self._CUnsigned(frameid), self._CInt(width), self._CInt(height), self._CInt(x0), self._CInt(y0), self._CInt(x1), self._CInt(y1), self._CInt(dwell_time), self._CInt(pixel_count), self._CInt(single))
 
     def ScScanXY(self, frameid, width, height, left, top, right, bottom, single):
-        return self.connection.RecvInt('ScScanXY', self._CInt(0), self._CInt(width), self._CInt(height), self._CInt(left), self._CInt(top), self._CInt(right), self._CInt(bottom), self._CInt(single))
+        self.connection.ScanStarted(frameid)
+        return self.connection.RecvInt('ScScanXY', self._CUnsigned(frameid), self._CInt(width), self._CInt(height), self._CInt(left), self._CInt(top), self._CInt(right), self._CInt(bottom), self._CInt(single))
 
     def ScSetBlanker(self, mode):
         self.connection.Send('ScSetBlanker', self._CInt(mode))
@@ -444,3 +524,21 @@ class Sem:
 
     def TcpGetDevice(self):
         return self.connection.RecvString('TcpGetDevice')
+
+
+class SemPipeline(Sem):
+    """Pipelined batch of SEM requests, see Sem.Pipeline()"""
+    
+    def __init__(self, sem):
+        """Constructor"""
+        self.connection = sem_conn.SemPipeline(sem.connection)
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Flush()
+        
+    def Flush(self):
+        """ Receive all the pending responses """
+        self.connection.Flush()
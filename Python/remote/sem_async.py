@@ -0,0 +1,405 @@
+#
+# SharkSEM Script - asyncio client
+#
+# Requires Python 3.6 or later
+#
+
+#
+# asyncio variant of the SEM interface
+#
+# AsyncSem has the methods of Sem as coroutines, IterImageRows() is an
+# asynchronous generator. Sem.Pipeline() is left out - asyncio.gather() of
+# the getters sends all the requests at once and replaces it.
+#
+
+import asyncio
+import collections
+import socket
+import struct
+
+import sem
+import sem_conn
+from sem_conn import ArgType
+from sem_v3_lib import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None                # the array API (FetchImageArray, ...) is not available
+
+
+class AsyncSemConnection(sem_conn.SemConnection):
+    """Asynchronous SEM Connection Class
+
+    Same as SemConnection, but built on asyncio streams. Messages are written
+    to the control connection immediately (Send() does not block), the Recv()
+    family are coroutines. Each request is tagged with a unique Identification,
+    so any number of requests may be pending at the same time. Both
+    connections are read by background tasks - the control task resolves the
+    request futures, the data task assembles the incoming images and resolves
+    the per-frame futures created by FetchImage() and friends.
+    """
+
+    max_frames = 8              # unclaimed frames kept per connection
+
+    def __init__(self):
+        """ Constructor """
+        sem_conn.SemConnection.__init__(self)
+        self.writer_c = None
+        self.writer_d = None
+        self.tasks = []
+        self.msg_id = 0
+        self.pending = {}       # identification -> (future, retval)
+        self.frames = {}        # (name, frame id, channel) -> [bpp, bytearray]
+        self.waiters = []       # [name, channel, frame id, bytes, future]
+        self.streams = []       # [name, channel, frame id, event, error, rewind] of IterImageRows()
+        self.streamed = {}      # frames locked by a stream, as self.frames
+        self.finished = collections.OrderedDict()   # keys of the frames passed or dropped
+        self.cameras = {}       # channel -> [future]
+
+    def _SendStr(self, s):
+        """ Non-blocking send (buffered by the stream writer) """
+        self.writer_c.write(s)
+
+    async def Connect(self, address, port):
+        """ Connect to the server """
+        loop = asyncio.get_event_loop()
+        try:
+            reader_c, self.writer_c = await asyncio.open_connection(address, port)
+            self.tasks.append(asyncio.ensure_future(self._ReadControl(reader_c)))
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            sock.bind(('', 0))
+            loc_port = sock.getsockname()[1]
+            await self._TcpRegDataPort(loc_port)
+            await loop.sock_connect(sock, (address, port + 1))
+            reader_d, self.writer_d = await asyncio.open_connection(sock=sock)
+            self.tasks.append(asyncio.ensure_future(self._ReadData(reader_d)))
+            return 0
+
+        except Exception:
+            self.Disconnect()
+            return -1
+
+    def Disconnect(self):
+        """ Close the connection(s) """
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        for writer in (self.writer_c, self.writer_d):
+            if writer is not None:
+                writer.close()
+        self.writer_c = None
+        self.writer_d = None
+        self._Fail(ConnectionError('disconnected'))
+
+    async def Drain(self):
+        """ Wait until the written messages are passed to the socket """
+        await self.writer_c.drain()
+
+    def _Fail(self, error):
+        """ Resolve all the pending futures with an error """
+        futures = [f for f, retval in self.pending.values()]
+        futures += [w[4] for w in self.waiters]
+        for l in self.cameras.values():
+            futures += l
+        self.pending = {}
+        self.waiters = []
+        self.cameras = {}
+        for f in futures:
+            if not f.done():
+                f.set_exception(error)
+        for st in self.streams:
+            st[4] = error
+            st[3].set()
+
+#
+# control connection
+#
+
+    async def _ReadControl(self, reader):
+        """ Background task - receive responses and resolve the futures """
+        try:
+            while True:
+                hdr = await reader.readexactly(32)
+                v = struct.unpack_from("<IIHHI", hdr, 16)
+                body = await reader.readexactly(v[0])
+                f = self.pending.pop(v[1], None)
+                if f is not None and not f[0].done():
+                    f[0].set_result(self._ParseBody(body, f[1]))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._Fail(e)
+
+    async def Recv(self, fn_name, retval, *args):
+        """ Send message and wait for the response, see SemConnection.Recv() """
+        self.msg_id = self.msg_id % 0xffffffff + 1       # 1 .. 2^32 - 1
+        f = asyncio.get_event_loop().create_future()
+        self.pending[self.msg_id] = (f, retval)
+        self._SendMsg(fn_name, self.msg_id, self.wait_flags, args)
+        return await f
+
+    async def RecvInt(self, fn_name, *args):
+        """ Simple variant of Recv() - single int value is expected """
+        v = await self.Recv(fn_name, (ArgType.Int,), *args)
+        return v[0]
+
+    async def RecvUInt(self, fn_name, *args):
+        """ Simple variant of Recv() - single unsigned int value is expected """
+        v = await self.Recv(fn_name, (ArgType.UnsignedInt,), *args)
+        return v[0]
+
+    async def RecvFloat(self, fn_name, *args):
+        """ Simple variant of Recv() - single float value is expected """
+        v = await self.Recv(fn_name, (ArgType.Float,), *args)
+        return v[0]
+
+    async def RecvString(self, fn_name, *args):
+        """ Simple variant of Recv() - single string value is expected """
+        v = await self.Recv(fn_name, (ArgType.String,), *args)
+        return v[0]
+
+#
+# data connection
+#
+
+    async def _ReadData(self, reader):
+        """ Background task - assemble images from the data connection """
+        try:
+            while True:
+                hdr = await reader.readexactly(32)
+                v = struct.unpack_from("<IIHHI", hdr, 16)
+                body = await reader.readexactly(v[0])
+                if len(body) < 20:
+                    continue
+                name = DecodeString(hdr[0:16])
+                if name == 'CameraData':
+                    self._OnCameraData(body)
+                else:
+                    self._OnScData(name, body)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._Fail(e)
+
+    def _OnScData(self, name, body):
+        """ Store image data packet to its frame """
+        arg_frame_id, arg_channel, arg_index, arg_bpp, arg_data_size = struct.unpack_from("<IIIII", body, 0)
+        if arg_bpp not in (8, 16):
+            return
+        key = (name, arg_frame_id, arg_channel)
+        frame = self.frames.get(key) or self.streamed.get(key)
+        if frame is None:
+            # a frame starts with pixel 0 - a later packet or a packet of a
+            # frame already passed is a late resend, it would never complete
+            if arg_index > 0 or key in self.finished:
+                return
+            while len(self.frames) >= self.max_frames:          # drop the oldest
+                old = next(iter(self.frames))
+                del self.frames[old]
+                self._Finish(old)
+            frame = [arg_bpp, bytearray()]
+            self.frames[key] = frame
+        if arg_bpp != frame[0]:
+            return
+        img = frame[1]
+        index = arg_index * arg_bpp // 8
+        rewind = None
+        if index < len(img):            # correct, can be sent more than once
+            del img[index:]
+            rewind = index
+        if index > len(img):            # data packet lost
+            return
+        img += body[20:20 + arg_data_size]
+        for st in self.streams:
+            if st[0] == name and st[1] == arg_channel and st[2] in (-1, arg_frame_id):
+                self._Lock(st, key)
+                if rewind is not None and (st[5] is None or rewind < st[5]):
+                    st[5] = rewind      # lowest position resent since the last wakeup
+                st[3].set()
+        self._Resolve(key)
+
+    def _Finish(self, key):
+        """ Frame 'key' is passed (or dropped), its late resends are ignored """
+        self.finished[key] = None
+        while len(self.finished) > 4 * self.max_frames:
+            self.finished.popitem(False)
+
+    def ScanStarted(self, frame_id):
+        """ A new scan may reuse the frame id of a finished frame """
+        sem_conn.SemConnection.ScanStarted(self, frame_id)
+        for key in [k for k in self.finished if k[1] == frame_id]:
+            del self.finished[key]
+
+    def _Lock(self, stream, key):
+        """ Give frame 'key' to the stream, waiters do not see it any more """
+        if key in self.frames:
+            self.streamed[key] = self.frames.pop(key)
+        stream[2] = key[1]
+
+    def _Resolve(self, key):
+        """ Pass complete frame 'key' to the first matching waiter """
+        frame = self.frames.get(key)
+        if frame is None:
+            return
+        name, frame_id, channel = key
+        for w in self.waiters:
+            if w[0] != name or w[1] != channel or (w[2] >= 0 and w[2] != frame_id):
+                continue
+            size = w[3] * frame[0] // 8
+            if len(frame[1]) < size:
+                continue
+            del self.frames[key]
+            self._Finish(key)
+            self.waiters.remove(w)
+            del frame[1][size:]
+            if not w[4].done():
+                w[4].set_result((frame_id, frame[0], frame[1]))
+            return
+
+    async def _WaitFrame(self, fn_name, channel, size, frame_id):
+        """ Wait for frame of 'size' pixels, returns (frame id, bpp, bytearray) """
+        f = asyncio.get_event_loop().create_future()
+        self.waiters.append([fn_name, channel, frame_id, size, f])
+        for key in list(self.frames.keys()):    # data may have arrived already
+            if not f.done():
+                self._Resolve(key)
+        return await f
+
+    async def FetchImage(self, fn_name, channel, size, frame_id = -1):
+        """ Fetch image. See Sem.FetchImage for details """
+        frame_id, bpp, img = await self._WaitFrame(fn_name, channel, size, frame_id)
+        return bytes(img)
+
+    async def FetchImageArray(self, fn_name, channel, width, height, out = None, frame_id = -1):
+        """ Fetch image as numpy array. See Sem.FetchImageArray for details """
+        self._NeedNumpy('FetchImageArray')
+        frame_id, bpp, img = await self._WaitFrame(fn_name, channel, width * height, frame_id)
+        if bpp == 8:
+            a = numpy.frombuffer(img, numpy.uint8).reshape((height, width))
+        else:
+            a = numpy.frombuffer(img, "<u2").reshape((height, width))
+        if out is None:
+            return a
+        out[...] = a
+        return out
+
+    async def FetchImages(self, fn_name, channels, width, height, frame_id = -1):
+        """ Fetch images of several channels. See Sem.FetchImages for details """
+        self._NeedNumpy('FetchImages')
+        imgs = {}
+        for ch in channels:
+            frame_id, bpp, img = await self._WaitFrame(fn_name, ch, width * height, frame_id)
+            if bpp == 8:
+                imgs[ch] = numpy.frombuffer(img, numpy.uint8).reshape((height, width))
+            else:
+                imgs[ch] = numpy.frombuffer(img, "<u2").reshape((height, width))
+        self.last_frame_id = frame_id
+        return imgs
+
+    def IterImageRows(self, fn_name, channel, width, height, out = None, frame_id = -1):
+        """ Fetch image row by row, asynchronous generator (async for). See
+        Sem.IterImageRows for details """
+        self._NeedNumpy('IterImageRows')
+        if out is not None:             # checked now, not at the first row
+            if (out.dtype not in (numpy.uint8, numpy.dtype("<u2")) or out.size != width * height
+                    or not out.flags.c_contiguous):
+                raise ValueError('out must be a contiguous uint8 or uint16 array of width x height pixels')
+        return self._IterImageRows(fn_name, channel, width, height, out, frame_id)
+
+    async def _IterImageRows(self, fn_name, channel, width, height, out, frame_id):
+        st = [fn_name, channel, frame_id, asyncio.Event(), None, None]
+        self.streams.append(st)
+        for key in list(self.frames.keys()):    # data may have arrived already
+            if key[0] == fn_name and key[2] == channel and frame_id in (-1, key[1]):
+                self._Lock(st, key)
+                st[3].set()
+                break
+        img = out
+        view = None
+        copied = 0                      # bytes copied to img
+        rows = 0                        # rows already passed to the caller
+        try:
+            while rows < height:
+                await st[3].wait()
+                st[3].clear()
+                if st[4] is not None:
+                    raise st[4]
+                frame = self.streamed.get((fn_name, st[2], channel))
+                if frame is None:
+                    continue
+                bpp, data = frame
+                if img is None:         # allocate according to the first packet
+                    img = numpy.empty((height, width), numpy.uint8 if bpp == 8 else "<u2")
+                if view is None:
+                    if bpp != img.itemsize * 8:
+                        raise ValueError('out has %d bit pixels, channel %d sends %d bit' % (img.itemsize * 8, channel, bpp))
+                    view = img.reshape(-1).view(numpy.uint8)
+                row_bytes = width * img.itemsize
+                n = min(len(data), view.size)
+                rewind = min(n, copied if st[5] is None else st[5])
+                st[5] = None
+                if rewind < copied:     # resent from an earlier position
+                    copied = rewind
+                    rows = min(rows, copied // row_bytes)
+                view[copied:n] = numpy.frombuffer(data, numpy.uint8, n - copied, copied)
+                copied = n
+                done = copied // row_bytes
+                if done > rows:
+                    yield (rows, img[rows:done])
+                    rows = done
+        finally:
+            self.streams.remove(st)
+            if self.streamed.pop((fn_name, st[2], channel), None) is not None:
+                self._Finish((fn_name, st[2], channel))
+
+    def _OnCameraData(self, body):
+        """ Pass camera image to the waiters """
+        arg_channel, arg_bpp, arg_width, arg_height, arg_data_size = struct.unpack_from("<IIIII", body, 0)
+        if arg_bpp != 8:
+            return
+        for f in self.cameras.pop(arg_channel, []):
+            if not f.done():
+                f.set_result((arg_width, arg_height, body[20:20 + arg_data_size]))
+
+    async def FetchCameraImage(self, channel):
+        """ Fetch camera image. See Sem.FetchCameraImage for details """
+        f = asyncio.get_event_loop().create_future()
+        self.cameras.setdefault(channel, []).append(f)
+        return await f
+
+
+class AsyncSem(sem.Sem):
+    """Tescan SEM Control Class - asyncio variant
+
+    Offers the same methods as Sem. Connect() and all the methods returning a
+    value (getters, FetchImage, ...) are coroutines and must be awaited. The
+    methods without return value (setters) write the request to the control
+    connection immediately and return None. Requests are processed by the
+    server in order, so a getter awaited after a setter sees its effect.
+
+    Example:
+        m = AsyncSem()
+        await m.Connect('localhost', 8300)
+        m.SetWD(15e-3)
+        wd, pos = await asyncio.gather(m.GetWD(), m.StgGetPosition())
+        async for row, block in m.IterImageRows(0, 1536, 1536):
+            preview(row, block)
+
+    There is no Pipeline() - concurrent requests are pipelined by themselves,
+    asyncio.gather() replaces it.
+    """
+
+    def __init__(self):
+        """Constructor"""
+        self.connection = AsyncSemConnection()
+
+    async def Drain(self):
+        """ Wait until all the written requests are passed to the socket """
+        await self.connection.Drain()
+
+    @property
+    def Pipeline(self):
+        """ Inherited from Sem, not part of AsyncSem """
+        raise AttributeError('AsyncSem has no Pipeline(), use asyncio.gather()')
@@ -0,0 +1,293 @@
+#
+# SharkSEM Script
+#
+# Requires Python 2.x or 3.x
+#
+
+#
+# SharkSEM message codecs
+#
+# Packers and unpackers are compiled once per command signature. Fixed size
+# messages (integers only) are packed by a single cached struct.Struct, ie.
+# header and body in one call. Floats and strings are variable sized, their
+# struct.Struct is cached per combination of the encoded lengths. Codecs for
+# the commands of sem.Sem are compiled from the COMMANDS table at import,
+# other signatures are compiled on first use.
+#
+
+import struct
+import sys
+
+if sys.version_info[0] == 2:
+    from sem_v2_lib import *
+
+if sys.version_info[0] == 3:
+    from sem_v3_lib import *
+
+#
+# SharkSEM data types
+#
+class ArgType:
+    """SharkSEM data types
+
+    Contains the common types used in the client-server communication.
+    """
+    Int, UnsignedInt, String, Float = range(4)
+
+I, U, S, F = ArgType.Int, ArgType.UnsignedInt, ArgType.String, ArgType.Float
+
+#
+# Commands of sem.Sem
+#
+# name: (input argument types, output argument types). Trailing input
+# arguments of StgMoveTo() and DtEnable() are optional, codecs are compiled
+# for every prefix of their input types.
+#
+COMMANDS = {
+    # session
+    'TcpRegDataPort':   ((I,), (I,)),
+    'TcpGetVersion':    ((), (S,)),
+    'TcpGetDevice':     ((), (S,)),
+    'ChamberLed':       ((I,), ()),
+    'Delay':            ((I,), ()),
+
+    # electron optics
+    'AutoColumn':       ((I,), ()),
+    'AutoGun':          ((I,), ()),
+    'AutoWD':           ((I,), ()),
+    'Degauss':          ((), ()),
+    'EnumCenterings':   ((), (S,)),
+    'EnumGeometries':   ((), (S,)),
+    'EnumPCIndexes':    ((), (S,)),
+    'Get3DBeam':        ((), (F, F)),
+    'GetCentering':     ((I,), (F, F)),
+    'GetGeometry':      ((I,), (F, F)),
+    'GetIAbsorbed':     ((), (F,)),
+    'GetImageShift':    ((), (F, F)),
+    'GetPCFine':        ((), (F,)),
+    'GetPCContinual':   ((), (F,)),
+    'GetPCIndex':       ((), (I,)),
+    'GetSpotSize':      ((), (F,)),
+    'GetViewField':     ((), (F,)),
+    'GetWD':            ((), (F,)),
+    'Set3DBeam':        ((F, F), ()),
+    'SetCentering':     ((I, F, F), ()),
+    'SetGeometry':      ((I, F, F), ()),
+    'SetImageShift':    ((F, F), ()),
+    'SetPCIndex':       ((I,), ()),
+    'SetPCContinual':   ((F,), ()),
+    'SetViewField':     ((F,), ()),
+    'SetWD':            ((F,), ()),
+
+    # manipulators
+    'ManipGetCount':    ((), (I,)),
+    'ManipGetCurr':     ((), (I,)),
+    'ManipSetCurr':     ((I,), ()),
+    'ManipGetConfig':   ((I,), (S,)),
+
+    # stage
+    'StgCalibrate':     ((), ()),
+    'StgGetPosition':   ((), (F, F, F, F, F)),
+    'StgIsBusy':        ((), (I,)),
+    'StgIsCalibrated':  ((), (I,)),
+    'StgMoveTo':        ((F, F, F, F, F), ()),
+    'StgStop':          ((), ()),
+
+    # detectors
+    'DtAutoSignal':     ((I,), ()),
+    'DtEnable':         ((I, I, I), ()),
+    'DtEnumDetectors':  ((), (S,)),
+    'DtGetChannels':    ((), (I,)),
+    'DtGetEnabled':     ((I,), (I, I)),
+    'DtGetGainBlack':   ((I,), (F, F)),
+    'DtGetSelected':    ((I,), (I,)),
+    'DtSelect':         ((I, I), ()),
+    'DtSetGainBlack':   ((I, F, F), ()),
+
+    # scanning
+    'ScEnumSpeeds':     ((), (S,)),
+    'ScGetBlanker':     ((), (I,)),
+    'ScGetExternal':    ((), (I,)),
+    'ScGetSpeed':       ((), (I,)),
+    'ScScanLine':       ((U, I, I, I, I, I, I, I, I, I), (I,)),
+    'ScScanXY':         ((U, I, I, I, I, I, I, I), (I,)),
+    'ScSetBlanker':     ((I,), ()),
+    'ScSetExternal':    ((I,), ()),
+    'ScSetSpeed':       ((I,), ()),
+    'ScStopScan':       ((), ()),
+    'ScSetBeamPos':     ((F, F), ()),
+
+    # scanning mode
+    'SMEnumModes':      ((), (S,)),
+    'SMGetMode':        ((), (I,)),
+    'SMSetMode':        ((I,), ()),
+
+    # vacuum, airlock
+    'VacGetPressure':   ((I,), (F,)),
+    'VacGetStatus':     ((), (I,)),
+    'VacGetVPMode':     ((), (I,)),
+    'VacGetVPPress':    ((), (F,)),
+    'VacPump':          ((), ()),
+    'VacSetVPMode':     ((I,), ()),
+    'VacSetVPPress':    ((F,), ()),
+    'VacVent':          ((), ()),
+    'ArlGetStatus':     ((), (I,)),
+    'ArlPump':          ((), ()),
+    'ArlVent':          ((), ()),
+    'ArlOpenValve':     ((), ()),
+    'ArlCloseValve':    ((), ()),
+
+    # high voltage
+    'HVAutoHeat':       ((I,), ()),
+    'HVBeamOff':        ((), ()),
+    'HVBeamOn':         ((), ()),
+    'HVEnumIndexes':    ((), (S,)),
+    'HVGetBeam':        ((), (I,)),
+    'HVGetEmission':    ((), (F,)),
+    'HVGetFilTime':     ((), (I,)),
+    'HVGetHeating':     ((), (F,)),
+    'HVGetIndex':       ((), (I,)),
+    'HVGetVoltage':     ((), (F,)),
+    'HVSetIndex':       ((I,), ()),
+    'HVSetVoltage':     ((F,), ()),
+
+    # GUI, camera
+    'GUIGetScanning':   ((), (I,)),
+    'GUISetScanning':   ((I,), ()),
+    'CameraEnable':     ((I, F, F, I), ()),
+    'CameraDisable':    ((), ()),
+    'CameraGetStatus':  ((I,), (I, F, F, I)),
+}
+
+HEADER = struct.Struct("<16sIIHHI")     # message header (name + <IIHHI)
+HEADER_FMT = "<16sIIHHI"
+
+_INT_FMT = {I: "i", U: "I"}
+_INT_STRUCT = {I: struct.Struct("<i"), U: struct.Struct("<I")}
+_SIZE = struct.Struct("<I")
+
+
+class Packer:
+    """Compiled packer of one request signature
+
+    Pack() returns the complete message (header + body) as a single bytes
+    object.
+    """
+
+    def __init__(self, fn_name, types):
+        """ Constructor """
+        self.name = fn_name.ljust(16, "\x00").encode()
+        self.types = tuple(types)
+        self.var = [t in (S, F) for t in self.types]
+        self.fixed = None               # Struct of fixed size message
+        self.structs = {}               # lengths of the strings -> Struct
+        if not any(self.var):
+            fmt = HEADER_FMT + "".join(_INT_FMT[t] for t in self.types)
+            self.fixed = struct.Struct(fmt)
+            self.body_size = self.fixed.size - HEADER.size
+
+    def Pack(self, msg_id, flags, values):
+        """ Build message with identification, flags and argument values """
+        if self.fixed is not None:
+            return self.fixed.pack(self.name, self.body_size, msg_id, flags, 0, 0, *values)
+
+        # floats and strings are sent as zero terminated, 4-padded strings
+        args = []
+        lens = []
+        for var, t, v in zip(self.var, self.types, values):
+            if var:
+                s = str(v).encode()
+                l = (len(s) + 4) // 4 * 4
+                args.append(l)
+                args.append(s)
+                lens.append(l)
+            else:
+                args.append(v)
+        lens = tuple(lens)
+        st = self.structs.get(lens)
+        if st is None:
+            st = self._Compile(lens)
+        return st.pack(self.name, st.size - HEADER.size, msg_id, flags, 0, 0, *args)
+
+    def _Compile(self, lens):
+        """ Compile Struct for the given lengths of the encoded strings """
+        fmt = [HEADER_FMT]
+        i = 0
+        for var, t in zip(self.var, self.types):
+            if var:
+                fmt.append("I%ds" % lens[i])        # 's' pads with zeros
+                i = i + 1
+            else:
+                fmt.append(_INT_FMT[t])
+        st = struct.Struct("".join(fmt))
+        self.structs[lens] = st
+        return st
+
+
+class Unpacker:
+    """Compiled unpacker of one response signature
+
+    Unpack() returns list of the output arguments. Integer only responses are
+    unpacked by a single struct.Struct.
+    """
+
+    def __init__(self, types):
+        """ Constructor """
+        self.types = tuple(types)
+        self.fixed = None
+        if not any(t in (S, F) for t in self.types):
+            self.fixed = struct.Struct("<" + "".join(_INT_FMT[t] for t in self.types))
+
+    def Unpack(self, body):
+        """ Parse the response body """
+        if self.fixed is not None:
+            return list(self.fixed.unpack_from(body, 0))
+        l = []
+        start = 0
+        for t in self.types:
+            if t in (S, F):
+                size = _SIZE.unpack_from(body, start)[0]
+                start = start + 4
+                s = DecodeString(body[start:start + size])
+                if t == F:
+                    l.append(float(s))
+                else:
+                    l.append(s)
+                start = start + size
+            else:
+                l.append(_INT_STRUCT[t].unpack_from(body, start)[0])
+                start = start + 4
+        return l
+
+
+_packers = {}                   # (name, types) -> Packer
+_unpackers = {}                 # types -> Unpacker
+
+
+def GetPacker(fn_name, types):
+    """ Compiled packer for command 'fn_name' with input argument 'types' """
+    key = (fn_name, types)
+    p = _packers.get(key)
+    if p is None:
+        p = Packer(fn_name, types)
+        _packers[key] = p
+    return p
+
+
+def GetUnpacker(types):
+    """ Compiled unpacker for output argument 'types' """
+    u = _unpackers.get(types)
+    if u is None:
+        u = Unpacker(types)
+        _unpackers[types] = u
+    return u
+
+
+def _CompileTable():
+    """ Compile codecs of the commands listed in COMMANDS """
+    for fn_name, (in_types, out_types) in COMMANDS.items():
+        for n in range(len(in_types) + 1):          # optional trailing args
+            GetPacker(fn_name, in_types[0:n])
+        GetUnpacker(out_types)
+
+_CompileTable()
@@ -13,23 +13,20 @@ import string
 import struct
 import sys
 
+import sem_codec
+from sem_codec import ArgType               # SharkSEM data types
+
+try:
+    import numpy
+except ImportError:
+    numpy = None                # the array API (FetchImageArray, ...) is not available
+
 if sys.version_info[0] == 2:
     from sem_v2_lib import *
      
 if sys.version_info[0] == 3:
     from sem_v3_lib import *
 
-#
-# SharkSEM data types
-#
-class ArgType:
-    """SharkSEM data types
-
-    Contains the common types used in the client-server communication.
-    """
-    Int, UnsignedInt, String, Float = range(4)
-    
-
 #
 # SharkSEM connection
 #
@@ -46,6 +43,10 @@ class SemConnection:
         self.socket_c = 0       # control connection
         self.socket_d = 0       # data connection
         self.wait_flags = 0     # wait flags (bits 5:0)
+        self.hdr_buf = bytearray(32)            # data connection message header
+        self.skip_buf = bytearray(65536)        # scratch buffer for discarded data
+        self.last_frame_id = -1                 # frame id of the last FetchImages()
+        self.scan_frame_id = -1                 # frame id of the last ScScanXY()
         
     def _SendStr(self, s):
         """ Blocking send """
@@ -57,13 +58,32 @@ class SemConnection:
             
     def _RecvFully(self, sock, size):
         """ Blocking receive - wait for all data """
+        buf = bytearray(size)
+        self._RecvInto(sock, memoryview(buf))
+        return bytes(buf)
+
+    def _RecvInto(self, sock, view):
+        """ Blocking receive into a writable buffer - wait for all data """
+        size = len(view)
         received = 0
-        str = DeclareBytes()
         while received < size:
-            s = sock.recv(size - received)
-            received = received + len(s)
-            str = str + s
-        return str
+            res = sock.recv_into(view[received:], size - received)
+            if res == 0:
+                raise socket.error('connection closed')
+            received = received + res
+
+    def _NeedNumpy(self, fn):
+        """ Clear error instead of a failure deep in the array code """
+        if numpy is None:
+            raise ImportError('numpy is required for %s (array API), use FetchImage() otherwise' % fn)
+
+    def _SkipD(self, size):
+        """ Blocking receive - data connection, data are discarded """
+        view = memoryview(self.skip_buf)
+        while size > 0:
+            n = min(size, len(view))
+            self._RecvInto(self.socket_d, view[0:n])
+            size = size - n
             
     def _RecvStrC(self, size):
         """ Blocking receive - control connection """
@@ -106,50 +126,209 @@ class SemConnection:
         except:
             pass
         
-    def FetchImage(self, fn_name, channel, size):
-        """ Fetch image. See Sem.FetchImage for details """
-        img = DeclareBytes()
-        img_sz = 0
-        while img_sz < size:
+    def _RecvScData(self, fn_name):
+        """ Receive data connection messages until 'fn_name' arrives
+        
+        Messages with different name (or too short) are discarded. Only the
+        header and the fixed part of the body are read, the caller must consume
+        the rest of the body. The result is a tuple
+        
+            (frame_id, channel, index, bpp, data_size, body_left)
+        
+        where 'body_left' is the number of bytes remaining in the socket (image
+        data followed by the padding).
+        """
+        name = fn_name.ljust(16, "\x00").encode()
+        hdr = memoryview(self.hdr_buf)
+        while True:
             # receive, parse and verify the message header
-            msg_name = self._RecvStrD(16)
-            hdr = self._RecvStrD(16)
-            v = struct.unpack("<IIHHI", hdr)
+            self._RecvInto(self.socket_d, hdr)
+            v = struct.unpack_from("<IIHHI", self.hdr_buf, 16)
             body_size = v[0]
-            
-            # get fn name
-            s = DecodeString(msg_name)
-            
-            # receive and parse the body
-            body = self._RecvStrD(body_size)
-            if s != fn_name:
+            if bytes(self.hdr_buf[0:16]) != name or body_size < 20:
+                self._SkipD(body_size)
                 continue
-            if body_size < 20:
+            
+            # receive and parse the body parameters
+            self._RecvInto(self.socket_d, hdr[0:20])
+            v = struct.unpack_from("<IIIII", self.hdr_buf, 0)
+            return v + (body_size - 20,)
+    
+    def ScanStarted(self, frame_id):
+        """ Called by ScScanXY() - the frame id of the new scan """
+        self.scan_frame_id = frame_id
+
+    def _LockFrame(self, frame_id, arg_frame_id, arg_index):
+        """ Frame to read - frame_id if given (>= 0), else the frame id of the
+        last ScScanXY(), else the frame of the first packet from pixel 0 (a
+        late resend of the previous frame starts later); -1 while unknown """
+        if frame_id >= 0:
+            return frame_id
+        if self.scan_frame_id >= 0:
+            return self.scan_frame_id
+        if arg_index == 0:
+            return arg_frame_id
+        return -1
+
+    def _FetchImageInto(self, fn_name, channel, view):
+        """ Fetch 8-bit image into a preallocated buffer (memoryview of bytes)
+        
+        Each data packet is received directly to its position in the buffer,
+        the image is never copied.
+        """
+        size = len(view)
+        img_sz = 0
+        frame_id = -1
+        while img_sz < size:
+            arg_frame_id, arg_channel, arg_index, arg_bpp, arg_data_size, body_left = self._RecvScData(fn_name)
+            if arg_channel != channel or arg_bpp != 8:
+                self._SkipD(body_left)
                 continue
-            body_params = body[0:20]
-            body_data = body[20:]
-            v = struct.unpack("<IIIII", body_params)
-            arg_frame_id = v[0]
-            arg_channel = v[1]
-            arg_index = v[2]
-            arg_bpp = v[3]
-            arg_data_size = v[4]
-            if arg_channel != channel:
+            frame_id = self._LockFrame(frame_id, arg_frame_id, arg_index)
+            if arg_frame_id != frame_id:
+                self._SkipD(body_left)
                 continue
             if arg_index < img_sz:         # correct, can be sent more than once
-                img = img[0:arg_index]
                 img_sz = arg_index
             if arg_index > img_sz:         # data packet lost
-                continue
-            if arg_bpp != 8:
+                self._SkipD(body_left)
                 continue
             
-            # append data
-            img = img + body_data
-            img_sz = img_sz + arg_data_size
+            # receive data to their place
+            n = min(arg_data_size, body_left, size - img_sz)
+            self._RecvInto(self.socket_d, view[img_sz:img_sz + n])
+            self._SkipD(body_left - n)
+            img_sz = img_sz + n
+
+    def FetchImage(self, fn_name, channel, size):
+        """ Fetch image. See Sem.FetchImage for details """
+        img = bytearray(size)
+        self._FetchImageInto(fn_name, channel, memoryview(img))
             
         # when we have complete image, terminate
-        return img
+        return bytes(img)
+    
+    def FetchImageArray(self, fn_name, channel, width, height, out = None):
+        """ Fetch image as numpy array. See Sem.FetchImageArray for details """
+        self._NeedNumpy('FetchImageArray')
+        if out is None:
+            out = numpy.empty((height, width), numpy.uint8)
+        if out.dtype != numpy.uint8 or out.size != width * height or not out.flags.c_contiguous:
+            raise ValueError('out must be a contiguous uint8 array of width x height pixels')
+        self._FetchImageInto(fn_name, channel, out.reshape(-1).data)
+        return out
+      
+    def FetchImages(self, fn_name, channels, width, height, frame_id = -1):
+        """ Fetch images of several channels. See Sem.FetchImages for details """
+        self._NeedNumpy('FetchImages')
+        size = width * height
+        imgs = {}
+        views = {}
+        img_sz = {}                     # received bytes per channel
+        for ch in channels:
+            img_sz[ch] = 0
+        todo = len(img_sz)
+        while todo > 0:
+            arg_frame_id, arg_channel, arg_index, arg_bpp, arg_data_size, body_left = self._RecvScData(fn_name)
+            if arg_channel not in img_sz or arg_bpp not in (8, 16):
+                self._SkipD(body_left)
+                continue
+            frame_id = self._LockFrame(frame_id, arg_frame_id, arg_index)
+            if arg_frame_id != frame_id:
+                self._SkipD(body_left)
+                continue
+            
+            # buffer is allocated when the first packet shows the pixel size
+            if arg_channel not in imgs:
+                if arg_bpp == 8:
+                    imgs[arg_channel] = numpy.empty((height, width), numpy.uint8)
+                else:
+                    imgs[arg_channel] = numpy.empty((height, width), "<u2")
+                views[arg_channel] = imgs[arg_channel].reshape(-1).view(numpy.uint8).data
+            img = imgs[arg_channel]
+            if arg_bpp != img.itemsize * 8:
+                self._SkipD(body_left)
+                continue
+                
+            index = arg_index * img.itemsize
+            sz = img_sz[arg_channel]
+            if sz == size * img.itemsize:   # channel already complete
+                self._SkipD(body_left)
+                continue
+            if index < sz:              # correct, can be sent more than once
+                sz = index
+            if index > sz:              # data packet lost
+                self._SkipD(body_left)
+                continue
+            
+            # receive data to their place
+            n = min(arg_data_size, body_left, size * img.itemsize - sz)
+            self._RecvInto(self.socket_d, views[arg_channel][sz:sz + n])
+            self._SkipD(body_left - n)
+            img_sz[arg_channel] = sz + n
+            if sz + n == size * img.itemsize:
+                todo = todo - 1
+            
+        self.last_frame_id = frame_id
+        return imgs
+      
+    def IterImageRows(self, fn_name, channel, width, height, out = None, frame_id = -1):
+        """ Fetch image row by row. See Sem.IterImageRows for details """
+        self._NeedNumpy('IterImageRows')
+        if out is not None:             # checked now, not at the first row
+            if (out.dtype not in (numpy.uint8, numpy.dtype("<u2")) or out.size != width * height
+                    or not out.flags.c_contiguous):
+                raise ValueError('out must be a contiguous uint8 or uint16 array of width x height pixels')
+        return self._IterImageRows(fn_name, channel, width, height, out, frame_id)
+      
+    def _IterImageRows(self, fn_name, channel, width, height, out, frame_id):
+        size = width * height
+        img = out
+        view = None
+        if img is not None:
+            view = img.reshape(-1).view(numpy.uint8).data
+        img_sz = 0                      # received bytes
+        rows = 0                        # rows already passed to the caller
+        while rows < height:
+            arg_frame_id, arg_channel, arg_index, arg_bpp, arg_data_size, body_left = self._RecvScData(fn_name)
+            if arg_channel != channel or arg_bpp not in (8, 16):
+                self._SkipD(body_left)
+                continue
+            frame_id = self._LockFrame(frame_id, arg_frame_id, arg_index)
+            if arg_frame_id != frame_id:
+                self._SkipD(body_left)
+                continue
+            if img is None:             # allocate according to the first packet
+                if arg_bpp == 8:
+                    img = numpy.empty((height, width), numpy.uint8)
+                else:
+                    img = numpy.empty((height, width), "<u2")
+                view = img.reshape(-1).view(numpy.uint8).data
+            if arg_bpp != img.itemsize * 8:
+                self._SkipD(body_left)
+                if img is out:          # would never be filled
+                    raise ValueError('out has %d bit pixels, channel %d sends %d bit' % (img.itemsize * 8, channel, arg_bpp))
+                continue
+                
+            index = arg_index * img.itemsize
+            if index < img_sz:          # correct, can be sent more than once
+                img_sz = index
+                rows = min(rows, img_sz // (width * img.itemsize))
+            if index > img_sz:          # data packet lost
+                self._SkipD(body_left)
+                continue
+            
+            # receive data to their place
+            n = min(arg_data_size, body_left, size * img.itemsize - img_sz)
+            self._RecvInto(self.socket_d, view[img_sz:img_sz + n])
+            self._SkipD(body_left - n)
+            img_sz = img_sz + n
+            
+            # pass the newly completed rows
+            done = img_sz // (width * img.itemsize)
+            if done > rows:
+                yield (rows, img[rows:done])
+                rows = done
       
     def FetchCameraImage(self, channel):
         """ Fetch camera image. See Sem.FetchCameraImage for details """
@@ -215,37 +394,18 @@ class SemConnection:
             - Identification = 0
             - Queue = 0
         """
+        self._SendMsg(fn_name, 0, self.wait_flags, args)
         
-        # build message body
-        body = DeclareBytes()                           # variable of type 'bytes'
-        for pair in args:
-            pair_type, pair_value = pair
-            
-            if pair_type == ArgType.Int:   				# 32-bit integer
-                body = body + struct.pack("<i", pair_value)
-                
-            if pair_type == ArgType.UnsignedInt:   		# 32-bit unsigned integer
-                body = body + struct.pack("<I", pair_value)
-
-            if pair_type == ArgType.Float:              # floating point
-                s = str(pair_value)
-                l = (len(s) + 4) // 4 * 4
-                s = s.ljust(l, "\x00")
-                body = body + struct.pack("<I", l) + s.encode()
+    def _SendMsg(self, fn_name, msg_id, wait_flags, args):
+        """ Send message with given identification and wait flags, see Send() """
         
-            if pair_type == ArgType.String:             # string
-                l = (len(pair_value) + 4) // 4 * 4
-                var = var.ljust(l, "\x00")
-                body = body + struct.pack("<I", l) + pair_value.encode()
-                
-        # build message header
-        s = fn_name.ljust(16, "\x00")                   # pad fn name (string)
-        hdr = s.encode()                                # convert to bytes
-        hdr = hdr + struct.pack("<IIHHI", len(body), 0, (self.wait_flags << 8), 0, 0)       # arguments
+        types = tuple([pair[0] for pair in args])
+        values = [pair[1] for pair in args]
+        packer = sem_codec.GetPacker(fn_name, types)    # compiled, cached
+        msg = packer.Pack(msg_id, wait_flags << 8, values)
         
         try:
-            self._SendStr(hdr)                          # send header
-            self._SendStr(body)                         # send body
+            self._SendStr(msg)                          # send header + body
             
         except:
             pass
@@ -274,59 +434,29 @@ class SemConnection:
         self.Send(fn_name, *args)
         
         try:
-            # receive header
-            fn_recv = self._RecvStrC(16)
-            hdr = self._RecvStrC(16)
-            
-            # parse header
-            v = struct.unpack("<IIHHI", hdr)
-            body_size = v[0]
-            
-            # receive body
-            body = self._RecvStrC(body_size)
-            
+            fn_recv, msg_id, body = self._RecvMsg()
         except:
             return
 
-        # parse return value
-        l = []
-        start = 0
+        return self._ParseBody(body, retval)
+    
+    def _RecvMsg(self):
+        """ Receive response from the control connection
         
-        for t in retval:
-                        
-            if t == ArgType.Int:   				# 32-bit integer
-                stop = start + 4
-                v = struct.unpack("<i", body[start:stop])
-                l.append(v[0])
-                start = stop
-                
-            if t == ArgType.UnsignedInt:   		# 32-bit unsigned integer
-                stop = start + 4
-                v = struct.unpack("<I", body[start:stop])
-                l.append(v[0])
-                start = stop
-
-            if t == ArgType.Float:              # floating point
-                stop = start + 4
-                v = struct.unpack("<I", body[start:stop])
-                fl_size = v[0]
-                start = stop
-                stop = start + fl_size
-                s = DecodeString(body[start:stop])
-                l.append(float(s))
-                start = stop
-                
-            if t == ArgType.String:             # string
-                stop = start + 4
-                v = struct.unpack("<I", body[start:stop])
-                fl_size = v[0]
-                start = stop
-                stop = start + fl_size
-                s = DecodeString(body[start:stop])
-                l.append(s)
-                start = stop
-
-        return l
+        Returns tuple (fn_name, identification, body).
+        """
+        
+        # receive and parse header
+        hdr = self._RecvStrC(32)
+        fn_recv, body_size, msg_id, flags, queue, resvd = sem_codec.HEADER.unpack(hdr)
+        
+        # receive body
+        body = self._RecvStrC(body_size)
+        return (DecodeString(fn_recv), msg_id, body)
+        
+    def _ParseBody(self, body, retval):
+        """ Unpack output arguments of types 'retval' from the response body """
+        return sem_codec.GetUnpacker(tuple(retval)).Unpack(body)
                 
     def RecvInt(self, fn_name, *args):
         """ Simple variant of Recv() - single int value is expected """
@@ -347,3 +477,120 @@ class SemConnection:
         """ Simple variant of Recv() - single string value is expected """
         v = self.Recv(fn_name, (ArgType.String,), *args)
         return v[0]
+
+
+#
+# SharkSEM pipelined requests
+#
+class SemFuture:
+    """Result of a pipelined request
+
+    The value is available after the response has arrived. Calling result()
+    before that flushes the pipeline, ie. blocks until all the pending
+    responses are received.
+    """
+    
+    def __init__(self, pipeline, retval, item):
+        """ Constructor """
+        self.pipeline = pipeline
+        self.retval = retval    # output argument types
+        self.item = item        # index of the returned argument, None = list
+        self.value = None
+        self.error = None
+        self.finished = False
+        
+    def _SetBody(self, body):
+        """ Parse the response body and resolve the future """
+        v = self.pipeline.connection._ParseBody(body, self.retval)
+        if self.item is not None:
+            v = v[self.item]
+        self.value = v
+        self.finished = True
+        
+    def _SetError(self, error):
+        """ Resolve the future with an error """
+        self.error = error
+        self.finished = True
+        
+    def done(self):
+        """ True if the response has already been received """
+        return self.finished
+    
+    def result(self):
+        """ Return value of the request, wait for the response if necessary """
+        if not self.finished:
+            self.pipeline.Flush()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class SemPipeline:
+    """SEM Pipeline Class
+
+    Wrapper around SemConnection, which sends the requests back to back
+    without waiting for the responses. Each request expecting a response is
+    tagged with a unique Identification (see SharkSEM message header) and the
+    Recv() family returns a SemFuture instead of the value. Responses are
+    matched to the futures by the Identification when Flush() is called.
+    
+    All the other methods and attributes are taken from the wrapped
+    connection. Wait flags are copied when the pipeline is created and may be
+    changed for the pipeline only.
+    """
+    
+    def __init__(self, connection):
+        """ Constructor """
+        self.connection = connection
+        self.wait_flags = connection.wait_flags
+        self.pending = {}       # identification -> SemFuture
+        self.msg_id = 0
+        
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+        
+    def Send(self, fn_name, *args):
+        """ Send simple message, no response expected """
+        self.connection._SendMsg(fn_name, 0, self.wait_flags, args)
+        
+    def Recv(self, fn_name, retval, *args):
+        """ Send message, the response is returned as a SemFuture (list) """
+        return self._Request(fn_name, retval, None, args)
+        
+    def RecvInt(self, fn_name, *args):
+        """ Pipelined variant of RecvInt() """
+        return self._Request(fn_name, (ArgType.Int,), 0, args)
+
+    def RecvUInt(self, fn_name, *args):
+        """ Pipelined variant of RecvUInt() """
+        return self._Request(fn_name, (ArgType.UnsignedInt,), 0, args)
+
+    def RecvFloat(self, fn_name, *args):
+        """ Pipelined variant of RecvFloat() """
+        return self._Request(fn_name, (ArgType.Float,), 0, args)
+
+    def RecvString(self, fn_name, *args):
+        """ Pipelined variant of RecvString() """
+        return self._Request(fn_name, (ArgType.String,), 0, args)
+        
+    def _Request(self, fn_name, retval, item, args):
+        """ Send tagged request and register its future """
+        self.msg_id = self.msg_id % 0xffffffff + 1       # 1 .. 2^32 - 1
+        future = SemFuture(self, retval, item)
+        self.pending[self.msg_id] = future
+        self.connection._SendMsg(fn_name, self.msg_id, self.wait_flags, args)
+        return future
+        
+    def Flush(self):
+        """ Receive responses for all the pending requests """
+        while len(self.pending) > 0:
+            try:
+                fn_recv, msg_id, body = self.connection._RecvMsg()
+            except Exception as e:
+                for future in self.pending.values():
+                    future._SetError(e)
+                self.pending = {}
+                return
+            future = self.pending.pop(msg_id, None)
+            if future is not None:
+                future._SetBody(body)
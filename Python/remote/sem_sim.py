@@ -0,0 +1,688 @@
+#
+# SharkSEM Script - microscope simulator
+#
+# Requires Python 3.x and numpy
+#
+
+#
+# Local SharkSEM server for offline testing and benchmarks
+#
+# Speaks the same wire format as SemConnection - 16 byte function name,
+# <IIHHI header (body size, identification, flags, queue, reserved), ints
+# and floats-as-strings in the body, TcpRegDataPort data port handshake and
+# ScData messages on the data connection. The microscope model covers stage
+# position and move latency (per-axis velocity, acceleration, backlash),
+# working distance settling, AutoWD duration and failures, focus drift and
+# a synthetic specimen, which is rendered into the scanned images (texture,
+# sample outline, defocus blur, noise).
+#
+# Usage:
+#     python sem_sim.py [--port 8300] [--bandwidth 20e6] [--time-scale 0.01]
+#
+# Units follow SharkSEM - mm for stage, WD, view field and image shift.
+#
+
+import argparse
+import random
+import socket
+import struct
+import threading
+import time
+
+import numpy
+
+import sem_codec
+from sem_codec import ArgType
+
+#
+# SharkSEM commands implemented by the simulator
+#
+# Signatures are taken from sem_codec.COMMANDS. Trailing input arguments are
+# optional, as in StgMoveTo() or DtEnable().
+#
+COMMANDS = dict((name, sem_codec.COMMANDS[name]) for name in (
+    'TcpRegDataPort', 'TcpGetVersion', 'TcpGetDevice', 'Delay',
+    'AutoWD', 'GetWD', 'SetWD', 'GetViewField', 'SetViewField', 'GetImageShift', 'SetImageShift',
+    'StgGetPosition', 'StgMoveTo', 'StgIsBusy', 'StgIsCalibrated', 'StgCalibrate', 'StgStop',
+    'DtEnable', 'DtGetEnabled', 'DtGetChannels', 'DtSelect', 'DtGetSelected', 'DtAutoSignal',
+    'ScScanXY', 'ScStopScan', 'ScGetSpeed', 'ScSetSpeed', 'ScSetBeamPos',
+    'GUIGetScanning', 'GUISetScanning'))
+
+
+class SimSpecimen:
+    """Synthetic specimen
+
+    Focus height is a tilted quadratic surface, the specimen is an elliptic
+    section (bright, textured) in a dark mount. Texture is a deterministic
+    value noise in stage coordinates, so overlapping tiles show the same
+    features.
+    """
+
+    def __init__(self, seed = 1):
+        """ Constructor """
+        self.seed = seed
+        self.wd0 = 15.0                 # in-focus WD at the origin [mm]
+        self.tilt = (0.004, -0.003)     # surface slope dz/dx, dz/dy
+        self.curvature = 2e-4           # quadratic term [1/mm]
+        self.radius = (9.0, 6.0)        # section half axes [mm]
+        self.center = (0.0, 0.0)
+
+    def FocusWD(self, x, y, z):
+        """ In-focus working distance at stage position (x, y, z) """
+        h = self.tilt[0] * x + self.tilt[1] * y + self.curvature * (x * x + y * y)
+        return self.wd0 - h - (z - 25.0)
+
+    def _Noise(self, x, y, cell):
+        """ Value noise with lattice 'cell' [mm], bilinear interpolation """
+        fx = x / cell
+        fy = y / cell
+        ix = numpy.floor(fx)
+        iy = numpy.floor(fy)
+        tx = fx - ix
+        ty = fy - iy
+        ix = ix.astype(numpy.int64)
+        iy = iy.astype(numpy.int64)
+
+        def lattice(a, b):
+            h = (a * 73856093) ^ (b * 19349663) ^ (self.seed * 83492791)
+            h = (h ^ (h >> 13)) * 1274126177
+            return ((h >> 8) & 0xffff).astype(numpy.float32) / 65535.0
+
+        v00 = lattice(ix, iy)
+        v10 = lattice(ix + 1, iy)
+        v01 = lattice(ix, iy + 1)
+        v11 = lattice(ix + 1, iy + 1)
+        top = v00 + (v10 - v00) * tx
+        bot = v01 + (v11 - v01) * tx
+        return top + (bot - top) * ty
+
+    def Render(self, x, y, channel):
+        """ Signal (0..1) at stage coordinates x, y (arrays) """
+        v = 0.5 * self._Noise(x, y, 0.02) + 0.3 * self._Noise(x, y, 0.005) + 0.2 * self._Noise(x, y, 0.0012)
+        inside = ((x - self.center[0]) / self.radius[0]) ** 2 + ((y - self.center[1]) / self.radius[1]) ** 2 <= 1.0
+        v = numpy.where(inside, 0.25 + 0.7 * v, 0.05 + 0.05 * v)
+        if channel % 2 == 1:            # second detector - different contrast
+            v = numpy.where(inside, 1.0 - 0.8 * v, v)
+        return v
+
+
+class SimMicroscope:
+    """Microscope model
+
+    Methods named after SharkSEM commands implement them, arguments and
+    return values are listed in COMMANDS. All physical delays are multiplied
+    by 'time_scale'.
+    """
+
+    def __init__(self, specimen = None, time_scale = 1.0):
+        """ Constructor """
+        self.specimen = specimen or SimSpecimen()
+        self.time_scale = time_scale
+        self.lock = threading.RLock()
+        self.t0 = time.time()
+
+        # stage
+        self.stage_speed = (3.0, 3.0, 0.5)      # x, y, z velocity [mm/s]
+        self.stage_accel = (10.0, 10.0, 2.0)    # [mm/s^2]
+        self.stage_settle = 0.2                 # settle time after a move [s]
+        self.backlash = 0.3                     # extra time on reversal [s]
+        self.pos = [0.0, 0.0, 25.0, 0.0, 0.0]
+        self.move_from = list(self.pos)
+        self.move_to = list(self.pos)
+        self.move_start = 0.0
+        self.move_end = 0.0
+        self.last_dir = [0, 0, 0]
+
+        # optics
+        self.wd = 15.0
+        self.wd_settle = 0.3                    # SetWD settle time [s]
+        self.optics_busy = 0.0
+        self.autowd_time = 15.0                 # AutoWD duration [s]
+        self.autowd_busy = 0.0
+        self.autowd_fail = 0.1                  # AutoWD failure rate
+        self.autowd_noise = 0.002               # AutoWD error [mm]
+        self.focus_drift = 0.0                  # focus drift [mm/h]
+        self.aperture = 0.005                   # beam semi-angle [rad]
+        self.view_field = 0.25
+        self.shift = [0.0, 0.0]
+        self.shift_limit = 0.05                 # max image shift [mm]
+
+        # scanning
+        self.channels = {}                      # enabled channel -> bpp
+        self.selected = {}
+        self.speed = 1
+        self.scan_end = 0.0                     # end of the beam scan
+        self.scan_stop = False
+        self.noise = 0.02                       # detector noise (rms)
+
+    def Now(self):
+        """ Simulator clock [s] """
+        return time.time() - self.t0
+
+    def Sleep(self, t):
+        """ Physical delay """
+        time.sleep(t * self.time_scale)
+
+#
+# state conditions (wait flags)
+#
+
+    def ScanBusy(self):
+        return self.Now() < self.scan_end
+
+    def StageBusy(self):
+        return self.Now() < self.move_end
+
+    def OpticsBusy(self):
+        return self.Now() < self.optics_busy
+
+    def AutoBusy(self):
+        return self.Now() < self.autowd_busy
+
+    def Busy(self, flags):
+        """ True if a command with wait 'flags' cannot be executed yet """
+        wait = flags >> 8
+        with self.lock:
+            return ((wait & 1 and self.ScanBusy()) or (wait & 2 and self.StageBusy())
+                    or (wait & 4 and self.OpticsBusy()) or (wait & 8 and self.AutoBusy()))
+
+    def FocusWD(self):
+        """ True in-focus WD at the current beam position """
+        x, y, z = self.Position()[0:3]
+        hours = self.Now() / max(self.time_scale, 1e-9) / 3600.0
+        return self.specimen.FocusWD(x + self.shift[0], y + self.shift[1], z) + self.focus_drift * hours
+
+    def Position(self):
+        """ Current stage position (interpolated during a move) """
+        now = self.Now()
+        if now >= self.move_end:
+            return list(self.move_to)
+        f = (now - self.move_start) / max(self.move_end - self.move_start, 1e-9)
+        return [a + (b - a) * f for a, b in zip(self.move_from, self.move_to)]
+
+    def MoveTime(self, dist, axis):
+        """ Travel time of single axis (trapezoidal velocity profile) """
+        v = self.stage_speed[axis]
+        a = self.stage_accel[axis]
+        d_acc = v * v / a
+        if dist < d_acc:
+            return 2.0 * (dist / a) ** 0.5
+        return dist / v + v / a
+
+#
+# SharkSEM commands
+#
+
+    def TcpRegDataPort(self, port):
+        return [0]
+
+    def TcpGetVersion(self):
+        return ['2.0.2 (simulator)']
+
+    def TcpGetDevice(self):
+        return ['SharkSEM simulator']
+
+    def AutoWD(self, channel):
+        with self.lock:
+            t = self.autowd_time * self.time_scale
+            self.autowd_busy = self.Now() + t
+            self.optics_busy = self.autowd_busy
+            if random.random() < self.autowd_fail:
+                self.wd = self.FocusWD() + random.uniform(-1.0, 1.0)
+            else:
+                self.wd = self.FocusWD() + random.gauss(0.0, self.autowd_noise)
+
+    def GetWD(self):
+        return [self.wd]
+
+    def SetWD(self, wd):
+        with self.lock:
+            self.wd = wd
+            self.optics_busy = self.Now() + self.wd_settle * self.time_scale
+
+    def GetViewField(self):
+        return [self.view_field]
+
+    def SetViewField(self, vf):
+        self.view_field = vf
+
+    def GetImageShift(self):
+        return list(self.shift)
+
+    def SetImageShift(self, x, y):
+        lim = self.shift_limit
+        self.shift = [min(max(x, -lim), lim), min(max(y, -lim), lim)]
+
+    def StgGetPosition(self):
+        return self.Position()
+
+    def StgMoveTo(self, *args):
+        with self.lock:
+            now = self.Now()
+            start = self.Position()
+            target = list(self.move_to)
+            target[0:len(args)] = args
+            t = 0.0
+            for axis in range(3):
+                d = target[axis] - start[axis]
+                if d == 0:
+                    continue
+                direction = 1 if d > 0 else -1
+                ta = self.MoveTime(abs(d), axis)
+                if self.last_dir[axis] not in (0, direction):
+                    ta = ta + self.backlash
+                self.last_dir[axis] = direction
+                t = max(t, ta)
+            if t > 0:
+                t = t + self.stage_settle
+            self.move_from = start
+            self.move_to = target
+            self.move_start = now
+            self.move_end = now + t * self.time_scale
+
+    def StgIsBusy(self):
+        return [int(self.StageBusy())]
+
+    def StgIsCalibrated(self):
+        return [1]
+
+    def StgCalibrate(self):
+        pass
+
+    def StgStop(self):
+        with self.lock:
+            p = self.Position()
+            self.move_from = p
+            self.move_to = p
+            self.move_end = self.Now()
+
+    def DtEnable(self, channel, enable, bpp = 8):
+        if enable:
+            self.channels[channel] = bpp
+        else:
+            self.channels.pop(channel, None)
+
+    def DtGetEnabled(self, channel):
+        return [int(channel in self.channels), self.channels.get(channel, 8)]
+
+    def DtGetChannels(self):
+        return [4]
+
+    def DtSelect(self, channel, detector):
+        self.selected[channel] = detector
+
+    def DtGetSelected(self, channel):
+        return [self.selected.get(channel, channel)]
+
+    def DtAutoSignal(self, channel):
+        pass
+
+    def ScGetSpeed(self):
+        return [self.speed]
+
+    def ScSetSpeed(self, speed):
+        self.speed = speed
+
+    def ScSetBeamPos(self, x, y):
+        pass
+
+    def GUIGetScanning(self):
+        return [0]
+
+    def GUISetScanning(self, enable):
+        pass
+
+    def Delay(self, delay):
+        self.Sleep(delay / 1000.0)
+
+    def DwellTime(self):
+        """ Pixel dwell time of the current speed index [s] """
+        return 1e-7 * 2 ** max(self.speed - 1, 0)
+
+    def BeamState(self):
+        """ Snapshot of the imaging conditions at the start of a scan """
+        x, y = self.Position()[0:2]
+        return (x + self.shift[0], y + self.shift[1], self.view_field, self.wd, self.FocusWD())
+
+    def RenderImage(self, state, channel, width, height, left, top, right, bottom):
+        """ Synthetic image of the visible region, float 0..1
+
+        'state' is BeamState() taken when the scan was started. Image axes
+        follow the stage axes - columns grow with X, rows grow with Y.
+        """
+        x0, y0, view_field, wd, focus_wd = state
+        pitch = view_field / width
+        cols = numpy.arange(left, right + 1, dtype = numpy.float64)
+        rows = numpy.arange(top, bottom + 1, dtype = numpy.float64)
+        x = x0 + (cols - width / 2.0) * pitch
+        y = y0 + (rows - height / 2.0) * pitch
+        img = self.specimen.Render(x[numpy.newaxis, :], y[:, numpy.newaxis], channel)
+
+        # defocus blur - separable box filter of the blur disc size
+        r = int(round(abs(wd - focus_wd) * self.aperture / pitch))
+        if r > 0:
+            for axis in (0, 1):
+                pad = [(0, 0), (0, 0)]
+                pad[axis] = (r, r)
+                c = numpy.cumsum(numpy.pad(img, pad, mode = 'edge'), axis = axis)
+                pad[axis] = (1, 0)
+                c = numpy.pad(c, pad, mode = 'constant')
+                n = img.shape[axis]
+                hi = numpy.take(c, numpy.arange(2 * r + 1, 2 * r + 1 + n), axis = axis)
+                lo = numpy.take(c, numpy.arange(0, n), axis = axis)
+                img = (hi - lo) / (2 * r + 1)
+        img = img + numpy.random.normal(0.0, self.noise, img.shape)
+        return numpy.clip(img, 0.0, 1.0)
+
+
+class SemSimulator:
+    """SharkSEM Simulator Server
+
+    Serves one client at a time. Control connection is on 'port', data
+    connection on 'port' + 1. Requests are executed in order, each one after
+    its wait conditions (wait flags) are satisfied. Images are streamed in
+    ScData messages of 'chunk' bytes at most 'bandwidth' bytes per second.
+    With probability 'resend' a packet is followed by a resend from an
+    earlier index, with probability 'loss' a packet is dropped and the data
+    are resent from the lost index after a few more packets.
+    """
+
+    def __init__(self, address = 'localhost', port = 8300, microscope = None,
+                 bandwidth = 20e6, chunk = 65536, resend = 0.0, loss = 0.0):
+        """ Constructor """
+        self.address = address
+        self.port = port
+        self.microscope = microscope or SimMicroscope()
+        self.bandwidth = bandwidth
+        self.chunk = chunk
+        self.resend = resend
+        self.loss = loss
+        self.socket_d = None
+        self.data_ready = threading.Event()
+        self.data_lock = threading.Lock()
+        self.scan_thread = None
+        self.running = False
+        self.listen_c = None
+        self.listen_d = None
+
+    def Start(self):
+        """ Start the server threads, returns immediately """
+        self.listen_c = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_c.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_c.bind((self.address, self.port))
+        self.listen_c.listen(1)
+        self.port = self.listen_c.getsockname()[1]      # port 0 = any free port
+        self.listen_d = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_d.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_d.bind((self.address, self.port + 1))
+        self.listen_d.listen(1)
+        self.running = True
+        for target in (self._ServeControl, self._ServeData):
+            t = threading.Thread(target = target)
+            t.daemon = True
+            t.start()
+
+    def Stop(self):
+        """ Stop the server """
+        self.running = False
+        self.microscope.scan_stop = True
+        for s in (self.listen_c, self.listen_d, self.socket_d):
+            try:
+                s.close()
+            except Exception:
+                pass
+
+    def Serve(self):
+        """ Run the server until interrupted """
+        self.Start()
+        try:
+            while True:
+                time.sleep(1.0)
+        except KeyboardInterrupt:
+            self.Stop()
+
+#
+# connections
+#
+
+    def _ServeData(self):
+        """ Accept data connections """
+        while self.running:
+            try:
+                s, addr = self.listen_d.accept()
+            except OSError:
+                return
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.data_lock:
+                self.socket_d = s
+            self.data_ready.set()
+
+    def _ServeControl(self):
+        """ Accept control connections, serve one client at a time """
+        while self.running:
+            try:
+                s, addr = self.listen_c.accept()
+            except OSError:
+                return
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                self._Session(s)
+            except (OSError, EOFError):
+                pass
+            finally:
+                s.close()
+                self.microscope.scan_stop = True
+                self.data_ready.clear()
+                with self.data_lock:
+                    if self.socket_d is not None:
+                        self.socket_d.close()
+                        self.socket_d = None
+
+    def _Recv(self, s, size):
+        """ Blocking receive - wait for all data """
+        buf = bytearray(size)
+        view = memoryview(buf)
+        received = 0
+        while received < size:
+            n = s.recv_into(view[received:], size - received)
+            if n == 0:
+                raise EOFError()
+            received = received + n
+        return bytes(buf)
+
+    def _Session(self, s):
+        """ Execute requests of one client """
+        while self.running:
+            hdr = self._Recv(s, 32)
+            name = hdr[0:16].split(b"\x00")[0].decode()
+            body_size, msg_id, flags, queue, resvd = struct.unpack_from("<IIHHI", hdr, 16)
+            body = self._Recv(s, body_size)
+            if name not in COMMANDS:
+                if flags & 1:
+                    s.sendall(self._Message(name, msg_id, queue, b""))
+                continue
+            in_types, out_types = COMMANDS[name]
+            args = Unpack(body, in_types)
+            while self.microscope.Busy(flags):           # wait flags
+                time.sleep(0.001)
+            if name == 'ScScanXY':
+                out = self._ScScanXY(*args)
+            elif name == 'ScStopScan':
+                out = self._ScStopScan()
+            else:
+                out = getattr(self.microscope, name)(*args)
+            if out_types or flags & 1:
+                s.sendall(self._Message(name, msg_id, queue, Pack(out or [], out_types)))
+
+    def _Message(self, name, msg_id, queue, body):
+        """ Build message (header + body) """
+        return struct.pack("<16sIIHHI", name.encode(), len(body), msg_id, 0, queue, 0) + body
+
+#
+# scanning
+#
+
+    def _ScScanXY(self, frameid, width, height, left, top, right, bottom, single):
+        m = self.microscope
+        if m.ScanBusy() or right < left or bottom < top or right >= width or bottom >= height:
+            return [-1]
+        npix = (right - left + 1) * (bottom - top + 1)
+        with m.lock:
+            state = m.BeamState()
+            if single:
+                m.scan_end = m.Now() + npix * m.DwellTime() * m.time_scale
+            else:
+                m.scan_end = float('inf')
+        m.scan_stop = False
+        prev = self.scan_thread
+        self.scan_thread = threading.Thread(target = self._Scan, args = (prev, state, frameid, width, height, left, top, right, bottom, single))
+        self.scan_thread.daemon = True
+        self.scan_thread.start()
+        return [0]
+
+    def _ScStopScan(self):
+        m = self.microscope
+        with m.lock:
+            if m.scan_end == float('inf'):          # continual scanning
+                m.scan_stop = True
+            m.scan_end = min(m.scan_end, m.Now())
+
+    def _Scan(self, prev, state, frameid, width, height, left, top, right, bottom, single):
+        """ Scanning thread - render images and stream them as ScData
+
+        The beam is busy (wait A) until the dwell time of the scan elapses,
+        the data transfer may finish later. Data of the previous scan are
+        sent first.
+        """
+        m = self.microscope
+        try:
+            if prev is not None:
+                prev.join()
+            if not self.data_ready.wait(5.0):
+                return
+            while not m.scan_stop:
+                npix = (right - left + 1) * (bottom - top + 1)
+                frames = []
+                for ch in sorted(m.channels):
+                    img = m.RenderImage(state, ch, width, height, left, top, right, bottom)
+                    bpp = m.channels[ch]
+                    if bpp == 16:
+                        data = (img * 65535).astype("<u2").tobytes()
+                    else:
+                        data = (img * 255).astype(numpy.uint8).tobytes()
+                    frames.append((ch, bpp, data))
+                if not frames:
+                    time.sleep(npix * m.DwellTime() * m.time_scale)
+                self._Stream(frameid, npix, frames)
+                if single:
+                    break
+        except OSError:
+            pass
+
+    def _Stream(self, frameid, npix, frames):
+        """ Send the frames in chunks, paced by dwell time and bandwidth """
+        m = self.microscope
+        t0 = time.time()
+        sent = 0
+        pos = {}                        # channel -> next pixel index
+        lost = {}                       # channel -> [lost index, packets to go]
+        for ch, bpp, data in frames:
+            pos[ch] = 0
+        while not m.scan_stop:
+            active = [f for f in frames if pos[f[0]] < npix or f[0] in lost]
+            if not active:
+                break
+            for ch, bpp, data in active:
+                if ch in lost and (lost[ch][1] == 0 or pos[ch] >= npix):
+                    pos[ch] = lost.pop(ch)[0]          # resend from the lost packet
+                bytes_pp = bpp // 8
+                index = pos[ch]
+                n = min(self.chunk // bytes_pp, npix - index)
+                packet = self._ScData(frameid, ch, index, bpp, data[index * bytes_pp:(index + n) * bytes_pp])
+                pos[ch] = index + n
+
+                if ch in lost:
+                    lost[ch][1] = lost[ch][1] - 1
+                elif random.random() < self.loss:
+                    lost[ch] = [index, 3]
+                    continue
+                elif random.random() < self.resend and index > 0:
+                    pos[ch] = random.randint(0, index)
+
+                # pacing - the scan itself and the network bandwidth
+                sent = sent + len(packet)
+                t = max(sent / self.bandwidth, (index + n) * m.DwellTime() * m.time_scale)
+                delay = t0 + t - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                with self.data_lock:
+                    if self.socket_d is None:
+                        return
+                    self.socket_d.sendall(packet)
+
+    def _ScData(self, frameid, channel, index, bpp, data):
+        """ Build ScData message """
+        l = (len(data) + 3) // 4 * 4
+        body = struct.pack("<IiIiI", frameid, channel, index, bpp, len(data)) + data + b"\x00" * (l - len(data))
+        return self._Message('ScData', 0, 0, body)
+
+
+#
+# argument marshaling (server side)
+#
+def Unpack(body, types):
+    """ Unpack input arguments, missing trailing arguments are omitted """
+    args = []
+    start = 0
+    for t in types:
+        if start >= len(body):
+            break
+        if t in (ArgType.Int, ArgType.UnsignedInt):
+            args.append(struct.unpack_from("<i" if t == ArgType.Int else "<I", body, start)[0])
+            start = start + 4
+        else:
+            l = struct.unpack_from("<I", body, start)[0]
+            s = body[start + 4:start + 4 + l].split(b"\x00")[0].decode()
+            args.append(float(s) if t == ArgType.Float else s)
+            start = start + 4 + l
+    return args
+
+
+def Pack(values, types):
+    """ Pack output arguments """
+    body = []
+    for t, v in zip(types, values):
+        if t == ArgType.Int:
+            body.append(struct.pack("<i", int(v)))
+        elif t == ArgType.UnsignedInt:
+            body.append(struct.pack("<I", int(v)))
+        else:
+            s = (repr(float(v)) if t == ArgType.Float else str(v)).encode()
+            l = (len(s) + 4) // 4 * 4
+            body.append(struct.pack("<I", l) + s.ljust(l, b"\x00"))
+    return b"".join(body)
+
+
+def main():
+    p = argparse.ArgumentParser(description = 'SharkSEM microscope simulator')
+    p.add_argument('--address', default = 'localhost')
+    p.add_argument('--port', type = int, default = 8300)
+    p.add_argument('--bandwidth', type = float, default = 20e6, help = 'data connection [bytes/s]')
+    p.add_argument('--chunk', type = int, default = 65536, help = 'ScData packet size [bytes]')
+    p.add_argument('--resend', type = float, default = 0.0, help = 'packet resend probability')
+    p.add_argument('--loss', type = float, default = 0.0, help = 'packet loss probability')
+    p.add_argument('--time-scale', type = float, default = 1.0, help = 'factor of all physical delays')
+    p.add_argument('--autowd-fail', type = float, default = 0.1, help = 'AutoWD failure rate')
+    p.add_argument('--drift', type = float, default = 0.0, help = 'focus drift [mm/h]')
+    a = p.parse_args()
+
+    m = SimMicroscope(time_scale = a.time_scale)
+    m.autowd_fail = a.autowd_fail
+    m.focus_drift = a.drift
+    sim = SemSimulator(a.address, a.port, m, a.bandwidth, a.chunk, a.resend, a.loss)
+    print('SharkSEM simulator listening on %s:%d (data %d)' % (a.address, a.port, a.port + 1))
+    sim.Serve()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,564 @@
+# -*- coding: utf-8 -*-
+################################################################################
+#Stage tour optimization.
+
+#The order in which the tiles are visited is planned with a stage travel
+#time model instead of a fixed serpentine. StageSpeedModel describes each
+#axis by velocity, acceleration (trapezoidal profile) and backlash penalty
+#on direction reversal, plus a common settle time. The axes move together,
+#so a move takes as long as the slowest axis. The model is fitted from timed
+#StgMoveTo / StgIsBusy runs (calibrate()).
+
+#plan_tour() orders an arbitrary set of tiles (irregular outlines, masked
+#regions, several samples) - nearest neighbour construction followed by
+#2-opt and Or-opt improvement restricted to k nearest neighbours, which
+#scales to 100k tiles. The heuristics charge the backlash where an axis
+#reverses between two consecutive moves, the serpentine of the grid ranks
+#is a second start tour and the result is never slower than it
+#(tour_time()). The result is an index array, apply it to the XML
+#point list (imagesnapper.py) or to the targets of TileAcquisition.
+
+#Units are SharkSEM units - mm, seconds.
+
+#Example:
+#    model = calibrate(m, x0=0.0, y0=0.0)
+#    order = plan_tour(pts, model)
+#    targets = [targets[i] for i in order]
+################################################################################
+
+from __future__ import print_function
+import math
+import time
+
+import numpy as np
+
+
+class StageSpeedModel:
+    """Stage travel time model.
+
+    speed       (vx, vy) maximum velocity [mm/s]
+    accel       (ax, ay) acceleration [mm/s^2]
+    settle      time added to every move [s] (settling, command latency)
+    backlash    (bx, by) extra time when the axis reverses direction [s]
+    """
+
+    def __init__(self, speed=(3.0, 3.0), accel=(10.0, 10.0), settle=0.2, backlash=(0.3, 0.3)):
+        self.speed = tuple(float(v) for v in speed)
+        self.accel = tuple(float(a) for a in accel)
+        self.settle = float(settle)
+        self.backlash = tuple(float(b) for b in backlash)
+
+    def __repr__(self):
+        return 'StageSpeedModel(speed=(%.4g, %.4g), accel=(%.4g, %.4g), settle=%.4g, backlash=(%.4g, %.4g))' % (
+            self.speed + self.accel + (self.settle,) + self.backlash)
+
+    def axis_time(self, d, axis):
+        """Travel time of one axis for distance(s) d (trapezoidal profile)."""
+        return _profile(np.abs(np.asarray(d, dtype=float)), self.speed[axis], self.accel[axis])
+
+    def cost(self, x0, y0, x1, y1):
+        """Move time between points (arrays), without backlash."""
+        t = np.maximum(self.axis_time(x1 - x0, 0), self.axis_time(y1 - y0, 1))
+        return np.where((x1 != x0) | (y1 != y0), t + self.settle, 0.0)
+
+    def scalar_cost(self):
+        """Fast scalar cost function c(x0, y0, x1, y1) for the tour heuristics."""
+        vx, vy = self.speed
+        ax, ay = self.accel
+        dx_acc = vx * vx / ax
+        dy_acc = vy * vy / ay
+        settle = self.settle
+        sqrt = math.sqrt
+
+        def c(x0, y0, x1, y1):
+            dx = abs(x1 - x0)
+            dy = abs(y1 - y0)
+            if dx == 0 and dy == 0:
+                return 0.0
+            tx = 2.0 * sqrt(dx / ax) if dx < dx_acc else dx / vx + vx / ax
+            ty = 2.0 * sqrt(dy / ay) if dy < dy_acc else dy / vy + vy / ay
+            return (tx if tx > ty else ty) + settle
+        return c
+
+    def scalar_reversal(self, xs, ys):
+        """Fast backlash penalty r(p, q, r) of tiles p, q, r (indices into xs,
+        ys, -1 = none) - charged at q when an axis reverses between the moves
+        p -> q and q -> r. Local version of the tour_time() backlash for the
+        tour heuristics (a move that keeps an axis still does not reset it
+        there)."""
+        bx, by = self.backlash
+
+        def r(p, q, n):
+            if p < 0 or n < 0:
+                return 0.0
+            t = 0.0
+            if (xs[q] - xs[p]) * (xs[n] - xs[q]) < 0:
+                t += bx
+            if (ys[q] - ys[p]) * (ys[n] - ys[q]) < 0:
+                t += by
+            return t
+        return r
+
+    def tour_time(self, pts, order, start=None):
+        """Total time of visiting pts in order, with backlash."""
+        p = np.asarray(pts, dtype=float)[order]
+        if start is not None:
+            p = np.vstack([np.asarray(start, dtype=float)[None, 0:2], p])
+        d = np.diff(p[:, 0:2], axis=0)
+        t = self.cost(p[:-1, 0], p[:-1, 1], p[1:, 0], p[1:, 1])
+        for axis in (0, 1):
+            s = np.sign(d[:, axis])
+            moving = s != 0
+            sm = s[moving]
+            rev = np.zeros(len(s), dtype=bool)
+            rev[np.flatnonzero(moving)[1:]] = sm[1:] != sm[:-1]
+            t = t + rev * self.backlash[axis]
+        return float(t.sum())
+
+
+def _profile(d, v, a):
+    """Trapezoidal (or triangular for short moves) velocity profile time."""
+    return np.where(d < v * v / a, 2.0 * np.sqrt(d / a), d / v + v / a)
+
+
+################################################################################
+# Calibration
+
+def time_moves(m, moves, poll=0.002):
+    """Execute StgMoveTo moves, measure each one by polling StgIsBusy.
+
+    moves   list of (x, y) targets [mm]
+    Returns list of (x0, y0, x1, y1, seconds).
+    """
+    old_flags = m.connection.wait_flags
+    m.SetWaitFlags(0)
+    out = []
+    try:
+        pos = m.StgGetPosition()
+        x0, y0 = pos[0], pos[1]
+        for x1, y1 in moves:
+            t0 = time.time()
+            m.StgMoveTo(x1, y1)
+            while m.StgIsBusy():
+                time.sleep(poll)
+            out.append((x0, y0, x1, y1, time.time() - t0))
+            x0, y0 = x1, y1
+    finally:
+        m.SetWaitFlags(old_flags)
+    return out
+
+
+def calibration_moves(x0, y0, distances=(0.02, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0), repeats=2):
+    """Single axis moves around (x0, y0) - every distance forward and back
+    (reversal) and twice in the same direction (no reversal), on each axis."""
+    moves = []
+    for axis in (0, 1):
+        for r in range(repeats):
+            for d in distances:
+                for step in (d, d, -d, -d):
+                    x, y = moves[-1] if moves else (x0, y0)
+                    if axis == 0:
+                        moves.append((x + step, y))
+                    else:
+                        moves.append((x, y + step))
+        moves.append((x0, y0))
+    return moves
+
+
+def fit_model(samples):
+    """Fit StageSpeedModel to timed single axis moves (see time_moves()).
+
+    Velocity and acceleration of each axis are found by a log-spaced grid
+    search, the constant time and the backlash penalty by linear least
+    squares for every grid node.
+    """
+    s = np.asarray(samples, dtype=float)
+    d = s[:, 2:4] - s[:, 0:2]
+    speed = []
+    accel = []
+    backlash = []
+    settle = []
+    vs = np.logspace(-2, 2, 81)
+    acs = np.logspace(-2, 3, 101)
+    for axis in (0, 1):
+        other = 1 - axis
+        mask = (d[:, axis] != 0) & (d[:, other] == 0)
+        idx = np.flatnonzero(d[:, axis] != 0)
+        sign = np.sign(d[idx, axis])
+        rev_all = np.zeros(len(idx), dtype=bool)
+        rev_all[1:] = sign[1:] != sign[:-1]             # reversal of this axis
+        rev = rev_all[mask[idx]]
+        dist = np.abs(d[mask, axis])
+        t = s[mask, 4]
+        if len(t) < 3:
+            raise ValueError('not enough moves of axis %d' % axis)
+        # f[v, a, i] for all grid nodes at once
+        V = vs[:, None, None]
+        A = acs[None, :, None]
+        f = np.where(dist < V * V / A, 2.0 * np.sqrt(dist / A), dist / V + V / A)
+        r = t[None, None, :] - f                        # = c + b * rev
+        nr = rev.sum()
+        nn = len(t) - nr
+        c = np.where(nn > 0, (r * ~rev).sum(axis=2) / max(nn, 1), 0.0)
+        b = np.where(nr > 0, (r * rev).sum(axis=2) / max(nr, 1) - c, 0.0)
+        sse = ((r - c[..., None] - b[..., None] * rev) ** 2).sum(axis=2)
+        i, j = np.unravel_index(np.argmin(sse), sse.shape)
+        speed.append(vs[i])
+        accel.append(acs[j])
+        settle.append(c[i, j])
+        backlash.append(max(b[i, j], 0.0))
+    return StageSpeedModel(speed, accel, max(np.mean(settle), 0.0), backlash)
+
+
+def calibrate(m, x0, y0, distances=(0.02, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0), repeats=2):
+    """Measure the stage around (x0, y0) and fit StageSpeedModel."""
+    samples = time_moves(m, calibration_moves(x0, y0, distances, repeats))
+    return fit_model(samples)
+
+
+################################################################################
+# Tour construction and improvement
+
+def knn(pts, k=8):
+    """k nearest neighbours of every point (grid buckets), (n x k) indices.
+
+    Rows are padded with -1 if there are fewer than k other points.
+    """
+    pts = np.asarray(pts, dtype=float)
+    n = len(pts)
+    out = -np.ones((n, k), dtype=np.int64)
+    if n < 2:
+        return out
+    span = np.ptp(pts, axis=0)
+    area = max(span[0], 1e-12) * max(span[1], 1e-12)
+    cell = max(np.sqrt(area * (k + 1) / n), 1e-12)
+    cx = np.floor((pts[:, 0] - pts[:, 0].min()) / cell).astype(np.int64)
+    cy = np.floor((pts[:, 1] - pts[:, 1].min()) / cell).astype(np.int64)
+    key = cx * (cy.max() + 3) + cy
+    order = np.argsort(key, kind='stable')
+    keys, starts, counts = np.unique(key[order], return_index=True, return_counts=True)
+    buckets = dict((int(kk), order[s:s + c]) for kk, s, c in zip(keys, starts, counts))
+    ny = cy.max() + 3
+    for kk, members in buckets.items():
+        i0, j0 = divmod(kk, ny)
+        r = 1
+        while True:
+            cand = [buckets[(i0 + di) * ny + (j0 + dj)]
+                    for di in range(-r, r + 1) for dj in range(-r, r + 1)
+                    if (i0 + di) * ny + (j0 + dj) in buckets and 0 <= j0 + dj < ny]
+            cand = np.concatenate(cand)
+            if len(cand) > k or len(cand) == n or r > 64:
+                break
+            r = r + 1
+        dd = np.hypot(pts[members, 0][:, None] - pts[cand, 0][None, :],
+                      pts[members, 1][:, None] - pts[cand, 1][None, :])
+        dd[members[:, None] == cand[None, :]] = np.inf
+        kk_ = min(k, len(cand) - 1)
+        part = np.argsort(dd, axis=1)[:, 0:kk_]
+        out[members, 0:kk_] = cand[part]
+    return out
+
+
+def nearest_neighbour_tour(pts, model, start=None, neigh=None):
+    """Greedy tour - always go to the cheapest of the nearby unvisited tiles.
+
+    Nearby tiles come from the k nearest neighbour lists, if all of them are
+    visited the closest unvisited tile is searched in grid buckets.
+    """
+    pts = np.asarray(pts, dtype=float)
+    n = len(pts)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    cost = model.scalar_cost()
+    if neigh is None:
+        neigh = knn(pts, 8)
+    xs = pts[:, 0].tolist()
+    ys = pts[:, 1].tolist()
+    rev = model.scalar_reversal(xs, ys)
+    span = np.ptp(pts, axis=0)
+    cell = max(np.sqrt(max(span[0], 1e-12) * max(span[1], 1e-12) / n) * 2, 1e-12)
+    origin = pts.min(axis=0)
+    cells = {}
+    cidx = np.floor((pts - origin) / cell).astype(np.int64)
+    for i, (a, b) in enumerate(cidx.tolist()):
+        cells.setdefault((a, b), set()).add(i)
+    visited = np.zeros(n, dtype=bool)
+
+    if start is None:
+        cur = 0
+    else:
+        cur = int(np.argmin(np.hypot(pts[:, 0] - start[0], pts[:, 1] - start[1])))
+    tour = [cur]
+    visited[cur] = True
+    cells[tuple(cidx[cur])].discard(cur)
+    last = -1
+    for step in range(n - 1):
+        best = -1
+        best_c = np.inf
+        for j in neigh[cur]:
+            if j >= 0 and not visited[j]:
+                c = cost(xs[cur], ys[cur], xs[j], ys[j]) + rev(last, cur, j)
+                if c < best_c:
+                    best, best_c = j, c
+        if best < 0:                            # search the buckets
+            a0, b0 = cidx[cur]
+            r = 0
+            found = False
+            while not found or r <= found_r + 1:
+                for a in range(a0 - r, a0 + r + 1):
+                    for b in range(b0 - r, b0 + r + 1):
+                        if max(abs(a - a0), abs(b - b0)) != r:
+                            continue
+                        for j in cells.get((a, b), ()):
+                            c = cost(xs[cur], ys[cur], xs[j], ys[j]) + rev(last, cur, j)
+                            if c < best_c:
+                                best, best_c = j, c
+                if best >= 0 and not found:
+                    found = True
+                    found_r = r
+                r = r + 1
+        last, cur = cur, best
+        visited[cur] = True
+        cells[tuple(cidx[cur])].discard(cur)
+        tour.append(cur)
+    return np.array(tour, dtype=np.int64)
+
+
+def two_opt(tour, pts, model, neigh, max_passes=20):
+    """2-opt improvement of an open path, moves restricted to neighbours."""
+    tour = np.array(tour, dtype=np.int64)
+    n = len(tour)
+    if n < 4:
+        return tour
+    cost = model.scalar_cost()
+    xs = pts[:, 0].tolist()
+    ys = pts[:, 1].tolist()
+    pos = np.empty(n, dtype=np.int64)
+    pos[tour] = np.arange(n)
+    nl = neigh.tolist()
+
+    def c(a, b):
+        return cost(xs[a], ys[a], xs[b], ys[b])
+
+    rev = model.scalar_reversal(xs, ys)
+
+    def t(k):
+        return int(tour[k]) if 0 <= k < n else -1
+
+    def reversal_delta(lo, hi):
+        """Backlash change of reversing tour[lo..hi] - only the four tiles
+        at the two junctions change (inside the segment every reversal
+        stays one)."""
+        a0, a1, a2 = t(lo - 2), t(lo - 1), t(lo)
+        b0, b1, b2 = t(hi - 1), t(hi), t(hi + 1)
+        c2 = t(lo + 1)
+        d2 = t(hi + 2)
+        if a1 >= 0:
+            before = rev(a0, a1, a2)
+            after = rev(a0, a1, b1)
+        else:
+            before = after = 0.0
+        before += rev(a1, a2, c2) + rev(b0, b1, b2) + (rev(b1, b2, d2) if b2 >= 0 else 0.0)
+        after += rev(a1, b1, b0) + rev(c2, a2, b2) + (rev(a2, b2, d2) if b2 >= 0 else 0.0)
+        return after - before
+
+    for p in range(max_passes):
+        improved = False
+        for i in range(n - 1):
+            a = int(tour[i])
+            b = int(tour[i + 1])
+            cab = c(a, b)
+            for cc in nl[a]:
+                if cc < 0:
+                    continue
+                j = int(pos[cc])
+                if j <= i + 1:
+                    # edge (d, c) before i - reverse t[j..i]: (d,c),(a,b) -> (d,a),(c,b)
+                    if j == 0 or j >= i:
+                        continue
+                    d = int(tour[j - 1])
+                    delta = c(d, a) + c(cc, b) - c(d, cc) - cab
+                    if delta < -1e-12:
+                        delta += reversal_delta(j, i)
+                    if delta < -1e-12:
+                        tour[j:i + 1] = tour[j:i + 1][::-1].copy()
+                        pos[tour[j:i + 1]] = np.arange(j, i + 1)
+                        improved = True
+                        break
+                    continue
+                # edges (a, b), (c, d) - reverse t[i+1..j]: (a,c),(b,d)
+                if j + 1 < n:
+                    d = int(tour[j + 1])
+                    delta = c(a, cc) + c(b, d) - cab - c(cc, d)
+                else:
+                    delta = c(a, cc) - cab                  # c is the path end
+                if delta < -1e-12:
+                    delta += reversal_delta(i + 1, j)
+                if delta < -1e-12:
+                    tour[i + 1:j + 1] = tour[i + 1:j + 1][::-1].copy()
+                    pos[tour[i + 1:j + 1]] = np.arange(i + 1, j + 1)
+                    improved = True
+                    break
+        if not improved:
+            break
+    return tour
+
+
+def or_opt(tour, pts, model, neigh, max_passes=10, max_len=3):
+    """Or-opt improvement - move segments of 1..max_len tiles elsewhere.
+
+    The path is kept as a doubly linked list, a move is O(1). The first
+    tile stays in place.
+    """
+    tour = np.asarray(tour, dtype=np.int64)
+    n = len(tour)
+    if n < 5:
+        return tour.copy()
+    cost = model.scalar_cost()
+    xs = pts[:, 0].tolist()
+    ys = pts[:, 1].tolist()
+    nl = neigh.tolist()
+    nxt = [-1] * n
+    prv = [-1] * n
+    t = tour.tolist()
+    for a, b in zip(t[:-1], t[1:]):
+        nxt[a] = b
+        prv[b] = a
+    head = t[0]
+
+    def c(a, b):
+        if a < 0 or b < 0:
+            return 0.0                                  # open path end
+        return cost(xs[a], ys[a], xs[b], ys[b])
+
+    reversal = model.scalar_reversal(xs, ys)
+
+    def move_delta(prev, after, cc, dn, order):
+        """Backlash change of moving the segment 'order' between cc and dn -
+        only the tiles whose links change are charged again."""
+        n2 = {prev: after, cc: order[0], order[-1]: dn}
+        p2 = {after: prev, order[0]: cc, dn: order[-1]}
+        for a, b in zip(order[:-1], order[1:]):
+            n2[a] = b
+            p2[b] = a
+        delta = 0.0
+        for v in set(n2) | set(p2):
+            if v >= 0:
+                delta += reversal(p2.get(v, prv[v]), v, n2.get(v, nxt[v])) - reversal(prv[v], v, nxt[v])
+        return delta
+
+    for p in range(max_passes):
+        improved = False
+        s0 = nxt[head]
+        while s0 >= 0:
+            moved = False
+            seg = [s0]
+            for L in range(1, max_len + 1):
+                if L > 1:
+                    if nxt[seg[-1]] < 0:
+                        break
+                    seg.append(nxt[seg[-1]])
+                s1 = seg[-1]
+                prev = prv[s0]
+                after = nxt[s1]
+                removed = c(prev, s0) + c(s1, after) - c(prev, after)
+                best = None
+                for cc in nl[s0] + nl[s1]:
+                    if cc < 0 or cc == prev or cc in seg:
+                        continue
+                    dn = nxt[cc]
+                    base = c(cc, dn)
+                    for first, last in ((s0, s1), (s1, s0)):
+                        gain = removed - (c(cc, first) + c(last, dn) - base)
+                        if gain > 1e-12:
+                            gain -= move_delta(prev, after, cc, dn, seg if first == s0 else seg[::-1])
+                        if gain > 1e-12 and (best is None or gain > best[0]):
+                            best = (gain, cc, first != s0)
+                if best is None:
+                    continue
+                gain, cc, rev = best
+                nxt[prev] = after                       # unlink
+                if after >= 0:
+                    prv[after] = prev
+                order = seg[::-1] if rev else seg
+                dn = nxt[cc]
+                nxt[cc] = order[0]                      # link after cc
+                prv[order[0]] = cc
+                for a, b in zip(order[:-1], order[1:]):
+                    nxt[a] = b
+                    prv[b] = a
+                nxt[order[-1]] = dn
+                if dn >= 0:
+                    prv[dn] = order[-1]
+                improved = moved = True
+                s0 = after if after >= 0 else -1
+                break
+            if not moved:
+                s0 = nxt[s0]
+        if not improved:
+            break
+    out = []
+    a = head
+    while a >= 0:
+        out.append(a)
+        a = nxt[a]
+    return np.array(out, dtype=np.int64)
+
+
+def plan_tour(pts, model=None, start=None, k=8, passes=20, or_passes=3, verbose=False):
+    """Order tiles for minimum stage travel time.
+
+    pts     (n x 2) tile positions [mm]
+    model   StageSpeedModel (default parameters if None)
+    start   current stage position, the tour starts at the closest tile
+    Returns index array - visit pts[order[0]], pts[order[1]], ...
+    """
+    pts = np.asarray(pts, dtype=float)[:, 0:2]
+    if model is None:
+        model = StageSpeedModel()
+    if len(pts) < 2:
+        return np.arange(len(pts))
+    t0 = time.time()
+    neigh = knn(pts, k)
+    serp = serpentine_order(grid_index(pts))
+    if start is not None and np.hypot(*(pts[serp[-1]] - start[0:2])) < np.hypot(*(pts[serp[0]] - start[0:2])):
+        serp = serp[::-1].copy()
+    t_serp = model.tour_time(pts, serp, start)
+    tour = nearest_neighbour_tour(pts, model, start, neigh)
+    t_nn = model.tour_time(pts, tour, start)
+    if verbose:
+        print('nearest neighbour: %.1f s, serpentine: %.1f s (%.2f s)' % (t_nn, t_serp, time.time() - t0))
+    if t_serp <= t_nn:
+        tour = serp.copy()
+    tour = two_opt(tour, pts, model, neigh, passes)
+    if verbose:
+        print('2-opt: %.1f s (%.2f s)' % (model.tour_time(pts, tour, start), time.time() - t0))
+    if or_passes:
+        tour = or_opt(tour, pts, model, neigh, or_passes)
+        tour = two_opt(tour, pts, model, neigh, passes)
+        if verbose:
+            print('Or-opt: %.1f s (%.2f s)' % (model.tour_time(pts, tour, start), time.time() - t0))
+    # the heuristics see the backlash only locally, keep the serpentine if faster
+    if model.tour_time(pts, tour, start) > t_serp:
+        tour = serp
+    return tour
+
+
+def grid_index(pts, decimals=6):
+    """(column, row) 1-based ranks of the x, y of the points (regular grid)."""
+    pts = np.asarray(pts, dtype=float)
+    cols = np.unique(np.round(pts[:, 0], decimals), return_inverse=True)[1].reshape(-1)
+    rows = np.unique(np.round(pts[:, 1], decimals), return_inverse=True)[1].reshape(-1)
+    return np.column_stack([cols + 1, rows + 1])
+
+
+def serpentine_order(coordn):
+    """Order of TescanImageSnapper.m - row by row, every other row reversed.
+
+    coordn  (n x 2) 1-based (column, row) grid indices
+    """
+    coordn = np.asarray(coordn)
+    col = coordn[:, 0].astype(np.int64)
+    row = coordn[:, 1].astype(np.int64)
+    key = np.where(row % 2 == 1, col, -col)
+    return np.lexsort((key, row))
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+################################################################################
+#Reading of the Tescan .hdr sidecar files.
+
+#A .hdr file is a small text file with "key=value" lines, grouped into
+#[MAIN], [SEM], ... sections. Values are in SI units (WD, StageX, StageY
+#in meters). Each file is read once and all the requested keys are taken
+#in a single regular expression pass. Many files are read in parallel.
+################################################################################
+
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+_LINE = re.compile(r'^\s*([^=\[\];#\s][^=]*?)\s*=\s*(.*?)\s*$', re.M)
+
+
+def _pattern(keys):
+    """Regular expression matching "key=value" lines of the given keys."""
+    names = '|'.join(re.escape(k) for k in keys)
+    return re.compile(r'^\s*(%s)\s*=\s*(.*?)\s*$' % names, re.M)
+
+
+def parse_hdr(text, keys=None):
+    """Parse .hdr text, returns dict key -> value (strings).
+
+    keys    list of keys to extract, None = all. First occurrence wins.
+    """
+    pattern = _LINE if keys is None else _pattern(keys)
+    d = {}
+    for k, v in pattern.findall(text):
+        if k not in d:
+            d[k] = v
+    return d
+
+
+def read_hdr(path, keys=None):
+    """Read .hdr file, see parse_hdr()."""
+    with open(path, 'rb') as f:
+        text = f.read().decode('latin-1')
+    return parse_hdr(text, keys)
+
+
+def _read_chunk(args):
+    """Worker - read several files, returns list of dicts."""
+    paths, keys = args
+    out = []
+    for p in paths:
+        try:
+            out.append(read_hdr(p, keys))
+        except (IOError, OSError):
+            out.append(None)
+    return out
+
+
+def read_hdrs(paths, keys=None, workers=None, processes=True, chunk=256):
+    """Read many .hdr files in parallel, returns list of dicts (None if the
+    file could not be read), in the order of 'paths'.
+
+    processes   use a process pool (parsing bound), otherwise threads
+    """
+    paths = list(paths)
+    if len(paths) <= chunk:
+        return _read_chunk((paths, keys))
+    jobs = [(paths[i:i + chunk], keys) for i in range(0, len(paths), chunk)]
+    pool = ProcessPoolExecutor(workers) if processes else ThreadPoolExecutor(workers or 8)
+    with pool:
+        out = []
+        for part in pool.map(_read_chunk, jobs):
+            out.extend(part)
+    return out
+
+
+def find_hdrs(directory, recursive=False):
+    """List .hdr files in a directory (sorted, as Matlab dir())."""
+    if not recursive:
+        return sorted(os.path.join(directory, n) for n in os.listdir(directory) if n.endswith('hdr'))
+    out = []
+    for root, dirs, files in os.walk(directory):
+        out.extend(os.path.join(root, n) for n in files if n.endswith('hdr'))
+    return sorted(out)
+
+
+def hdr_columns(records, keys, dtype=float):
+    """Convert list of dicts from read_hdrs() into arrays, one per key.
+
+    Missing values (or unreadable files) become NaN.
+    """
+    cols = []
+    for k in keys:
+        col = np.full(len(records), np.nan)
+        for i, r in enumerate(records):
+            if r is not None and k in r:
+                try:
+                    col[i] = dtype(r[k])
+                except ValueError:
+                    pass
+        cols.append(col)
+    return cols
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+################################################################################
+#Direct tile acquisition through SharkSEM, without ImageSnapper.
+
+#TileAcquisition takes a list of (x, y, WD) targets (stage position in mm,
+#working distance in mm) and acquires one image per target. The work runs
+#as a three-stage pipeline:
+
+#  1) control - the requests for tile N+1 (StgMoveTo, SetWD) are queued in
+#     the microscope right behind the scan of tile N, guarded by the wait
+#     flags, so the stage starts moving the moment the beam has finished
+#  2) receiver - a thread reads the pixels of tile N from the data
+#     connection while the stage is already travelling
+#  3) writers - a pool of threads saves tile N-1 to disk (image plus a
+#     Tescan-like .hdr sidecar with WD and stage position in meters)
+
+#Autofocus is not used, the WD of each tile comes from the focus map. See
+#README for the workflow.
+
+#Example:
+#    m = sem.Sem()
+#    m.Connect('localhost', 8300)
+#    acq = TileAcquisition(m, 'HighRes', width = 1536, height = 1536)
+#    records = acq.run([(x0, y0, wd0), (x1, y1, wd1), ...])
+################################################################################
+
+from __future__ import print_function
+import os
+import sys
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'remote'))
+import sem
+import numpy as np
+
+# SharkSEM wait flags (see Sem.SetWaitFlags)
+WAIT_SCAN = 1           # A - e-beam scanning
+WAIT_STAGE = 2          # B - stage
+WAIT_OPTICS = 4         # C - e-beam optics
+WAIT_AUTO = 8           # D - e-beam automatic procedure
+
+
+def save_image(path, img):
+    """Save image array, format given by the extension.
+
+    .npy is written by numpy, other formats (tif, png, jpg, ...) need Pillow.
+    """
+    if path.endswith('.npy'):
+        np.save(path, img)
+        return
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ImportError('Pillow is required to write %s, use ext="npy" otherwise' % path)
+    Image.fromarray(img).save(path)
+
+
+def load_image(path):
+    """Load image saved by save_image() (or any image Pillow can read)."""
+    if path.endswith('.npy'):
+        return np.load(path)
+    from PIL import Image
+    return np.asarray(Image.open(path))
+
+
+def write_hdr(path, record, pixel_size):
+    """Write Tescan-like .hdr sidecar of an acquired tile (SI units)."""
+    lines = ['[MAIN]',
+             'Date=%s' % time.strftime('%Y-%m-%d', time.localtime(record['t_scan'])),
+             'Time=%s' % time.strftime('%H:%M:%S', time.localtime(record['t_scan'])),
+             'PixelSizeX=%.9e' % pixel_size,
+             'PixelSizeY=%.9e' % pixel_size,
+             '[SEM]',
+             'WD=%.9e' % (record['wd'] * 1e-3),
+             'StageX=%.9e' % (record['x'] * 1e-3),
+             'StageY=%.9e' % (record['y'] * 1e-3),
+             'FrameId=%d' % record['frame']]
+    if record.get('shift') is not None:
+        lines += ['ImageShiftX=%.9e' % (record['shift'][0] * 1e-3),
+                  'ImageShiftY=%.9e' % (record['shift'][1] * 1e-3)]
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+class TileAcquisition:
+    """Pipelined tile acquisition engine.
+
+    m           connected sem.Sem
+    out_dir     output directory, tiles are written as <name>.<ext> (or
+                <name>_ch<channel>.<ext> if several channels are acquired)
+    width       image size in pixels
+    height
+    channels    input video channels, enabled by the caller (DtEnable)
+    view_field  view field in mm, None = keep the current one
+    ext         image format - npy, tif, png, ...
+    writers     number of writer threads
+    """
+
+    def __init__(self, m, out_dir, width=1536, height=1536, channels=(0,),
+                 view_field=None, ext='tif', writers=4):
+        self.m = m
+        self.out_dir = out_dir
+        self.width = width
+        self.height = height
+        self.channels = list(channels)
+        self.view_field = view_field
+        self.ext = ext
+        self.writers = writers
+        self.frame = 0                  # last used frame id
+        self.lock = threading.Lock()
+        self.error = None
+
+    def tile_name(self, index, target):
+        """Name of the tile - the 4th item of the target or its index."""
+        if len(target) > 3 and target[3] is not None:
+            return str(target[3])
+        return '%06d' % index
+
+    def tile_wd(self, record):
+        """WD used for the tile [mm]. Hook for on-the-fly corrections."""
+        return record['wd']
+
+    def tile_done(self, record):
+        """Called from a writer thread when the tile is on disk. Hook."""
+        pass
+
+    def stage_position(self, record):
+        """Stage position (x, y) for the tile [mm]. Hook - the stage is not
+        moved between tiles with the same position."""
+        return record['x'], record['y']
+
+    def tile_setup(self, record):
+        """Called in the control stage before tile_wd(), requests sent here
+        run after the previous scan. Hook for beam settings."""
+        pass
+
+    def tile_started(self, record):
+        """Called in the control stage right after the scan of the tile was
+        started (wait flags scan + stage + optics). Hook."""
+        pass
+
+    def run(self, targets, callback=None):
+        """Acquire all the targets, returns list of tile records.
+
+        Each record is a dict with name, index, x, y, wd (used), wd_plan,
+        frame, files, hdr and timestamps t_scan (scan started) and t_done (written). 'callback',
+        if given, is called with each record from a writer thread.
+        """
+        m = self.m
+        if not os.path.isdir(self.out_dir):
+            os.makedirs(self.out_dir)
+        if self.view_field is not None:
+            m.SetViewField(self.view_field)
+        self.pixel_size = (self.view_field or m.GetViewField()) * 1e-3 / self.width
+        self.callback = callback
+        self.error = None
+
+        records = []
+        for i, t in enumerate(targets):
+            records.append({'index': i, 'name': self.tile_name(i, t),
+                            'x': float(t[0]), 'y': float(t[1]), 'wd': float(t[2]), 'wd_plan': float(t[2]),
+                            'frame': None, 'files': [], 'hdr': None, 't_scan': None, 't_done': None})
+        if not records:
+            return []
+
+        old_flags = m.connection.wait_flags
+        pool = ThreadPoolExecutor(self.writers)
+        pending = threading.Semaphore(2 * self.writers)     # bounds memory
+        scanned = queue.Queue()
+        receiver = threading.Thread(target=self._receive, args=(scanned, pool, pending))
+        receiver.daemon = True
+        try:
+            m.SetWaitFlags(0)
+            m.StgMoveTo(*self.stage_position(records[0]))
+            receiver.start()
+            for i, r in enumerate(records):
+                if self.error is not None:
+                    break
+                if self._scan(r, records[i + 1] if i + 1 < len(records) else None):
+                    scanned.put(r)
+            scanned.put(None)
+            receiver.join()
+        finally:
+            pool.shutdown(wait=True)
+            m.SetWaitFlags(old_flags)
+        if self.error is not None:
+            raise self.error
+        return records
+
+    def _scan(self, r, next_r):
+        """Control stage - scan tile r, queue the move to next_r.
+
+        Returns False if the scan could not be started.
+        """
+        m = self.m
+        with self.lock:
+            self.frame = self.frame % 0xffffffff + 1
+            r['frame'] = self.frame
+        m.SetWaitFlags(WAIT_SCAN)                       # after previous scan
+        self.tile_setup(r)
+        r['wd'] = self.tile_wd(r)
+        m.SetWD(r['wd'])
+        m.SetWaitFlags(WAIT_SCAN | WAIT_STAGE | WAIT_OPTICS)
+        res = m.ScScanXY(r['frame'], self.width, self.height, 0, 0, self.width - 1, self.height - 1, 1)
+        r['t_scan'] = time.time()
+        if res is None or res < 0:
+            self.error = RuntimeError('ScScanXY failed for tile %s' % r['name'])
+            return False
+        self.tile_started(r)
+        m.SetWaitFlags(WAIT_SCAN)                       # executed when the beam is done
+        m.ScStopScan()
+        if next_r is not None:
+            pos = self.stage_position(next_r)
+            if pos != self.stage_position(r):
+                m.StgMoveTo(*pos)
+        return True
+
+    def _receive(self, scanned, pool, pending):
+        """Receiver stage - read the frames in order, hand them to writers."""
+        m = self.m
+        try:
+            while True:
+                r = scanned.get()
+                if r is None:
+                    return
+                imgs = m.FetchImages(self.channels, self.width, self.height, r['frame'])
+                pending.acquire()
+                pool.submit(self._write, r, imgs, pending)
+        except Exception as e:
+            self.error = e
+
+    def _write(self, r, imgs, pending):
+        """Writer stage - save the tile and its .hdr sidecar."""
+        try:
+            files = []
+            for ch in self.channels:
+                if len(self.channels) == 1:
+                    name = '%s.%s' % (r['name'], self.ext)
+                else:
+                    name = '%s_ch%d.%s' % (r['name'], ch, self.ext)
+                path = os.path.join(self.out_dir, name)
+                save_image(path, imgs[ch])
+                files.append(path)
+            hdr = os.path.join(self.out_dir, '%s-%s.hdr' % (r['name'], self.ext))
+            write_hdr(hdr, r, self.pixel_size)
+            r['files'] = files
+            r['hdr'] = hdr
+            r['t_done'] = time.time()
+            self.tile_done(r)
+            if self.callback is not None:
+                self.callback(r)
+        except Exception as e:
+            self.error = e
+        finally:
+            pending.release()
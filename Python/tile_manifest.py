@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+################################################################################
+#Tile manifest and reorganisation.
+
+#Replacement of the rename step of ShellScripts/TescanRenameFilesMontage.sh.
+#The acquisition tree is scanned once (directories listed in parallel),
+#tiles are found as
+#    <col>_<row>/Snap_<k>.<ext> + Snap_<k>-<ext>.hdr    (ImageSnapper)
+#    <col>_<row>.<ext> + <col>_<row>-<ext>.hdr          (renamed)
+#and their .hdr metadata is read in parallel (tescan_hdr.py). The result
+#is a manifest - one CSV line per tile with grid index, stage X/Y/Z, WD
+#(strings exactly as in the .hdr, SI units), file path, size and mtime.
+#Stitching, pyramids and QA read the manifest instead of listing the
+#directories again (e.g. mosaic.py accepts it in place of the directory).
+
+#A tile found more than once (re-shot in ImageSnapper - Snap_2, or both
+#renamed and not) is a duplicate, the newest file is used. Missing tiles
+#are the holes in the grid, or the samples of an ImageSnapper project that
+#have no tile.
+
+#flatten() moves, hard-links or copies the tiles into one directory with
+#the names the shell script produces.
+
+#Example:
+#    python tile_manifest.py D:\Data\HighRes tif --flatten D:\Data\Flat
+################################################################################
+
+from __future__ import print_function
+import argparse
+import csv
+import os
+import re
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from tescan_hdr import read_hdrs
+
+_NAME = re.compile(r'^(\d+)_(\d+)$')
+_SNAP = re.compile(r'^Snap_(\d+)$')
+
+HDR_KEYS = ('StageX', 'StageY', 'StageZ', 'WD')
+COLUMNS = ('name', 'col', 'row', 'x', 'y', 'z', 'wd', 'size', 'mtime', 'path', 'hdr')
+_HDR_COLUMNS = ('x', 'y', 'z', 'wd')           # values of HDR_KEYS
+
+
+def _list(path):
+    """One directory - (files [(name, size, mtime)], subdirectories)."""
+    files = []
+    dirs = []
+    try:
+        for e in os.scandir(path):
+            if e.is_dir(follow_symlinks=False):
+                dirs.append(e.path)
+            elif e.is_file():
+                st = e.stat()
+                files.append((e.name, st.st_size, st.st_mtime))
+    except OSError:
+        pass
+    return path, files, dirs
+
+
+def scan_tree(root, workers=16):
+    """List the whole tree, directories in parallel.
+
+    Returns dict directory -> list of (file name, size, mtime).
+    """
+    out = {}
+    with ThreadPoolExecutor(workers) as pool:
+        todo = [pool.submit(_list, root)]
+        while todo:
+            f = todo.pop()
+            path, files, dirs = f.result()
+            out[path] = files
+            todo.extend(pool.submit(_list, d) for d in dirs)
+    return out
+
+
+def find_tile_files(tree, ext):
+    """Tiles in a scanned tree, list of dicts (name, col, row, path, hdr,
+    size, mtime, snap), duplicates included."""
+    suffix = '.' + ext
+    tiles = []
+    for d, files in tree.items():
+        names = set(n for n, s, t in files)
+        dname = os.path.basename(d)
+        in_sample = _NAME.match(dname)
+        for n, size, mtime in files:
+            if not n.endswith(suffix):
+                continue
+            base = n[:-len(suffix)]
+            m = _NAME.match(base)
+            snap = 0
+            if m is None and in_sample:
+                s = _SNAP.match(base)
+                if s is None:
+                    continue
+                m = in_sample
+                snap = int(s.group(1))
+            elif m is None:
+                continue
+            hdr = '%s-%s.hdr' % (base, ext)
+            tiles.append({'name': '%s_%s' % m.groups(), 'col': int(m.group(1)), 'row': int(m.group(2)),
+                          'path': os.path.join(d, n),
+                          'hdr': os.path.join(d, hdr) if hdr in names else '',
+                          'size': size, 'mtime': mtime, 'snap': snap})
+    return tiles
+
+
+def build_manifest(root, ext, expected=None, workers=16, verbose=True):
+    """Scan the tree and read the .hdr files.
+
+    expected    names of the tiles that should exist (e.g. from the
+                ImageSnapper project), default the full grid box
+    Returns (tiles, duplicates, missing) - tiles is a list of dicts sorted
+    by (row, col) with the COLUMNS keys, duplicates the list of the
+    replaced tile dicts.
+    """
+    tree = scan_tree(root, workers)
+    found = find_tile_files(tree, ext)
+    best = {}
+    duplicates = []
+    for t in sorted(found, key=lambda t: (t['mtime'], t['snap'])):
+        if t['name'] in best:
+            duplicates.append(best[t['name']])
+        best[t['name']] = t                         # newest wins
+    tiles = sorted(best.values(), key=lambda t: (t['row'], t['col']))
+    hdrs = read_hdrs([t['hdr'] for t in tiles if t['hdr']], HDR_KEYS)
+    it = iter(hdrs)
+    for t in tiles:
+        h = (next(it) or {}) if t['hdr'] else {}
+        t['x'], t['y'], t['z'], t['wd'] = (h.get(k, '') for k in HDR_KEYS)
+    if expected is None and tiles:
+        cols = [t['col'] for t in tiles]
+        rows = [t['row'] for t in tiles]
+        w = len(tiles[0]['name'].split('_')[0])
+        h = len(tiles[0]['name'].split('_')[1])
+        expected = ['%0*d_%0*d' % (w, c, h, r) for r in range(min(rows), max(rows) + 1)
+                    for c in range(min(cols), max(cols) + 1)]
+    have = set(best)
+    missing = [n for n in (expected or []) if n not in have]
+    if verbose:
+        print('%d tiles, %d duplicates, %d missing, %d without .hdr' % (
+            len(tiles), len(duplicates), len(missing), sum(1 for t in tiles if not t['hdr'])))
+    return tiles, duplicates, missing
+
+
+def write_manifest(path, tiles):
+    """Write the manifest CSV."""
+    with open(path + '.tmp', 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(COLUMNS)
+        for t in tiles:
+            w.writerow([t['name'], t['col'], t['row'], t['x'], t['y'], t['z'], t['wd'],
+                        t['size'], '%.6f' % t['mtime'], t['path'], t['hdr']])
+    os.replace(path + '.tmp', path)
+
+
+def read_manifest(path, strings=False):
+    """Read the manifest, returns dict column -> numpy array.
+
+    x, y, z, wd are float arrays (NaN where the .hdr had no value), or the
+    exact strings if strings=True.
+    """
+    with open(path, newline='') as f:
+        rows = list(csv.reader(f))
+    header = rows[0]
+    cols = dict((k, [r[i] for r in rows[1:]]) for i, k in enumerate(header))
+    out = {}
+    for k, v in cols.items():
+        if k in ('col', 'row', 'size'):
+            out[k] = np.array(v, dtype=np.int64)
+        elif k == 'mtime' or (k in _HDR_COLUMNS and not strings):
+            out[k] = np.array([float(s) if s else np.nan for s in v])
+        else:
+            out[k] = np.array(v, dtype=object)
+    return out
+
+
+def manifest_tiles(path):
+    """(name, image path, hdr path) list of a manifest, as mosaic.find_tiles."""
+    m = read_manifest(path, strings=True)
+    return list(zip(m['name'], m['path'], m['hdr']))
+
+
+def _place(args):
+    src, dst, mode = args
+    if not src or src == dst:
+        return dst
+    if os.path.exists(dst):
+        os.remove(dst)
+    if mode == 'move':
+        os.rename(src, dst)
+    elif mode == 'link':
+        os.link(src, dst)
+    else:
+        shutil.copy2(src, dst)
+    return dst
+
+
+def flatten(tiles, dest, ext, mode='link', workers=16):
+    """Put the tiles into dest as <col>_<row>.<ext> + <col>_<row>-<ext>.hdr.
+
+    mode    'link' (hard link, same file system), 'move' or 'copy'
+    Returns the tiles with updated path and hdr. Sample directories left
+    empty by 'move' are removed.
+    """
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    jobs = []
+    out = []
+    for t in tiles:
+        t = dict(t)
+        img = os.path.join(dest, '%s.%s' % (t['name'], ext))
+        hdr = os.path.join(dest, '%s-%s.hdr' % (t['name'], ext)) if t['hdr'] else ''
+        jobs.append((t['path'], img, mode))
+        if hdr:
+            jobs.append((t['hdr'], hdr, mode))
+        t['path'], t['hdr'] = img, hdr
+        out.append(t)
+    old_dirs = set(os.path.dirname(t['path']) for t in tiles)
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(_place, jobs))
+    if mode == 'move':
+        for d in old_dirs:
+            if _NAME.match(os.path.basename(d)):
+                try:
+                    os.rmdir(d)                         # only if empty
+                except OSError:
+                    pass
+    return out
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='Scan an acquisition tree, write a tile manifest.')
+    p.add_argument('root')
+    p.add_argument('ext', help='tile extension, e.g. tif')
+    p.add_argument('--manifest', default=None, help='manifest file, default <root>/manifest.csv '
+                   'or <flatten>/manifest.csv')
+    p.add_argument('--flatten', default=None, help='directory for the flat layout')
+    p.add_argument('--mode', default='link', choices=('link', 'move', 'copy'))
+    p.add_argument('--xml', default=None, help='ImageSnapper project with the expected samples')
+    p.add_argument('--workers', type=int, default=16)
+    a = p.parse_args(argv)
+    expected = None
+    if a.xml:
+        from imagesnapper import iter_samples
+        expected = [attrib.get('Name') for tag, attrib in iter_samples(a.xml)]
+    tiles, duplicates, missing = build_manifest(a.root, a.ext, expected, a.workers)
+    for t in duplicates:
+        print('duplicate (not used): %s' % t['path'])
+    if missing:
+        print('missing: %s' % ' '.join(missing))
+    if a.flatten:
+        tiles = flatten(tiles, a.flatten, a.ext, a.mode, a.workers)
+    path = a.manifest or os.path.join(a.flatten or a.root, 'manifest.csv')
+    write_manifest(path, tiles)
+    print('manifest written to %s' % path)
+    return 1 if missing else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())